@@ -0,0 +1,46 @@
+"""
+Compare two benchmark results, e.g. from before and after a change.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import json
+import sys
+
+
+def flatten(value, prefix=""):
+    """Every number in the results, keyed by its path. Lists of sweeps are keyed by server count."""
+    numbers = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ("config", "rss", "timestamp"):
+                continue
+            numbers.update(flatten(item, f"{prefix}{key}."))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            label = item.get("servers", index) if isinstance(item, dict) else index
+            numbers.update(flatten(item, f"{prefix}{label}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        numbers[prefix.rstrip(".")] = value
+    return numbers
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    with open(sys.argv[1]) as before_file, open(sys.argv[2]) as after_file:
+        before_results, after_results = json.load(before_file), json.load(after_file)
+    before, after = flatten(before_results), flatten(after_results)
+    print(f"{'metric':<50} {before_results.get('commit') or 'before':>14} {after_results.get('commit') or 'after':>14} {'change':>9}")
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        if old is None or new is None:
+            change = ""
+        elif old == 0:
+            change = "" if new == 0 else "new"
+        else:
+            change = f"{(new - old) / abs(old) * 100:+.1f}%"
+        print(f"{key:<50} {'' if old is None else f'{old:.6g}':>14} {'' if new is None else f'{new:.6g}':>14} {change:>9}")
+
+
+if __name__ == "__main__":
+    main()
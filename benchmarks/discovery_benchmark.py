@@ -0,0 +1,250 @@
+"""
+End to end benchmark of the discovery service.
+
+Starts a NATS server (an existing one with --nats-url, a local nats-server binary if there
+is one on the PATH, otherwise the in-process stand-in), a fleet of fake backends, the discovery
+server from service_discovery_server.py and a number of InferenceServerManager clients that
+call discover() at a fixed rate. Everything runs in this one process.
+
+Reports, as JSON:
+    - health sweep duration versus the number of servers, cold and with warm connections
+    - discovery round trip percentiles
+    - messages per second through NATS and published by the discovery server
+    - RSS over time while the clients are running
+
+Run from the root of the repo:
+    python -m benchmarks.discovery_benchmark --servers 200 --clients 20 --rate 200 --duration 10 --output results.json
+and compare two runs with:
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.fake_backends import start_fleet
+from benchmarks.fake_nats import FakeNATSServer
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(0.50),
+        "p90": rank(0.90),
+        "p99": rank(0.99),
+        "max": ordered[-1],
+    }
+
+
+def rss_bytes():
+    """The resident set size of this process, falls back to the peak RSS where /proc isn't available."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_nats(args):
+    """Returns (url, stop, message count or None)."""
+    if args.nats_url:
+        return args.nats_url, None, None
+    binary = shutil.which("nats-server")
+    if binary and not args.in_process_nats:
+        port = free_port()
+        process = subprocess.Popen([binary, "-a", "127.0.0.1", "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ## give it a moment to start listening
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+
+        async def stop():
+            process.terminate()
+            process.wait()
+        return f"nats://127.0.0.1:{port}", stop, None
+    server = await FakeNATSServer().start()
+    return server.url, server.stop, lambda: server.messages
+
+
+async def benchmark_health_sweeps(backends, server_counts, concurrency, timeout):
+    """Time a cold and a warm sweep over the first n backends, for every n."""
+    from health_check import HealthChecker
+    sweeps = []
+    for count in server_counts:
+        checker = HealthChecker(concurrency=concurrency, timeout=timeout)
+        urls = [backend.url for backend in backends[:count]]
+        timings = {}
+        for run in ("cold", "warm"):
+            start = time.perf_counter()
+            results = await checker.sweep(urls)
+            timings[run] = time.perf_counter() - start
+        await checker.close()
+        sweeps.append({
+            "servers": count,
+            "cold_seconds": timings["cold"],
+            "warm_seconds": timings["warm"],
+            "healthy": sum(result.ok for result in results),
+        })
+    return sweeps
+
+
+async def run(args):
+    logging.basicConfig(level=args.log_level)
+    nats_url, stop_nats, nats_messages = await start_nats(args)
+    os.environ["NATS_SERVER_URL"] = nats_url
+    ## every run starts cold, a registry persisted by an earlier run would bring back its dead backends
+    os.environ["REGISTRY_SNAPSHOT_PATH"] = ""
+
+    ## imported late so they pick up the settings above
+    import service_discovery_server
+    from get_inference_service import InferenceServerManager
+    from metrics import MESSAGES_PUBLISHED
+
+    server_counts = sorted({int(count) for count in args.sweep_servers.split(",")} | {args.servers})
+    backends = await start_fleet(max(server_counts), models_per_backend=args.models_per_backend,
+                                 latency=args.backend_latency, failure_rate=args.failure_rate, replicas=args.replicas)
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "nats": "external" if args.nats_url else ("in-process" if nats_messages else "nats-server"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+    }
+    results["health_sweeps"] = await benchmark_health_sweeps(backends, server_counts, args.concurrency, args.probe_timeout)
+
+    ## the discovery server, with the fleet already registered so its first sweep picks everything up
+    service_discovery_server.our_servers.extend(backend.url for backend in backends[:args.servers])
+    startup = time.perf_counter()
+    server_task = asyncio.create_task(service_discovery_server.run_nats_client())
+    while len(service_discovery_server.our_models) == 0 and time.perf_counter() - startup < 30:
+        await asyncio.sleep(0.01)
+    results["startup_to_registry_seconds"] = time.perf_counter() - startup
+
+    model_names = sorted({model["name"] for model in service_discovery_server.our_models})
+    managers = []
+    for index in range(args.clients):
+        manager = InferenceServerManager({
+            "name": random.choice(model_names) if model_names else "",
+            "quantization": "",
+            "use_regex_model_name": False,
+            "use_regex_quantization": False,
+        })
+        await manager.connect()
+        managers.append(manager)
+
+    rss = []
+    loop = asyncio.get_running_loop()
+    begin = loop.time()
+
+    async def sample_rss():
+        while True:
+            rss.append({"seconds": loop.time() - begin, "rss_bytes": rss_bytes()})
+            await asyncio.sleep(args.rss_interval)
+
+    async def timed_discover(manager):
+        start = time.perf_counter()
+        models = await manager.discover(timeout=args.discover_timeout, max_replies=1)
+        return time.perf_counter() - start, len(models)
+
+    sampler = asyncio.create_task(sample_rss())
+    published_before = sum(MESSAGES_PUBLISHED.values.values())
+    nats_before = nats_messages() if nats_messages else None
+    ## open loop, requests go out at the configured rate whether or not earlier ones have finished
+    total = int(args.rate * args.duration)
+    tasks = []
+    drive_start = loop.time()
+    for number in range(total):
+        delay = drive_start + number / args.rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed_discover(managers[number % len(managers)])))
+    outcomes = await asyncio.gather(*tasks)
+    elapsed = loop.time() - drive_start
+    sampler.cancel()
+    rss.append({"seconds": loop.time() - begin, "rss_bytes": rss_bytes()})
+
+    round_trips = [seconds for seconds, found in outcomes if found]
+    results["discovery"] = dict(percentiles(round_trips), requests=total, unanswered=total - len(round_trips),
+                                requests_per_second=total / elapsed)
+    results["published_by_discovery_per_second"] = (sum(MESSAGES_PUBLISHED.values.values()) - published_before) / elapsed
+    results["nats_messages_per_second"] = (nats_messages() - nats_before) / elapsed if nats_messages else None
+    results["rss"] = rss
+    results["rss_growth_bytes"] = rss[-1]["rss_bytes"] - rss[0]["rss_bytes"]
+
+    for manager in managers:
+        await manager.close()
+    server_task.cancel()
+    for backend in backends:
+        await backend.stop()
+    if stop_nats:
+        await stop_nats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark discovery against a local NATS and fake model backends.")
+    parser.add_argument("--servers", type=int, default=50, help="backends registered with the discovery server")
+    parser.add_argument("--sweep-servers", default="10,50,200", help="server counts to time health sweeps for")
+    parser.add_argument("--models-per-backend", type=int, default=4)
+    parser.add_argument("--replicas", type=int, default=2, help="backends serving each model")
+    parser.add_argument("--backend-latency", type=float, default=0.05, help="seconds per /models response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of /models requests that fail")
+    parser.add_argument("--concurrency", type=int, default=256, help="health check concurrency cap")
+    parser.add_argument("--probe-timeout", type=float, default=5.0)
+    parser.add_argument("--clients", type=int, default=20, help="InferenceServerManager clients")
+    parser.add_argument("--rate", type=float, default=100.0, help="discover() calls per second over all clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to keep the clients busy")
+    parser.add_argument("--discover-timeout", type=float, default=2.0)
+    parser.add_argument("--rss-interval", type=float, default=1.0)
+    parser.add_argument("--nats-url", help="use this NATS server instead of starting one")
+    parser.add_argument("--in-process-nats", action="store_true", help="use the in-process stand-in even if nats-server is installed")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    encoded = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(encoded + "\n")
+    print(encoded)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+## fake OpenAI-compatible inference servers that only serve /v1/models, with configurable latency and failures
+import asyncio
+import hashlib
+import json
+import random
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeBackend:
+    """
+    One fake inference server listening on its own port.
+
+    Args:
+        models (list): The model ids it serves, e.g. ["org/llama.Q4_K_M.gguf"]
+        latency (float): How long every response takes, in seconds.
+        failure_rate (float): The share of requests answered with a 500.
+        page_size (int): Serve the catalog in pages of this many models, OpenAI style with has_more and last_id. 0 serves it whole.
+        etags (bool): Send an ETag with the catalog and answer a matching If-None-Match with a 304.
+    """
+
+    def __init__(self, models, latency=0.0, failure_rate=0.0, host="127.0.0.1", page_size=0, etags=False):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.host = host
+        self.page_size = page_size
+        self.etags = etags
+        self.port = None
+        self.server = None
+        self.requests = 0
+        self.set_models(models)
+
+    def set_models(self, models):
+        self.models = models
+        self.body = json.dumps({"object": "list", "data": [{"id": model, "object": "model"} for model in models]}).encode()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, 0, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def page(self, query):
+        """The body of the catalog page a query asks for."""
+        if not self.page_size:
+            return self.body
+        after = parse_qs(query).get("after", [None])[0]
+        start = self.models.index(after) + 1 if after in self.models else 0
+        models = self.models[start:start + self.page_size]
+        has_more = start + self.page_size < len(self.models)
+        return json.dumps({"object": "list", "data": [{"id": model, "object": "model"} for model in models],
+                           "has_more": has_more, "last_id": models[-1] if models else None}).encode()
+
+    def response(self, path, if_none_match=None):
+        """Returns (status, extra headers, body)."""
+        if random.random() < self.failure_rate:
+            return "500 Internal Server Error", "", b'{"error": "fake failure"}'
+        url = urlsplit(path)
+        if url.path != "/v1/models":
+            return "404 Not Found", "", b'{"error": "not found"}'
+        body = self.page(url.query)
+        if not self.etags:
+            return "200 OK", "", body
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        if if_none_match == etag:
+            return "304 Not Modified", f"ETag: {etag}\r\n", b""
+        return "200 OK", f"ETag: {etag}\r\n", body
+
+    async def handle(self, reader, writer):
+        try:
+            ## keep-alive, so answer requests until the client hangs up
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                if_none_match = None
+                content_length = 0
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    name = name.strip().lower()
+                    if name == "if-none-match":
+                        if_none_match = value.strip()
+                    elif name == "content-length":
+                        content_length = int(value)
+                ## a request body isn't used, but has to be read before the next request on the connection
+                if content_length:
+                    await reader.readexactly(content_length)
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                parts = request_line.decode("latin-1").split(" ")
+                status, headers, body = self.response(parts[1] if len(parts) > 1 else "/", if_none_match)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n{headers}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+async def start_fleet(count, models_per_backend=4, latency=0.0, failure_rate=0.0, replicas=2, page_size=0, etags=False):
+    """
+    Start `count` fake backends. Each model is served by `replicas` backends, so clients have replicas to choose from.
+
+    Returns:
+        list: The started backends.
+    """
+    quantizations = ["Q4_K_M", "Q5_K_M", "Q8_0", "F16"]
+    backends = []
+    for index in range(count):
+        group = index // max(replicas, 1)
+        models = [f"org/model-{group}.{quantizations[number % len(quantizations)]}.gguf" for number in range(models_per_backend)]
+        backends.append(FakeBackend(models, latency=latency, failure_rate=failure_rate, page_size=page_size, etags=etags))
+    await asyncio.gather(*(backend.start() for backend in backends))
+    return backends
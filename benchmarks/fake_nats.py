@@ -0,0 +1,114 @@
+## a minimal in-process stand-in for nats-server, for benchmarking when the real one isn't installed.
+## it speaks enough of the client protocol for core pub/sub, headers, wildcards and queue groups,
+## it does not do clustering, auth or JetStream.
+import asyncio
+import json
+import random
+
+
+def subject_matches(pattern, subject):
+    """Match a subject against a subscription subject, with the `*` and `>` wildcards."""
+    pattern_tokens = pattern.split(".")
+    subject_tokens = subject.split(".")
+    for index, token in enumerate(pattern_tokens):
+        if token == ">":
+            return len(subject_tokens) > index
+        if index >= len(subject_tokens):
+            return False
+        if token != "*" and token != subject_tokens[index]:
+            return False
+    return len(pattern_tokens) == len(subject_tokens)
+
+
+class FakeNATSServer:
+    """
+    Routes messages between the clients connected to it.
+
+    Start it with `await FakeNATSServer().start()` and point clients at `server.url`.
+    `messages` counts every message published through it.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, max_payload=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_payload = max_payload
+        ## (writer, sid) -> (subject, queue group)
+        self.subscriptions = {}
+        self.server = None
+        self.messages = 0
+
+    @property
+    def url(self):
+        return f"nats://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer, _ in list(self.subscriptions):
+            writer.close()
+        await self.server.wait_closed()
+
+    def route(self, subject, reply, headers, payload):
+        self.messages += 1
+        groups = {}
+        for (writer, sid), (pattern, queue) in list(self.subscriptions.items()):
+            if not subject_matches(pattern, subject):
+                continue
+            if queue:
+                groups.setdefault((pattern, queue), []).append((writer, sid))
+            else:
+                self.deliver(writer, sid, subject, reply, headers, payload)
+        ## a queue group gets each message once, on a random member
+        for members in groups.values():
+            writer, sid = random.choice(members)
+            self.deliver(writer, sid, subject, reply, headers, payload)
+
+    def deliver(self, writer, sid, subject, reply, headers, payload):
+        if writer.is_closing():
+            return
+        reply_part = f" {reply}" if reply else ""
+        if headers is None:
+            writer.write(f"MSG {subject} {sid}{reply_part} {len(payload)}\r\n".encode() + payload + b"\r\n")
+        else:
+            writer.write(f"HMSG {subject} {sid}{reply_part} {len(headers)} {len(headers) + len(payload)}\r\n".encode() + headers + payload + b"\r\n")
+
+    async def handle_client(self, reader, writer):
+        info = {"server_id": "fake-nats", "version": "2.10.0", "proto": 1, "headers": True, "max_payload": self.max_payload}
+        writer.write(f"INFO {json.dumps(info)}\r\n".encode())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.decode().split()
+                if not parts:
+                    continue
+                op = parts[0].upper()
+                if op == "PING":
+                    writer.write(b"PONG\r\n")
+                elif op == "SUB":
+                    ## SUB <subject> [queue group] <sid>
+                    queue = parts[2] if len(parts) == 4 else None
+                    self.subscriptions[(writer, parts[-1])] = (parts[1], queue)
+                elif op == "UNSUB":
+                    self.subscriptions.pop((writer, parts[1]), None)
+                elif op == "PUB":
+                    ## PUB <subject> [reply] <size>
+                    data = await reader.readexactly(int(parts[-1]) + 2)
+                    self.route(parts[1], parts[2] if len(parts) == 4 else None, None, data[:-2])
+                elif op == "HPUB":
+                    ## HPUB <subject> [reply] <header size> <total size>
+                    header_size = int(parts[-2])
+                    data = await reader.readexactly(int(parts[-1]) + 2)
+                    self.route(parts[1], parts[2] if len(parts) == 5 else None, data[:header_size], data[header_size:-2])
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            for key in [key for key in self.subscriptions if key[0] is writer]:
+                del self.subscriptions[key]
+            writer.close()
@@ -0,0 +1,168 @@
+"""
+Startup benchmark of a discovery-aware worker, and a regression check for it.
+
+A short-lived worker pays for importing get_inference_service, connecting to NATS and its first
+discover() before it gets to do any work. Each run is a fresh interpreter:
+    - `python -X importtime` of the client module: its cumulative import time, and whether it pulled
+      in any of the heavy dependencies it should only load on first use
+    - import, connect and the first discover() against the discovery server from
+      service_discovery_server.py with a fleet of fake backends, started in this process
+
+Reports the medians and percentiles as JSON, and exits with status 1 when the client module imports
+a heavy dependency or a median goes over its budget.
+
+Run from the root of the repo:
+    python -m benchmarks.startup_benchmark --runs 10 --import-budget-ms 250 --startup-budget-ms 500
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from benchmarks.discovery_benchmark import git_commit, percentiles, start_nats
+from benchmarks.fake_backends import start_fleet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+## what the client must not import until it's used, each takes tens to hundreds of milliseconds
+HEAVY_MODULES = ("openai", "httpx", "pydantic", "dotenv", "requests")
+
+## runs in a fresh interpreter, anything it imports before the timer starts would hide its cost
+CLIENT_STARTUP = """
+import time
+start = time.perf_counter()
+from get_inference_service import InferenceServerManager
+imported = time.perf_counter()
+import asyncio, json, sys
+
+async def first_discover():
+    manager = InferenceServerManager({"name": "", "quantization": "", "use_regex_model_name": False, "use_regex_quantization": False})
+    await manager.connect()
+    connected = time.perf_counter()
+    models = await manager.discover(timeout=float(sys.argv[1]), max_replies=1)
+    discovered = time.perf_counter()
+    await manager.close()
+    return connected, discovered, len(models)
+
+connected, discovered, found = asyncio.run(first_discover())
+print(json.dumps({"import_seconds": imported - start, "connect_seconds": connected - imported,
+                  "discover_seconds": discovered - connected, "total_seconds": discovered - start, "models": found}))
+"""
+
+
+async def python(*arguments):
+    """Run a fresh interpreter in the root of the repo, returns (stdout, stderr, seconds it took)."""
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, *arguments, cwd=ROOT, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(f"python {' '.join(arguments)} exited with {process.returncode}:\n{stderr.decode()}")
+    return stdout.decode(), stderr.decode(), time.perf_counter() - start
+
+
+async def import_times(module):
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        dict: The cumulative import time in seconds of every module that was imported, by name.
+    """
+    _, stderr, _ = await python("-X", "importtime", "-c", f"import {module}")
+    times = {}
+    for line in stderr.splitlines():
+        ## import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+async def run(args):
+    logging.basicConfig(level=args.log_level)
+    nats_url, stop_nats, _ = await start_nats(args)
+    os.environ["NATS_SERVER_URL"] = nats_url
+    ## every run starts cold, a registry persisted by an earlier run would bring back its dead backends
+    os.environ["REGISTRY_SNAPSHOT_PATH"] = ""
+
+    ## imported late so it picks up the settings above
+    import service_discovery_server
+
+    backends = await start_fleet(args.servers, models_per_backend=args.models_per_backend)
+    service_discovery_server.our_servers.extend(backend.url for backend in backends)
+    server_task = asyncio.create_task(service_discovery_server.run_nats_client())
+    startup = time.perf_counter()
+    while len(service_discovery_server.our_models) == 0 and time.perf_counter() - startup < 30:
+        await asyncio.sleep(0.01)
+
+    imports, heavy = [], set()
+    for _ in range(args.runs):
+        times = await import_times(args.module)
+        imports.append(times[args.module])
+        heavy.update(name.split(".")[0] for name in times if name.split(".")[0] in HEAVY_MODULES)
+    startups = []
+    for _ in range(args.runs):
+        stdout, _, seconds = await python("-c", CLIENT_STARTUP, str(args.discover_timeout))
+        startups.append(dict(json.loads(stdout), process_seconds=seconds))
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+        "import": dict(percentiles(imports), heavy_modules=sorted(heavy)),
+        "startup": {stage: percentiles([startup[stage] for startup in startups])
+                    for stage in ("import_seconds", "connect_seconds", "discover_seconds", "total_seconds", "process_seconds")},
+        "unanswered": sum(not startup["models"] for startup in startups),
+    }
+    failures = []
+    if heavy:
+        failures.append(f"{args.module} imports {', '.join(sorted(heavy))}")
+    import_median = results["import"]["p50"] * 1000
+    if args.import_budget_ms and import_median > args.import_budget_ms:
+        failures.append(f"importing {args.module} takes {import_median:.0f}ms, the budget is {args.import_budget_ms:.0f}ms")
+    startup_median = results["startup"]["total_seconds"]["p50"] * 1000
+    if args.startup_budget_ms and startup_median > args.startup_budget_ms:
+        failures.append(f"import, connect and first discover() take {startup_median:.0f}ms, the budget is {args.startup_budget_ms:.0f}ms")
+    if results["unanswered"]:
+        failures.append(f"{results['unanswered']} of {args.runs} first discover() calls found no models")
+    results["failures"] = failures
+
+    server_task.cancel()
+    for backend in backends:
+        await backend.stop()
+    if stop_nats:
+        await stop_nats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of a discovery client and check it against a budget.")
+    parser.add_argument("--module", default="get_inference_service", help="the client module to import")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters to time, for each measurement")
+    parser.add_argument("--servers", type=int, default=10, help="backends registered with the discovery server")
+    parser.add_argument("--models-per-backend", type=int, default=4)
+    parser.add_argument("--discover-timeout", type=float, default=2.0)
+    parser.add_argument("--import-budget-ms", type=float, default=250.0, help="median import time allowed, 0 for no budget")
+    parser.add_argument("--startup-budget-ms", type=float, default=500.0, help="median import, connect and first discover() allowed, 0 for no budget")
+    parser.add_argument("--nats-url", help="use this NATS server instead of starting one")
+    parser.add_argument("--in-process-nats", action="store_true", help="use the in-process stand-in even if nats-server is installed")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    encoded = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(encoded + "\n")
+    print(encoded)
+    for failure in results["failures"]:
+        print(f"over budget: {failure}", file=sys.stderr)
+    sys.exit(1 if results["failures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+## circuit breakers per backend, fed by what clients report of their real inference requests
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+## a backend's circuit opens when at least this share of the requests in a window failed...
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+## ...and there were at least this many of them
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "5"))
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "30"))
+## how long a circuit stays open before requests are let through again, doubling every time it opens again
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "300"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    __slots__ = ("state", "window_start", "requests", "failures", "opened_at", "open_seconds", "last_ok")
+
+    def __init__(self, now):
+        self.state = CLOSED
+        self.window_start = now
+        self.requests = 0
+        self.failures = 0
+        self.opened_at = None
+        self.open_seconds = 0.0
+        ## when a client last said a request to it went well
+        self.last_ok = None
+
+
+def report_count(report, field):
+    """A count of a telemetry report, 0 if it's missing and None if it isn't a whole number of at least 0."""
+    value = report.get(field)
+    if value is None:
+        return 0
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        return None
+    return value
+
+
+class CircuitBreakers:
+    """
+    The circuit of every backend clients have told us about.
+
+    - closed: all is well, the backend is handed out as usual
+    - open: too many requests to it failed, it isn't handed out until `open_seconds` have passed
+    - half open: it's handed out again, but only after the closed ones. The next report closes
+      the circuit if its requests went well and opens it again, for twice as long, if any failed.
+      With other replicas around it may get no requests at all, so its next health check, see
+      `probed`, decides as well
+    """
+
+    def __init__(self, failure_rate=BREAKER_FAILURE_RATE, min_requests=BREAKER_MIN_REQUESTS, window=BREAKER_WINDOW,
+                 open_seconds=BREAKER_OPEN_SECONDS, max_open_seconds=BREAKER_MAX_OPEN_SECONDS):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.breakers = {}
+
+    def state(self, url, now):
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            return CLOSED
+        if breaker.state == OPEN and now - breaker.opened_at >= breaker.open_seconds:
+            breaker.state = HALF_OPEN
+            logger.info("Circuit of %s is half open", url)
+        return breaker.state
+
+    def record(self, report, now):
+        """
+        Take in a client's report of a backend, see `telemetry.TelemetryBuffer.drain`.
+
+        A report whose counts aren't whole numbers is skipped, it may come from anyone on the subject.
+
+        Returns:
+            str: OPEN or CLOSED if the circuit just opened or closed because of it, else None.
+        """
+        url = report["url"]
+        counts = [report_count(report, field) for field in ("ok", "errors", "timeouts")]
+        if None in counts:
+            logger.debug("Skipping a malformed telemetry report: %r", report)
+            return None
+        ok, errors, timeouts = counts
+        failures = errors + timeouts
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            breaker = self.breakers[url] = CircuitBreaker(now)
+        if ok:
+            breaker.last_ok = now
+        state = self.state(url, now)
+        if state == OPEN:
+            return None
+        if state == HALF_OPEN:
+            if failures:
+                return self.trip(url, breaker, now)
+            if ok:
+                return self.close(url, breaker, now)
+            return None
+        if now - breaker.window_start > self.window:
+            self.reset(breaker, now)
+        breaker.requests += ok + failures
+        breaker.failures += failures
+        if breaker.requests >= self.min_requests and breaker.failures >= self.failure_rate * breaker.requests:
+            return self.trip(url, breaker, now)
+        return None
+
+    def probed(self, url, ok, now):
+        """
+        Take in a health check of a backend. A passing one closes a half open circuit and a failing one
+        opens it again, the checks of closed and open circuits are left to the health checks themselves.
+
+        Returns:
+            str: OPEN or CLOSED if the circuit just opened or closed because of it, else None.
+        """
+        if self.state(url, now) != HALF_OPEN:
+            return None
+        breaker = self.breakers[url]
+        if ok:
+            return self.close(url, breaker, now)
+        return self.trip(url, breaker, now)
+
+    def half_open_at(self, url):
+        """When an open circuit goes half open, None if it isn't open."""
+        breaker = self.breakers.get(url)
+        if breaker is None or breaker.state != OPEN:
+            return None
+        return breaker.opened_at + breaker.open_seconds
+
+    def close(self, url, breaker, now):
+        breaker.state = CLOSED
+        breaker.open_seconds = 0.0
+        self.reset(breaker, now)
+        logger.info("Circuit of %s closed", url)
+        return CLOSED
+
+    def trip(self, url, breaker, now):
+        breaker.state = OPEN
+        breaker.opened_at = now
+        breaker.open_seconds = min(max(breaker.open_seconds * 2, self.open_seconds), self.max_open_seconds)
+        self.reset(breaker, now)
+        logger.warning("Circuit of %s opened for %.0fs", url, breaker.open_seconds)
+        return OPEN
+
+    def reset(self, breaker, now):
+        breaker.window_start = now
+        breaker.requests = 0
+        breaker.failures = 0
+
+    def serving(self, url, now, within):
+        """Whether clients said a request to the backend went well in the last `within` seconds, with its circuit closed."""
+        breaker = self.breakers.get(url)
+        return breaker is not None and breaker.state == CLOSED and breaker.last_ok is not None and now - breaker.last_ok <= within
+
+    def screen(self, models, now):
+        """
+        Drop the models on backends whose circuit is open.
+
+        Returns:
+            tuple: (models, demoted), the models that are left and the urls of the ones among them
+                whose circuit is half open, they should only be used when there's nothing better.
+        """
+        if not self.breakers:
+            return models, set()
+        usable, demoted = [], set()
+        for model in models:
+            state = self.state(model["url"], now)
+            if state == OPEN:
+                continue
+            if state == HALF_OPEN:
+                demoted.add(model["url"])
+            usable.append(model)
+        return usable, demoted
+
+    def forget(self, url):
+        self.breakers.pop(url, None)
@@ -0,0 +1,184 @@
+## async OpenAI clients for the discovered backends, one per backend, kept open so its connections are reused
+import asyncio
+import functools
+import inspect
+import logging
+import os
+from telemetry import ReportingTransport
+from tls import shared_ssl_context
+
+logger = logging.getLogger(__name__)
+
+## the api key sent to the backends, most self-hosted servers don't check it but the client insists on one
+INFERENCE_API_KEY = os.getenv("INFERENCE_API_KEY", "multiverse")
+## connections to one backend at most, and how many of them are kept open between requests
+CLIENT_POOL_MAX_CONNECTIONS = int(os.getenv("CLIENT_POOL_MAX_CONNECTIONS", "64"))
+CLIENT_POOL_MAX_KEEPALIVE = int(os.getenv("CLIENT_POOL_MAX_KEEPALIVE", "64"))
+## how long a completion may take, in seconds
+CLIENT_POOL_TIMEOUT = float(os.getenv("CLIENT_POOL_TIMEOUT", "600"))
+## how long an evicted client's requests get to finish before it's closed anyway, in seconds
+CLIENT_POOL_EVICT_GRACE = float(os.getenv("CLIENT_POOL_EVICT_GRACE", "60"))
+
+
+class OpenAIClientPool:
+    """
+    One AsyncOpenAI client per backend url, created on first use and kept until the backend goes away.
+
+    Each client has its own connection pool with at most `max_connections` connections to its backend,
+    so requests reuse keep-alive connections instead of paying a TCP and TLS handshake each.
+
+    With `report` set, every request a client makes is reported as report(url, latency, outcome),
+    see `telemetry.ReportingTransport`.
+
+    httpx and openai are only imported with the first client, they take most of a second to load
+    and a worker that only discovers models never needs them.
+    """
+
+    def __init__(self, api_key=INFERENCE_API_KEY, max_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                 max_keepalive=CLIENT_POOL_MAX_KEEPALIVE, timeout=CLIENT_POOL_TIMEOUT, report=None,
+                 grace=CLIENT_POOL_EVICT_GRACE):
+        self.api_key = api_key
+        self.report = report
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.grace = grace
+        self.clients = {}
+        ## the InFlightTransport of each client, to tell when an evicted one is done
+        self.transports = {}
+        ## evicted clients waiting for their requests to finish before they're closed
+        self.retiring = set()
+
+    def __contains__(self, url):
+        return url in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def client(self, url):
+        """The client of a backend, e.g. "http://10.0.0.5:8080/v1", created if we don't have one yet."""
+        client = self.clients.get(url)
+        if client is None:
+            import httpx
+            from openai import AsyncOpenAI
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive)
+            transport = httpx.AsyncHTTPTransport(verify=shared_ssl_context(), limits=limits)
+            if self.report is not None:
+                transport = ReportingTransport(transport, url, self.report)
+            transport = self.transports[url] = InFlightTransport(transport)
+            http_client = httpx.AsyncClient(transport=transport, timeout=self.timeout)
+            client = self.clients[url] = AsyncOpenAI(base_url=url, api_key=self.api_key, timeout=self.timeout, http_client=http_client)
+            logger.debug("Opened a client for %s", url)
+        return client
+
+    async def evict(self, url):
+        """
+        Stop handing out the client of a backend and close it in the background once the requests still
+        running on it are done, or after `grace` seconds whether they are or not.
+
+        Closing it straight away would abort them, when the backend may well still be serving them.
+        """
+        client = self.clients.pop(url, None)
+        if client is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.retire(url, client, self.transports.pop(url)))
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+
+    async def retire(self, url, client, transport):
+        try:
+            await asyncio.wait_for(transport.idle.wait(), self.grace)
+        except asyncio.TimeoutError:
+            logger.warning("Closing the client for %s with %d requests still running", url, transport.in_flight)
+        await client.close()
+        logger.debug("Closed the client for %s", url)
+
+    async def close(self):
+        """Evict every client and wait until they're all closed, at most `grace` seconds."""
+        for url in list(self.clients):
+            await self.evict(url)
+        if self.retiring:
+            await asyncio.gather(*self.retiring)
+
+
+class InFlightTransport:
+    """
+    Wraps a backend's httpx transport and counts the requests running on it, from sending one until its
+    response is closed, so streamed completions count until their last chunk.
+
+    Like `telemetry.ReportingTransport` it's an httpx.AsyncBaseTransport in all but name.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.in_flight = 0
+        ## set while no request is running
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def handle_async_request(self, request):
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.finished()
+            raise
+        response.stream = counted_stream_class()(response.stream, self.finished)
+        return response
+
+    def finished(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.idle.set()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.__aexit__(*exc_info)
+
+
+@functools.lru_cache(maxsize=None)
+def counted_stream_class():
+    """
+    The response stream of InFlightTransport, it has to be an httpx.AsyncByteStream so it's
+    only defined once httpx is loaded.
+    """
+    import httpx
+
+    class CountedStream(httpx.AsyncByteStream):
+        """A response stream that calls done() once, when it's closed."""
+
+        def __init__(self, stream, done):
+            self.stream = stream
+            self.done = done
+
+        async def __aiter__(self):
+            async for part in self.stream:
+                yield part
+
+        async def aclose(self):
+            try:
+                await self.stream.aclose()
+            finally:
+                if self.done is not None:
+                    done, self.done = self.done, None
+                    done()
+
+    return CountedStream
+
+
+async def call(callback, *args):
+    """Call a callback, awaiting it if it's async and on the default thread pool if it isn't, so it can block."""
+    if inspect.iscoroutinefunction(callback):
+        return await callback(*args)
+    result = await asyncio.get_running_loop().run_in_executor(None, callback, *args)
+    ## e.g. a lambda or partial around an async function
+    if inspect.isawaitable(result):
+        result = await result
+    return result
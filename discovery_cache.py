@@ -0,0 +1,75 @@
+## the client's cache of discovered models, one entry per query config
+import collections
+import json
+import os
+
+## how long a discovered list of models counts as fresh, in seconds. After that it's still served, but refreshed
+CLIENT_CACHE_TTL = float(os.getenv("CLIENT_CACHE_TTL", "30"))
+## how many queries we keep models for, the least recently used one goes first
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "128"))
+
+
+def query_key(query):
+    """A hashable key for a query config, the same for equal configs."""
+    return json.dumps(query, sort_keys=True, separators=(",", ":"))
+
+
+class CacheEntry:
+    __slots__ = ("query", "models", "expires")
+
+    def __init__(self, query, models, expires):
+        self.query = query
+        self.models = models
+        self.expires = expires
+
+
+class QueryCache:
+    """
+    The models matching each query, with a ttl per entry and least recently used eviction.
+
+    An entry's `models` list is updated in place, so whoever holds on to it sees the changes.
+    Pinned entries, e.g. the manager's own config, are never evicted.
+    """
+
+    def __init__(self, ttl=CLIENT_CACHE_TTL, max_entries=CLIENT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.pinned = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, query, models, now, pinned=False):
+        """
+        Store freshly discovered models for a query, they are fresh for `ttl` seconds from `now`.
+
+        The models replace those of an existing entry in place.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = CacheEntry(query, models, now + self.ttl)
+        else:
+            entry.models[:] = models
+            entry.expires = now + self.ttl
+            self.entries.move_to_end(key)
+        if pinned:
+            self.pinned.add(key)
+        while len(self.entries) - len(self.pinned) > self.max_entries:
+            for old_key in self.entries:
+                if old_key not in self.pinned:
+                    del self.entries[old_key]
+                    break
+        return entry
@@ -4,8 +4,6 @@ import subprocess
 import os
 import json
 
-from openai import OpenAI
-
 
 ## let's say you want to use the InferenceServerManager class to get all of the available models
 ## you can do the following:
@@ -16,18 +14,21 @@ all_available_models_query = {
     "use_regex_quantization": False
 }
 
+manager = InferenceServerManager(all_available_models_query)
+
 
-def new_server_cb(model):
+async def new_server_cb(model):
     print(f"New server available: {model}")
     ## here's where we could, for example, call a subprocess out to whatever other python script
     ## capture the output and print it to the console
     
-    ## the base_url is the url we fetched from the NATS server
-    client = OpenAI(base_url=model.get("url"), api_key="multiverse")
+    ## the manager keeps one client per backend url we fetched from the NATS server, so every
+    ## request to the same backend reuses its connections instead of opening new ones
+    client = manager.client(model)
     print(model)
     
     ## now, in this function, you can actually send a request to the server to get the model
-    completion = client.chat.completions.create(
+    completion = await client.chat.completions.create(
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": "Please tell me a joke about AIs"}
@@ -42,14 +43,14 @@ def new_server_cb(model):
     ## your code here...
     return content
     
+## callbacks can be plain functions too, they run on a thread pool so blocking in them is fine
 def server_unavailable_cb(model):
     print(f"Server unavailable: {model}")
-    ## your code to handle de-registering a server here...
+    ## your code to handle de-registering a server here, its client is closed for you...
     return
 
 
 async def main():
-    manager = InferenceServerManager(all_available_models_query)
     await manager.connect()
     await manager.listen_for_response(new_server_cb=new_server_cb, server_unavailable_cb=server_unavailable_cb)  # Listen for responses before we make requests
     await manager.update_servers()  # Initialize and make requests
@@ -58,9 +59,8 @@ async def main():
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
-        await manager.close()  # Properly close NATS connection
+        await manager.close()  # Properly close NATS connection and the backend clients
 
 if __name__ == '__main__':
     
     asyncio.run(main())
-
@@ -1,107 +1,599 @@
 ## ask for a service name and return the service object
-import json
-import re
+import asyncio
+import logging
 import os
+import time
+import weakref
 from nats.aio.client import Client as NATS    
+from nats.errors import TimeoutError as NATSTimeoutError
+from model_registry import matches_query, model_key
+from query_planner import order_models
+from load_balancing import LoadTracker, StickyRouter, get_strategy, LOAD_BALANCING_STRATEGY
+from wire_format import decode_available, decode_unavailable, decode_load_report, encode_request, request_headers
+from kv_registry import KVRegistry, REGISTRY_KV_BUCKET
+from discovery_cache import QueryCache, query_key
+from client_pool import OpenAIClientPool, call
+from telemetry import TelemetryBuffer, encode_telemetry, TELEMETRY_INTERVAL, TELEMETRY_SUBJECT
+from subjects import query_subject, covers, AVAILABLE_SUBJECT, UNAVAILABLE_SUBJECT, WITHDRAWN_SUBJECT
+from metrics import CLIENT_DECODE_SECONDS, CLIENT_REGISTRY_MODELS, CLIENT_STICKY_ROUTES, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+## how long discover() waits for discovery nodes to answer, in seconds
+DISCOVERY_TIMEOUT = float(os.getenv("DISCOVERY_TIMEOUT", "1.0"))
+
+## every manager in the process, so the registry size gauge can add them up when it's scraped
+managers = weakref.WeakSet()
+CLIENT_REGISTRY_MODELS.set_function(lambda: sum(len(manager.models) for manager in managers))
+
+
+def half_open(models):
+    """The urls of the backends whose circuit the discovery services said is half open, they go after the others."""
+    return {model["url"] for model in models if model.get("half_open")}
+
+
+def upsert_model(models, model):
+    """Add a model to a list, replacing the one with the same key, e.g. when a stale model is verified again. Returns whether it's new."""
+    key = model_key(model)
+    for index, known_model in enumerate(models):
+        if model_key(known_model) == key:
+            models[index] = model
+            return False
+    models.append(model)
+    return True
+
 
 class InferenceServerManager:
-    def __init__(self, config):
+    def __init__(self, config, strategy=LOAD_BALANCING_STRATEGY):
         self.config = config
         self.models = []
+        ## the newest registry revision we've seen announced by a discovery service
+        self.revision = 0
+        ## the load of each backend, as announced by discovery services and as we measure it ourselves
+        self.loads = LoadTracker()
+        self.strategy = get_strategy(strategy)
+        ## strategies asked for by name in pick(), kept so round robin keeps its place
+        self.strategies = {}
+        ## which backend each session key went to, for pick() with a key
+        self.router = StickyRouter()
+        ## the models of every query we've been asked for, our own config's entry is self.models itself.
+        ## it starts out expired, so the first get_models() fetches it
+        self.cache = QueryCache()
+        self.config_key = query_key(config)
+        self.cache.put(self.config_key, config, self.models, float("-inf"), pinned=True)
+        ## refreshes in flight, so concurrent ones of the same query share a single request
+        self.refreshing = {}
+        ## when update_servers() last asked for each query
+        self.updates_sent = {}
+        ## the shared registry bucket and the task following it, when bootstrapped from it
+        self.kv_registry = None
+        self.kv_follower = None
+        ## how our requests to each backend went, sent to the discovery services every TELEMETRY_INTERVAL
+        self.telemetry = TelemetryBuffer()
+        self.telemetry_sender = None
+        ## an OpenAI client per backend, closed when the backend goes away and its requests are done. Its requests report how they went
+        self.clients = OpenAIClientPool(report=self.report_outcome)
+        ## callbacks that are still running
+        self.callbacks = set()
+        ## the discovery nodes that told us about each backend, so one that shuts down only takes
+        ## the backends nobody else vouches for with it. The shared registry counts as one of them
+        self.sources = {}
+        ## the announcement handlers once we listen for them, and their subscriptions by subject
+        self.handlers = None
+        self.watched = {}
         nats_client_url = os.getenv("NATS_SERVER_URL", "nats://0.0.0.0:4222")
         self.nats_client = None
         self.nats_server = nats_client_url
+        managers.add(self)
     
-    def get_models(self):
-        return self.models
+    def get_models(self, query=None):
+        """
+        The models matching a query, our config by default, straight from the cache.
+
+        Cheap enough to call on every inference request, it never waits for the network. An expired
+        entry is served as it is while it's refreshed in the background, and a query we have nothing
+        for yet comes back empty while its models are fetched.
+        """
+        key = self.config_key if query is None else query_key(query)
+        entry = self.cache.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            self.start_refresh(query, key)
+        return entry.models if entry is not None else []
+
+    def find(self, query):
+        """
+        The models matching a query, best first the way its order_by says, straight from the cache like `get_models`.
+
+        Args:
+            query (dict): A query config, usually built with `query_planner.model_query`, e.g.
+                model_query(context_length=(32768, None), quant_family="K", order_by=["latency"], limit=3)
+        """
+        models = self.get_models(query)
+        return order_models(models, query, self.loads.loads, half_open(models))
+
+    async def best_fit(self, query):
+        """
+        The model that fits a query best, asking the discovery services if we have nothing fresh for it.
+
+        The discovery services answer from their indexes and send their best candidates only, so it takes
+        a single round trip. Their candidates are ordered again with our own view of the backends' load.
+
+        Returns:
+            dict: The model record, or None if nothing matches.
+        """
+        key = query_key(query)
+        entry = self.cache.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            await self.refresh(query)
+        models = self.get_models(query)
+        best = order_models(models, dict(query, limit=1), self.loads.loads, half_open(models))
+        return best[0] if best else None
+
+    def client(self, model):
+        """
+        The pooled AsyncOpenAI client of the backend serving a model, reuse it rather than creating your own.
+
+        Args:
+            model (dict|str): A model record, or the url of its backend.
+        """
+        return self.clients.client(model if isinstance(model, str) else model["url"])
+
+    def notify(self, callback, model):
+        """
+        Call a new server or server unavailable callback in the background, so a slow one doesn't hold up
+        the messages behind it. Async callbacks run on the event loop, anything else on a thread pool.
+        """
+        if callback is None:
+            return
+        task = asyncio.get_running_loop().create_task(call(callback, model))
+        self.callbacks.add(task)
+        task.add_done_callback(self.callback_done)
+
+    def callback_done(self, task):
+        self.callbacks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("A discovery callback failed", exc_info=task.exception())
+
+    def serves(self, url):
+        """Whether any query we have cached still has a model on a backend."""
+        return any(model["url"] == url for entry in self.cache for model in entry.models)
+
+    async def evict_clients(self, urls):
+        """
+        Evict the clients of backends that none of our queries have a model on anymore, and forget who told us about them.
+
+        They're not handed out again, and are closed once the requests running on them are done, see `OpenAIClientPool.evict`.
+        """
+        for url in urls:
+            if not self.serves(url):
+                self.sources.pop(url, None)
+                if url in self.clients:
+                    await self.clients.evict(url)
+
+    def vouch(self, node, models):
+        """Note that a discovery node told us about the backends of these models."""
+        if node is None:
+            return
+        for model in models:
+            sources = self.sources.get(model["url"])
+            if sources is None:
+                sources = self.sources[model["url"]] = set()
+            sources.add(node)
+
+    def start_refresh(self, query=None, key=None):
+        """Start refreshing a query in the background, or return the refresh already in flight. None without an event loop."""
+        key = key or (self.config_key if query is None else query_key(query))
+        task = self.refreshing.get(key)
+        if task is not None:
+            return task
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        task = self.refreshing[key] = loop.create_task(self.fetch(query, key))
+        task.add_done_callback(lambda done: self.refresh_done(key, done))
+        return task
+
+    def refresh_done(self, key, task):
+        self.refreshing.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logger.warning("Refreshing models failed: %s", task.exception())
+
+    async def refresh(self, query=None):
+        """Fetch the models matching a query, our config by default, again. Returns them once they're in the cache."""
+        return await asyncio.shield(self.start_refresh(query))
+
+    async def fetch(self, query, key):
+        query = self.config if query is None else query
+        discovered, answered = await self.ask(query)
+        entry = self.cache.get(key)
+        ## every node that is up answers, if only with an empty frame, so no answer at all means none is: keep serving what we have
+        if not answered:
+            return entry.models if entry is not None else []
+        ## what the discovery services say now replaces what we had, even if it's nothing, so models that went away
+        ## without us hearing about it go too, and with them the clients of backends nothing else is on
+        gone = {model["url"] for model in entry.models} if entry is not None else set()
+        models = self.cache.put(key, query, list(discovered.values()), time.monotonic(), pinned=key == self.config_key).models
+        await self.evict_clients(gone - {model["url"] for model in models})
+        return models
+
+    def pick(self, model_name, strategy=None, key=None):
+        """
+        Pick one of the backends serving a model, spreading traffic over all of them.
+
+        With a key every request for it goes to the same backend, as long as that one is around and not
+        overloaded, so multi-turn chats find their prompt still cached there, see `load_balancing.StickyRouter`.
+
+            model = manager.pick(name, key=prompt_prefix_key(messages))
+
+        Args:
+            model_name (str): The name of the model.
+            strategy (str): "round_robin", "least_latency" or "power_of_two", defaults to the manager's strategy.
+                Not used with a key.
+            key (str): A session id, or `load_balancing.prompt_prefix_key` of the conversation.
+
+        Returns:
+            dict: The model record of the chosen backend, or None if no backend serves the model.
+        """
+        replicas = [model for model in self.models if model["name"] == model_name]
+        if not replicas:
+            return None
+        ## backends whose circuit is half open only get traffic when there's nothing else, as the discovery services hand them out
+        replicas = [model for model in replicas if not model.get("half_open")] or replicas
+        if key is not None:
+            model, outcome = self.router.route(replicas, key)
+            CLIENT_STICKY_ROUTES.inc(outcome=outcome)
+            return model
+        if strategy is None:
+            return self.strategy.choose(replicas, self.loads.loads)
+        if strategy not in self.strategies:
+            self.strategies[strategy] = get_strategy(strategy)
+        return self.strategies[strategy].choose(replicas, self.loads.loads)
+
+    def stats(self):
+        """What the manager knows and how its sticky routing is doing, e.g. stats()["sticky"]["hit_rate"]."""
+        return {
+            "models": len(self.models),
+            "cached_queries": len(self.cache),
+            "clients": len(self.clients),
+            "revision": self.revision,
+            "sticky": self.router.stats(),
+        }
+
+    def record_latency(self, url, latency, ok=True):
+        """
+        Tell the manager how long a request to a backend took, so least-latency picks use our own measurements too.
+
+        Requests made with `client` are recorded on their own, this is for the ones made some other way.
+        """
+        self.report_outcome(url, latency, "ok" if ok else "error")
+
+    def report_outcome(self, url, latency=None, outcome="ok"):
+        """
+        Record how a request to a backend went, for our own load balancing and for the discovery services'
+        circuit breakers, which stop handing out backends whose requests keep failing.
+
+        Args:
+            outcome (str): "ok", "error" or "timeout".
+        """
+        self.loads.record_latency(url, latency or 0.0, outcome == "ok")
+        self.telemetry.record(url, latency, outcome)
+
+    async def send_telemetry(self):
+        """Send what we recorded of our requests every TELEMETRY_INTERVAL seconds, in one batch."""
+        while True:
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+            await self.flush_telemetry()
+
+    async def flush_telemetry(self):
+        if not self.telemetry or not self.nats_client or not self.nats_client.is_connected:
+            return
+        for frame in encode_telemetry(self.telemetry.drain(), self.nats_client.max_payload):
+            await self.nats_client.publish(TELEMETRY_SUBJECT, frame)
+
+    def take_load(self, model):
+        """Remember the load a discovery service sent along with a model, and return the model without it."""
+        if "load" not in model:
+            return model
+        model = dict(model)
+        self.loads.update(model["url"], model.pop("load"))
+        return model
     
     async def connect(self):
         if not self.nats_client:
             self.nats_client = NATS()
-            print("Connecting to NATS server: ", self.nats_server)
+            logger.info("Connecting to NATS server: %s", self.nats_server)
             await self.nats_client.connect(self.nats_server)
-            print("connected to NATS server: ", self.nats_server)
+            logger.info("connected to NATS server: %s", self.nats_server)
+            self.telemetry_sender = asyncio.create_task(self.send_telemetry())
+            await start_metrics_server()
         
-    async def update_servers(self):
+    async def update_servers(self, query=None):
         """
         Issues a request to the service discovery service to get the latest list of available servers.
+
+        The answers come on inference.available. Calls for the same query, our config by default,
+        while an earlier request is still being answered share that request instead of sending another.
         """
-        if not self.nats_client and not self.nats_client.is_connected:
-            self.connect()
+        await self.connect()
+        query = self.config if query is None else query
+        ## the answer goes out on the subject of the model, which we may not be subscribed to yet
+        await self.watch(query)
+        key = query_key(query)
+        now = asyncio.get_running_loop().time()
+        sent = self.updates_sent.get(key)
+        if sent is not None and now - sent < DISCOVERY_TIMEOUT:
+            return
+        self.updates_sent[key] = now
         # Request the model service
-        print("Requesting models: ", self.config)
-        await self.nats_client.publish("inference.requested", json.dumps(self.config).encode())
+        logger.debug("Requesting models: %s", query)
+        await self.nats_client.publish("inference.requested", encode_request(query), headers=request_headers())
         
-        print("Requested models: ", self.config)
+        logger.debug("Requested models: %s", query)
+
+    async def discover(self, timeout=DISCOVERY_TIMEOUT, max_replies=None):
+        """
+        Ask every discovery node for the models matching our config and wait for their answers.
+
+        The answers come back on a private inbox rather than on inference.available,
+        so nobody else has to receive and filter them.
+
+        Args:
+            timeout (float): How long to wait for answers, in seconds.
+            max_replies (int): Stop as soon as this many nodes have answered, instead of waiting for the timeout.
+
+        Returns:
+            list: The models from all the answers, merged. They are also added to our list of models.
+        """
+        discovered, answered = await self.ask(self.config, timeout, max_replies)
+        known = {model_key(model) for model in self.models}
+        self.models.extend(model for key, model in discovered.items() if key not in known)
+        if answered:
+            self.cache.get(self.config_key).expires = time.monotonic() + self.cache.ttl
+        return list(discovered.values())
+
+    async def ask(self, query, timeout=DISCOVERY_TIMEOUT, max_replies=None):
+        """
+        Send a query to every discovery node and collect their answers on a private inbox.
+
+        Returns:
+            tuple: (discovered, answered), the matching models by key and the nodes that answered in full.
+        """
+        await self.connect()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        inbox = self.nats_client.new_inbox()
+        subscription = await self.nats_client.subscribe(inbox)
+        discovered = {}
+        answered = set()
+        try:
+            ## the headers say we can read binary answers, which are smaller and faster to decode
+            await self.nats_client.publish("inference.requested", encode_request(query), reply=inbox, headers=request_headers())
+            while max_replies is None or len(answered) < max_replies:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    msg = await subscription.next_msg(timeout=remaining)
+                except NATSTimeoutError:
+                    break
+                with CLIENT_DECODE_SECONDS.time(subject="_INBOX"):
+                    models, revision = decode_available(msg.data, msg.headers)
+                self.revision = max(self.revision, revision)
+                headers = msg.headers or {}
+                for model in models:
+                    model = self.take_load(model)
+                    if matches_query(query, model):
+                        discovered[model_key(model)] = model
+                self.vouch(headers.get("Node"), models)
+                ## a node has answered once we have the last of its frames
+                number, _, count = headers.get("Frame", "1/1").partition("/")
+                if number == count:
+                    answered.add(headers.get("Node", len(answered)))
+        finally:
+            await subscription.unsubscribe()
+        return discovered, answered
             
+    async def bootstrap(self, bucket=REGISTRY_KV_BUCKET, new_server_cb=None, server_unavailable_cb=None):
+        """
+        Read the models matching our config from the discovery registry's JetStream bucket, and keep following it.
+
+        One bulk read instead of asking every discovery node, after that only changes come in.
+
+        Args:
+            bucket (str): The bucket the discovery nodes keep the registry in, see REGISTRY_KV_BUCKET.
+            new_server_cb: Called with every model that shows up after the bulk read.
+            server_unavailable_cb: Called with every model that goes away after the bulk read.
+
+        Returns:
+            list: Our models after the bulk read.
+        """
+        await self.connect()
+        self.kv_registry = await KVRegistry.open(self.nats_client, bucket, create=False)
+        state = await self.kv_registry.load()
+        self.revision = max(self.revision, state["revision"])
+        for url, snapshot in state["snapshots"].items():
+            if url in state["loads"]:
+                self.loads.update(url, state["loads"][url])
+            self.replace_server(url, snapshot["models"])
+            self.vouch(bucket, snapshot["models"])
+
+        async def follow():
+            async for change in self.kv_registry.changes():
+                ## a server that was removed takes its models with it
+                if change.kind == "server" and change.value is not None:
+                    continue
+                if change.value is not None:
+                    self.loads.update(change.url, change.value.get("load"))
+                    self.vouch(bucket, change.value["models"])
+                    ## the revision the models were announced at, not the bucket's sequence number
+                    self.revision = max(self.revision, change.value["version"])
+                added, removed = self.replace_server(change.url, change.value["models"] if change.value else [])
+                for model in added:
+                    self.notify(new_server_cb, model)
+                for model in removed:
+                    self.notify(server_unavailable_cb, model)
+                if removed:
+                    await self.evict_clients([change.url])
+
+        self.kv_follower = asyncio.create_task(follow())
+        return self.models
+
+    def replace_server(self, url, models):
+        """
+        Swap the models we know from one backend for the ones it serves now.
+
+        Returns:
+            tuple: (added, removed), the models that are new to us and the ones that went away.
+        """
+        models = [model for model in models if matches_query(self.config, model)]
+        known = {model_key(model) for model in self.models if model["url"] == url}
+        keys = {model_key(model) for model in models}
+        added = [model for model in models if model_key(model) not in known]
+        removed = [model for model in self.models if model["url"] == url and model_key(model) not in keys]
+        self.models[:] = [model for model in self.models if model["url"] != url] + models
+        return added, removed
+
     async def handle_service_unavailability(self, models, server_unavailable_cb=None):
         """
         Listens for the inference.unavailable message and updates the list of available servers.
 
+        The clients of backends that have nothing left that we're interested in are closed.
+
         Args:
-            models (list): List of models that are no longer available.
+            models (list): List of models that are no longer available, a model without a name stands for its whole server.
         """
-        for model in models:
-            for known_model in self.models:
-                if known_model["url"] == model["url"]:
-                    self.models.remove(known_model)
-                    if server_unavailable_cb:
-                        await server_unavailable_cb(model)
-        
+        whole_servers = {model["url"] for model in models if "name" not in model}
+        named = {(model["url"], model["name"]) for model in models if "name" in model}
+
+        def unavailable(known_model):
+            return known_model["url"] in whole_servers or (known_model["url"], known_model["name"]) in named
+
+        removed = [known_model for known_model in self.models if unavailable(known_model)]
+        ## filter into new lists rather than removing while iterating, which skips entries. Every cached query loses them
+        for entry in self.cache:
+            entry.models[:] = [known_model for known_model in entry.models if not unavailable(known_model)]
+        await self.evict_clients(whole_servers | {url for url, _ in named})
+        for known_model in removed:
+            self.notify(server_unavailable_cb, known_model)
+
+    async def handle_withdrawal(self, node, servers, server_unavailable_cb=None):
+        """
+        Forget a discovery node that is shutting down, with the backends only it told us about.
+
+        What it looked after and another node takes over comes back with the refresh this starts,
+        until then the other backends of each model take its traffic.
+
+        Args:
+            node (str): The id of the node.
+            servers (list): The backends it looked after, as models without a name.
+        """
+        gone = []
+        for server in servers:
+            sources = self.sources.get(server["url"])
+            if sources and node in sources:
+                sources.discard(node)
+                if not sources:
+                    gone.append(server)
+        logger.info("Discovery node %s withdrew, dropping %d of its %d servers", node, len(gone), len(servers))
+        if gone:
+            await self.handle_service_unavailability(gone, server_unavailable_cb)
+            self.start_refresh()
+
+    async def watch(self, query):
+        """
+        Subscribe to the announcements of the models a query config matches, see `subjects.query_subject`.
+
+        A subject that one of our subscriptions covers already isn't subscribed to again, and the subscriptions
+        a new one covers are dropped once it's there, so nothing comes in twice. Does nothing before `listen_for_response`.
+        """
+        if self.handlers is None:
+            return
+        available_handler, unavailable_handler = self.handlers
+        for prefix, handler in ((AVAILABLE_SUBJECT, available_handler), (UNAVAILABLE_SUBJECT, unavailable_handler)):
+            subject = query_subject(prefix, query)
+            if any(covers(watched, subject) for watched in self.watched):
+                continue
+            self.watched[subject] = await self.nats_client.subscribe(subject, cb=handler)
+            logger.debug("Subscribed to %s", subject)
+            for watched in [watched for watched in self.watched if watched != subject and covers(subject, watched)]:
+                await self.watched.pop(watched).unsubscribe()
+                logger.debug("Unsubscribed from %s, %s covers it", watched, subject)
 
     async def listen_for_response(self, new_server_cb=None, server_unavailable_cb=None):
         """
         Listens for the inference.available message and updates the list of available servers.
+
+        Only the announcements of the models our config matches come in, the NATS server filters them
+        by subject. Other queries get theirs when they're asked for with `update_servers`, until then
+        their cached models are refreshed when they expire.
+
+        Args:
+            new_server_cb: Called with every new model that matches our config.
+            server_unavailable_cb: Called with every model of ours that goes away.
+                Either can be async or a plain function, a plain one runs on a thread pool so it may block.
         """
-        print("Listening for available models")
-        print(new_server_cb)
-        print(server_unavailable_cb)
+        logger.debug("Listening for available models, callbacks: %s, %s", new_server_cb, server_unavailable_cb)
         async def available_handler(msg):
-            print("Received models: ", msg.data.decode())
-            models = json.loads(msg.data.decode())
-            if models.get("requested_model"):
-                model = models.get("selected_model")
-                valid = self.add_model(model)
-                if valid and new_server_cb:
-                    await new_server_cb(model)
-        print("Listening for available models")
-        await self.nats_client.subscribe("inference.available", cb=available_handler)
-        print("Subscribed to inference.available")
+            logger.debug("Received models: %s", msg.data)
+            ## a frame can carry a single model or a batch of them
+            with CLIENT_DECODE_SECONDS.time(subject="inference.available"):
+                models, revision = decode_available(msg.data, msg.headers)
+            if models:
+                self.revision = max(self.revision, revision)
+                self.vouch((msg.headers or {}).get("Node"), models)
+            for model in models:
+                model = self.take_load(model)
+                if self.add_model(model):
+                    self.notify(new_server_cb, model)
+
         ## listen to the response on inference.unavailable
         async def unavailable_handler(msg):
-            models = json.loads(msg.data.decode())
+            with CLIENT_DECODE_SECONDS.time(subject="inference.unavailable"):
+                models = decode_unavailable(msg.data, msg.headers)
+            headers = msg.headers or {}
+            ## a discovery node shutting down, what it told us about may still be served by the others
+            if headers.get("Withdrawn") and "Node" in headers:
+                await self.handle_withdrawal(headers["Node"], models, server_unavailable_cb)
+                return
+            if "Revision" in headers:
+                self.revision = max(self.revision, int(headers["Revision"]))
             await self.handle_service_unavailability(models, server_unavailable_cb)
-        
-        print("Listening for unavailable models")
-        await self.nats_client.subscribe("inference.unavailable", cb=unavailable_handler)
-        print("Subscribed to inference.unavailable")
+
+        ## discovery services send the load of every backend after each health check
+        async def load_handler(msg):
+            with CLIENT_DECODE_SECONDS.time(subject="inference.load"):
+                loads = decode_load_report(msg.data, msg.headers)
+            for load in loads:
+                self.loads.update(load.pop("url"), load)
+
+        self.handlers = (available_handler, unavailable_handler)
+        await self.watch(self.config)
+        ## a discovery node going away concerns us whatever models we want
+        await self.nats_client.subscribe(WITHDRAWN_SUBJECT, cb=unavailable_handler)
+        await self.nats_client.subscribe("inference.load", cb=load_handler)
         
     async def close(self):
+        ## stop everything that still uses the connection, refreshes and callbacks included, before it's closed
+        tasks = [task for task in (self.kv_follower, self.telemetry_sender) if task]
+        tasks += list(self.refreshing.values()) + list(self.callbacks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.flush_telemetry()
+        await self.clients.close()
         await self.nats_client.close()
-        print("Closed connection to NATS server")
+        logger.info("Closed connection to NATS server")
         
     def add_model(self, model):
-        ## make sure it matches our requested config
-        ## if the model wasn't empty, check if the model name matches
-        
-        if self.config["name"] != "":
-            ## check if we're using regex match
-            if self.config["use_regex_model_name"]:
-                if not re.match(self.config["name"], model["name"]):
-                    return False
-            else:
-                if self.config["name"] != model["name"]:
-                    return False
-        ## if the quantization wasn't empty, check if the quantization matches
-        if self.config["quantization"] != "":
-            ## check if we're using regex match
-            if self.config["use_regex_quantization"]:
-                if not re.match(self.config["quantization"], model["quantization"]):
-                    return False
-            else:
-                if self.config["quantization"] != model["quantization"]:
-                    return False
-        self.models.append(model)
-        return True
+        ## the other queries we have cached get it too, if it matches them
+        for entry in self.cache:
+            if entry.models is not self.models and matches_query(entry.query, model):
+                upsert_model(entry.models, model)
+        ## make sure it matches our requested config, an empty name or quantization matches anything
+        if not matches_query(self.config, model):
+            return False
+        ## only a model that is new to us counts, one we know already is just updated
+        return upsert_model(self.models, model)
         
     
\ No newline at end of file
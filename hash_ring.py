@@ -0,0 +1,47 @@
+## consistent hashing, of servers onto shard workers and of sessions onto the replicas of a model
+import bisect
+import hashlib
+
+
+def hash_key(key):
+    ## python's own hash() differs between processes, the workers have to agree
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto members.
+
+    When a member comes or goes only the keys it owned, or the ones it takes over, change hands.
+    """
+
+    def __init__(self, members=(), points=64):
+        ## points per member on the ring, more spread the keys more evenly
+        self.points = points
+        self.set_members(members)
+
+    def set_members(self, members):
+        entries = sorted((hash_key(f"{member}#{point}"), member) for member in members for point in range(self.points))
+        self.hashes = [hashed for hashed, _ in entries]
+        self.owners = [member for _, member in entries]
+        self.members = set(members)
+
+    def owner(self, key):
+        """The member that owns `key`, or None if there are no members."""
+        if not self.hashes:
+            return None
+        return self.owners[bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)]
+
+    def candidates(self, key):
+        """Every member once, in the order they come round the ring from `key`, the owner first."""
+        if not self.hashes:
+            return
+        start = bisect.bisect(self.hashes, hash_key(key))
+        seen = set()
+        for index in range(len(self.hashes)):
+            member = self.owners[(start + index) % len(self.hashes)]
+            if member not in seen:
+                seen.add(member)
+                yield member
+                if len(seen) == len(self.members):
+                    return
@@ -0,0 +1,192 @@
+## concurrent health checks for the inference servers we know about
+import asyncio
+import hashlib
+import os
+import zlib
+from urllib.parse import urlsplit
+import httpx
+from tls import shared_ssl_context
+from model_catalog import CatalogPage, CatalogParser, CATALOG_MAX_PAGES, next_cursor, page_params
+
+HEALTH_CHECK_CONCURRENCY = int(os.getenv("HEALTH_CHECK_CONCURRENCY", "256"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "10"))
+## the connection pool scans all of its connections whenever a request starts or finishes,
+## so one big pool gets quadratically slower with the number of servers. we spread servers
+## over several small pools instead, each server always lands in the same one.
+HEALTH_CHECK_POOL_SHARDS = int(os.getenv("HEALTH_CHECK_POOL_SHARDS", "16"))
+## response headers a backend, or a proxy in front of it, can set to tell us how busy it is
+IN_FLIGHT_HEADER = "X-Requests-In-Flight"
+QUEUE_DEPTH_HEADER = "X-Queue-Depth"
+
+
+def header_int(response, header):
+    try:
+        return int(response.headers[header])
+    except (KeyError, ValueError):
+        return None
+
+
+class ProbeResult:
+    """
+    The outcome of probing a single server's /models endpoint.
+
+    `unchanged` is set when the server's catalog is the same as at its last successful probe,
+    its models aren't parsed again then and `models` is empty, the caller has them from last time.
+    """
+
+    def __init__(self, url, ok, models=None, error=None, latency=None, in_flight=None, queue_depth=None, unchanged=False):
+        self.url = url
+        self.ok = ok
+        self.models = models or []
+        self.unchanged = unchanged
+        self.error = error
+        self.latency = latency
+        self.in_flight = in_flight
+        self.queue_depth = queue_depth
+
+    def __repr__(self):
+        if self.ok:
+            return f"ProbeResult({self.url!r}, ok, {len(self.models)} models, {self.latency:.3f}s)"
+        return f"ProbeResult({self.url!r}, failed: {self.error!r})"
+
+
+class HealthChecker:
+    """
+    Probes inference servers concurrently over a pooled async HTTP client.
+
+    The clients are kept for the lifetime of the checker so keep-alive connections
+    are reused from one sweep to the next. At most `concurrency` probes are in flight
+    at once and every probe is bounded by `timeout` seconds, so a sweep takes roughly
+    as long as its slowest probe rather than the sum of all of them.
+
+    The pages of every server's catalog are remembered by their ETag, content hash and cursor only,
+    a page that comes back unchanged isn't parsed again. Their models aren't kept, the registry has them.
+    """
+
+    def __init__(self, concurrency=HEALTH_CHECK_CONCURRENCY, timeout=HEALTH_CHECK_TIMEOUT, pool_shards=HEALTH_CHECK_POOL_SHARDS):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.clients = [
+            httpx.AsyncClient(
+                verify=shared_ssl_context(),
+                timeout=httpx.Timeout(timeout),
+                limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+                follow_redirects=True,
+            )
+            for _ in range(max(1, pool_shards))
+        ]
+        self.catalogs = {}
+
+    def client_for(self, server_url):
+        """Return the pooled client that owns connections to this server's host."""
+        host = urlsplit(server_url).netloc.encode()
+        return self.clients[zlib.crc32(host) % len(self.clients)]
+
+    async def fetch_page(self, server_url, after, cached):
+        """
+        Fetch one page of a server's catalog.
+
+        Returns:
+            tuple: (response, CatalogPage, unchanged), `cached` itself when the page is the same as last time.
+        """
+        headers = {"If-None-Match": cached.etag} if cached is not None and cached.etag else None
+        async with self.client_for(server_url).stream("GET", f"{server_url}/models", params=page_params(after), headers=headers) as response:
+            if response.status_code == 304 and cached is not None:
+                return response, cached, True
+            response.raise_for_status()
+            digest = hashlib.blake2b(digest_size=16)
+            ## a page we haven't seen is parsed as it arrives, one we have only if its hash says it changed
+            parser = CatalogParser() if cached is None else None
+            chunks = []
+            async for chunk in response.aiter_bytes():
+                digest.update(chunk)
+                if parser is None:
+                    chunks.append(chunk)
+                else:
+                    parser.feed(chunk)
+            etag = response.headers.get("ETag")
+            if cached is not None and digest.digest() == cached.digest:
+                cached.etag = etag
+                return response, cached, True
+            if parser is None:
+                parser = CatalogParser()
+                for chunk in chunks:
+                    parser.feed(chunk)
+            parser.close()
+            return response, CatalogPage(etag, digest.digest(), parser.models, next_cursor(parser.fields, parser.models)), False
+
+    async def probe(self, server_url):
+        """
+        Fetch the model list of a single server, following its pages if it has more than one.
+
+        Args:
+            server_url (str): The base url of the server, e.g. https://host/v1
+
+        Returns:
+            ProbeResult: ok with the CatalogModels of the /models response, or failed with the error.
+        """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            try:
+                first, pages, unchanged = await self.fetch_catalog(server_url, self.catalogs.get(server_url, []))
+                ## some pages came back the same but others didn't, and we don't have the models of the same ones
+                if not unchanged and any(page.models is None for page in pages):
+                    first, pages, unchanged = await self.fetch_catalog(server_url, [])
+            except (httpx.HTTPError, asyncio.TimeoutError, ValueError) as e:
+                ## the registry drops what a failed server served, so after it recovers we need its models again
+                self.catalogs.pop(server_url, None)
+                return ProbeResult(server_url, False, error=e, latency=loop.time() - start)
+            models = [] if unchanged else [model for page in pages for model in page.models]
+            self.catalogs[server_url] = [CatalogPage(page.etag, page.digest, None, page.after) for page in pages]
+            return ProbeResult(server_url, True, models=models, latency=loop.time() - start, unchanged=unchanged,
+                               in_flight=header_int(first, IN_FLIGHT_HEADER),
+                               queue_depth=header_int(first, QUEUE_DEPTH_HEADER))
+
+    async def fetch_catalog(self, server_url, cached_pages):
+        """
+        Fetch every page of a server's catalog, with the pages we remember from last time.
+
+        Returns:
+            tuple: (the response of the first page, the CatalogPages, whether every one of them is the same as last time).
+                The pages that are the same come back without their models.
+        """
+        pages = []
+        unchanged = bool(cached_pages)
+        after = None
+        while len(pages) < CATALOG_MAX_PAGES:
+            cached = cached_pages[len(pages)] if len(pages) < len(cached_pages) else None
+            ## a cached page is only the same page if it starts where this one does
+            if cached is not None and pages and cached_pages[len(pages) - 1].after != after:
+                cached = None
+            ## httpx timeouts apply per read, so also cap the whole exchange
+            response, page, same = await asyncio.wait_for(self.fetch_page(server_url, after, cached), self.timeout)
+            if not pages:
+                first = response
+            pages.append(page)
+            unchanged = unchanged and same
+            if page.after is None or page.after == after:
+                break
+            after = page.after
+        return first, pages, unchanged and len(pages) == len(cached_pages)
+
+    def forget(self, server_url):
+        """Drop what we remember of a server's catalog."""
+        self.catalogs.pop(server_url, None)
+
+    async def sweep(self, server_urls):
+        """
+        Probe every server at once.
+
+        Args:
+            server_urls (list): Base urls of the servers to probe.
+
+        Returns:
+            list: One ProbeResult per server, in the same order as `server_urls`.
+        """
+        return await asyncio.gather(*(self.probe(server_url) for server_url in server_urls))
+
+    async def close(self):
+        for client in self.clients:
+            await client.aclose()
@@ -0,0 +1,167 @@
+## decides when each backend gets its next health check
+import asyncio
+import heapq
+import itertools
+import os
+import random
+from load_balancing import ewma
+
+## a healthy backend starts at the minimum interval and backs off towards the maximum while it stays healthy
+HEALTH_CHECK_MIN_INTERVAL = float(os.getenv("HEALTH_CHECK_MIN_INTERVAL", "5"))
+HEALTH_CHECK_MAX_INTERVAL = float(os.getenv("HEALTH_CHECK_MAX_INTERVAL", "300"))
+HEALTH_CHECK_GROWTH = float(os.getenv("HEALTH_CHECK_GROWTH", "1.5"))
+## after this many failures in a row a backend counts as dead and is checked exponentially less often
+HEALTH_CHECK_DEAD_AFTER = int(os.getenv("HEALTH_CHECK_DEAD_AFTER", "3"))
+HEALTH_CHECK_DEAD_MAX_INTERVAL = float(os.getenv("HEALTH_CHECK_DEAD_MAX_INTERVAL", "600"))
+## spread checks by up to this share of their interval, so they don't all fire together
+HEALTH_CHECK_JITTER = float(os.getenv("HEALTH_CHECK_JITTER", "0.1"))
+## a backend whose health changes this often, as a moving average over its checks, is flapping
+FLAPPING_THRESHOLD = 0.3
+
+
+class BackendSchedule:
+    __slots__ = ("url", "interval", "failures", "healthy", "flapping", "due")
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.failures = 0
+        self.healthy = None
+        self.flapping = 0.0
+        self.due = None
+
+
+class HealthScheduler:
+    """
+    Keeps one heap entry per backend, ordered by when it is next due for a health check.
+
+    - a healthy backend is checked less and less often, up to `max_interval`
+    - one that clients are successfully sending requests to goes straight to `max_interval`
+    - a failing or flapping backend is checked again after `min_interval`
+    - a dead one, `dead_after` failures in a row, backs off exponentially up to `dead_max_interval`
+    - a backend that just recovered starts over at `min_interval`
+    """
+
+    def __init__(self, min_interval=HEALTH_CHECK_MIN_INTERVAL, max_interval=HEALTH_CHECK_MAX_INTERVAL,
+                 growth=HEALTH_CHECK_GROWTH, dead_after=HEALTH_CHECK_DEAD_AFTER,
+                 dead_max_interval=HEALTH_CHECK_DEAD_MAX_INTERVAL, jitter=HEALTH_CHECK_JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.dead_after = dead_after
+        self.dead_max_interval = dead_max_interval
+        self.jitter = jitter
+        self.schedules = {}
+        self.heap = []
+        ## breaks ties in the heap, so urls are never compared
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def __contains__(self, url):
+        return url in self.schedules
+
+    def __len__(self):
+        return len(self.schedules)
+
+    def push(self, schedule, due):
+        schedule.due = due
+        heapq.heappush(self.heap, (due, next(self.counter), schedule.url))
+
+    def add(self, url, now, delay=0.0):
+        """Start checking a backend, its first check is due after `delay` seconds. A known backend is just rescheduled."""
+        schedule = self.schedules.get(url)
+        if schedule is None:
+            schedule = self.schedules[url] = BackendSchedule(url, self.min_interval)
+        self.push(schedule, now + delay)
+        self.wakeup.set()
+
+    def expedite(self, url, due):
+        """
+        Bring a backend's next check forward to `due`. Nothing changes while it's being checked, that
+        check's result schedules the next one, or when it's due sooner anyway.
+
+        Returns:
+            bool: Whether its check was moved.
+        """
+        schedule = self.schedules.get(url)
+        if schedule is None or schedule.due is None or schedule.due <= due:
+            return False
+        self.push(schedule, due)
+        self.wakeup.set()
+        return True
+
+    def remove(self, url):
+        ## its heap entries are skipped when they come up
+        self.schedules.pop(url, None)
+
+    def pop_due(self, now):
+        """Take every backend whose check is due. It isn't due again until its result is `record`ed."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, url = heapq.heappop(self.heap)
+            schedule = self.schedules.get(url)
+            ## skip entries of removed backends and ones that were rescheduled since
+            if schedule is None or schedule.due != when:
+                continue
+            schedule.due = None
+            due.append(url)
+        return due
+
+    def next_due(self):
+        """When the earliest check is due, or None if nothing is scheduled."""
+        while self.heap:
+            when, _, url = self.heap[0]
+            schedule = self.schedules.get(url)
+            if schedule is not None and schedule.due == when:
+                return when
+            heapq.heappop(self.heap)
+        return None
+
+    def record(self, result, now, serving=False):
+        """
+        Schedule a backend's next check from the outcome of this one.
+
+        Args:
+            result (ProbeResult): The outcome of the check.
+            now (float): The current event loop time.
+            serving (bool): Whether clients report that their requests to it are going well.
+        """
+        schedule = self.schedules.get(result.url)
+        if schedule is None:
+            return
+        changed = schedule.healthy is not None and schedule.healthy != result.ok
+        schedule.flapping = ewma(schedule.flapping, 1.0 if changed else 0.0)
+        if result.ok:
+            schedule.failures = 0
+            if changed or schedule.flapping > FLAPPING_THRESHOLD:
+                schedule.interval = self.min_interval
+            ## real traffic says more about it than a probe could, the probe is only there to notice new models
+            elif serving:
+                schedule.interval = self.max_interval
+            else:
+                schedule.interval = min(schedule.interval * self.growth, self.max_interval)
+        else:
+            schedule.failures += 1
+            if schedule.failures < self.dead_after:
+                ## check again soon, to tell a blip from a dead backend
+                schedule.interval = self.min_interval
+            else:
+                ## capped, long before the cap on the interval 2 ** failures gets too big for a float
+                backoff = 2 ** min(schedule.failures - self.dead_after + 1, 32)
+                schedule.interval = min(self.min_interval * backoff, self.dead_max_interval)
+        schedule.healthy = result.ok
+        self.push(schedule, now + schedule.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+        ## the loop may be asleep with nothing else due
+        self.wakeup.set()
+
+    async def wait(self, now, longest=None):
+        """Sleep until the next check is due, until a backend is added, or for at most `longest` seconds."""
+        next_due = self.next_due()
+        timeout = None if next_due is None else max(next_due - now, 0)
+        if longest is not None:
+            timeout = longest if timeout is None else min(timeout, longest)
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,160 @@
+## keeps the registry in a NATS JetStream key-value bucket, shared by every discovery node and readable by clients
+import base64
+import json
+import logging
+import os
+from nats.js.errors import BucketNotFoundError
+
+logger = logging.getLogger(__name__)
+
+## the bucket to keep the registry in, empty keeps it in memory only
+REGISTRY_KV_BUCKET = os.getenv("REGISTRY_KV_BUCKET", "")
+## entries nobody has refreshed for this long expire, in seconds. Every node refreshes what it health checks
+## three times per ttl, so only the servers no node looks after anymore go away
+REGISTRY_KV_TTL = float(os.getenv("REGISTRY_KV_TTL", "90"))
+
+SERVER_PREFIX = "servers."
+MODELS_PREFIX = "models."
+DELETE_OPERATIONS = ("DEL", "PURGE")
+
+
+def url_key(prefix, url):
+    ## urls have characters keys can't have, e.g. ':'
+    return prefix + base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+
+
+class KVChange:
+    """
+    One change to the bucket.
+
+    - kind is "server" or "models"
+    - value is None when the entry was deleted, otherwise the server's descriptor or its {"url", "version", "models", "load"}
+    - sequence is the bucket's sequence number of the change, it has nothing to do with the registry's revision
+    """
+    __slots__ = ("kind", "url", "value", "sequence")
+
+    def __init__(self, kind, url, value, sequence):
+        self.kind = kind
+        self.url = url
+        self.value = value
+        self.sequence = sequence
+
+
+class KVRegistry:
+    """
+    The registry as a JetStream key-value bucket.
+
+    Every registered server has a `servers.<url>` entry and every server that passed a health check a
+    `models.<url>` entry with what it serves. Start with `load` for everything in the bucket in one bulk
+    read, then follow `changes` for what others write after that.
+
+    The bucket's max age is the ttl of every entry, this version of the client can't set one per key.
+    """
+
+    def __init__(self, kv, ttl=REGISTRY_KV_TTL):
+        self.kv = kv
+        self.ttl = ttl
+        self.watcher = None
+        ## the bucket's sequence number of the last change we read. Every write moves it on, the ttl refreshes
+        ## included, so it's kept apart from the registry's revision, which only moves when models change
+        self.sequence = 0
+
+    @classmethod
+    async def open(cls, nats_client, bucket=REGISTRY_KV_BUCKET, ttl=REGISTRY_KV_TTL, create=True):
+        """Open the bucket, creating it if it doesn't exist yet and `create` is set, otherwise raises BucketNotFoundError."""
+        js = nats_client.jetstream()
+        try:
+            kv = await js.key_value(bucket)
+        except BucketNotFoundError:
+            if not create:
+                raise
+            kv = await js.create_key_value(bucket=bucket, ttl=ttl, history=1, description="inference service discovery registry")
+            logger.info("Created registry bucket %s", bucket)
+        return cls(kv, ttl)
+
+    async def put(self, key, value):
+        return await self.kv.put(key, json.dumps(value, separators=(",", ":")).encode())
+
+    async def delete(self, key):
+        await self.kv.delete(key)
+
+    async def put_server(self, url, descriptor=None):
+        await self.put(url_key(SERVER_PREFIX, url), descriptor or {"url": url})
+
+    async def delete_server(self, url):
+        await self.delete(url_key(SERVER_PREFIX, url))
+        await self.delete(url_key(MODELS_PREFIX, url))
+
+    async def put_models(self, url, version, models, load=None):
+        await self.put(url_key(MODELS_PREFIX, url), {"url": url, "version": version, "models": models, "load": load})
+
+    async def delete_models(self, url):
+        await self.delete(url_key(MODELS_PREFIX, url))
+
+    def change(self, entry):
+        """Turn a watcher entry into a KVChange, None for entries that aren't ours to read."""
+        if entry.key.startswith(SERVER_PREFIX):
+            kind, prefix = "server", SERVER_PREFIX
+        elif entry.key.startswith(MODELS_PREFIX):
+            kind, prefix = "models", MODELS_PREFIX
+        else:
+            return None
+        encoded = entry.key[len(prefix):]
+        url = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+        if entry.operation in DELETE_OPERATIONS:
+            return KVChange(kind, url, None, entry.revision)
+        try:
+            return KVChange(kind, url, json.loads(entry.value), entry.revision)
+        except ValueError:
+            logger.warning("Skipping a damaged registry entry %s", entry.key)
+            return None
+
+    async def load(self):
+        """
+        Read everything in the bucket at once, and start watching it for changes.
+
+        Returns:
+            dict: {"revision", "servers", "descriptors", "snapshots": {url: {"version", "models"}}, "loads": {url: load}},
+                the same shape `registry_store.RegistryStore.load` returns. The revision is the newest version of
+                any server's models, what the node that wrote them announced them at.
+        """
+        state = {"revision": 0, "servers": [], "descriptors": {}, "snapshots": {}, "last_seen": {}, "loads": {}}
+        self.watcher = await self.kv.watchall()
+        ## the watcher hands out the newest entry of every key and then None, then whatever changes after
+        while True:
+            entry = await self.watcher.updates(timeout=None)
+            if entry is None:
+                break
+            change = self.change(entry)
+            if change is None:
+                continue
+            self.sequence = max(self.sequence, change.sequence)
+            if change.value is None:
+                continue
+            if change.kind == "server":
+                if change.url not in state["servers"]:
+                    state["servers"].append(change.url)
+                if isinstance(change.value, dict):
+                    state["descriptors"][change.url] = change.value
+            else:
+                state["snapshots"][change.url] = {"version": change.value["version"], "models": change.value["models"]}
+                state["revision"] = max(state["revision"], change.value["version"])
+                if change.value.get("load"):
+                    state["loads"][change.url] = change.value["load"]
+        return state
+
+    async def changes(self):
+        """Yield a KVChange for every change made to the bucket since `load`, our own writes included."""
+        while True:
+            entry = await self.watcher.updates(timeout=None)
+            if entry is None:
+                continue
+            change = self.change(entry)
+            if change is not None:
+                self.sequence = max(self.sequence, change.sequence)
+                yield change
+
+    async def close(self):
+        if self.watcher is not None:
+            await self.watcher.stop()
+            self.watcher = None
@@ -0,0 +1,275 @@
+## per-backend load signals and the strategies we use to spread traffic over replicas
+import collections
+import hashlib
+import itertools
+import math
+import os
+import random
+import time
+from hash_ring import HashRing
+
+## how much weight a new sample gets in the moving averages
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", "0.3"))
+LOAD_BALANCING_STRATEGY = os.getenv("LOAD_BALANCING_STRATEGY", "power_of_two")
+## sticky routing: no replica takes more than this many times its fair share of a model's sessions
+STICKY_BALANCE = float(os.getenv("STICKY_BALANCE", "1.25"))
+## a session nobody routed for this long is forgotten, in seconds, and we remember this many at most
+STICKY_SESSION_TTL = float(os.getenv("STICKY_SESSION_TTL", "600"))
+STICKY_MAX_SESSIONS = int(os.getenv("STICKY_MAX_SESSIONS", "100000"))
+## how much of a conversation `prompt_prefix_key` hashes, in characters
+STICKY_PREFIX_LENGTH = int(os.getenv("STICKY_PREFIX_LENGTH", "2048"))
+
+
+def ewma(average, sample, alpha=EWMA_ALPHA):
+    """Fold a sample into an exponentially weighted moving average, the first sample starts it."""
+    if average is None:
+        return sample
+    return average + alpha * (sample - average)
+
+
+def load_score(load):
+    """
+    Turn a backend's load signals into a single number, lower is better.
+
+    Args:
+        load (dict): The backend's load, see `LoadTracker.load`. Missing signals count as idle.
+    """
+    if not load:
+        return 0.0
+    latency = load.get("latency") or 0.0
+    waiting = (load.get("in_flight") or 0) + (load.get("queue_depth") or 0)
+    error_rate = min(load.get("error_rate") or 0.0, 0.99)
+    return latency * (1 + waiting) / (1 - error_rate)
+
+
+class LoadTracker:
+    """
+    Keeps the load signals of every backend we health check.
+
+    Probe latency and error rate are moving averages over the probes, in-flight requests
+    and queue depth are whatever the backend last reported, if it reports them at all.
+
+    A client also measures its own requests with `record_latency`. Those are kept apart from what the
+    discovery services announce, and their latency and error rate win over the announced ones, so a
+    backend's latency doesn't flip between probe and completion latency with every announcement.
+    """
+
+    def __init__(self):
+        self.loads = {}
+        ## the latency and error rate of the requests we made ourselves, by backend
+        self.measured = {}
+
+    def record_probe(self, result):
+        """Update a backend's load from a `health_check.ProbeResult`."""
+        load = self.loads.setdefault(result.url, {"latency": None, "error_rate": None, "in_flight": None, "queue_depth": None})
+        load["error_rate"] = ewma(load["error_rate"], 0.0 if result.ok else 1.0)
+        if result.ok:
+            load["latency"] = ewma(load["latency"], result.latency)
+            load["in_flight"] = result.in_flight
+            load["queue_depth"] = result.queue_depth
+
+    def record_latency(self, url, latency, ok=True):
+        """Update a backend's load from a request someone else made to it."""
+        measured = self.measured.get(url)
+        if measured is None:
+            measured = self.measured[url] = {"latency": None, "error_rate": None}
+        measured["error_rate"] = ewma(measured["error_rate"], 0.0 if ok else 1.0)
+        if ok:
+            measured["latency"] = ewma(measured["latency"], latency)
+        load = self.loads.setdefault(url, {"latency": None, "error_rate": None, "in_flight": None, "queue_depth": None})
+        load.update((key, value) for key, value in measured.items() if value is not None)
+
+    def update(self, url, load):
+        """Take over the load a discovery service announced for a backend, but for what we measured ourselves."""
+        if load:
+            load = self.loads[url] = dict(load)
+            measured = self.measured.get(url)
+            if measured is not None:
+                load.update((key, value) for key, value in measured.items() if value is not None)
+
+    def load(self, url):
+        return self.loads.get(url)
+
+    def forget(self, url):
+        self.loads.pop(url, None)
+        self.measured.pop(url, None)
+
+    def report(self):
+        """Every backend's load as a list, the way it is sent on inference.load."""
+        return [dict(load, url=url) for url, load in self.loads.items()]
+
+
+class RoundRobin:
+    """Hand out the replicas of each model in turn."""
+
+    def __init__(self):
+        self.counters = {}
+
+    def choose(self, replicas, loads):
+        counter = self.counters.setdefault(replicas[0]["name"], itertools.count())
+        return replicas[next(counter) % len(replicas)]
+
+
+class LeastLatency:
+    """Pick the replica with the lowest moving average latency, weighted by its queue and error rate. Backends we know nothing about go first."""
+
+    def choose(self, replicas, loads):
+        return min(replicas, key=lambda model: (load_score(loads.get(model["url"])), random.random()))
+
+
+class PowerOfTwoChoices:
+    """Pick two replicas at random and take the less loaded one, which avoids everyone piling onto the same best one."""
+
+    def choose(self, replicas, loads):
+        if len(replicas) == 1:
+            return replicas[0]
+        first, second = random.sample(replicas, 2)
+        if load_score(loads.get(second["url"])) < load_score(loads.get(first["url"])):
+            return second
+        return first
+
+
+def prompt_prefix_key(messages, length=STICKY_PREFIX_LENGTH):
+    """
+    A routing key from the start of a chat, for callers without a session id of their own.
+
+    Conversations that start the same, e.g. with the same long system prompt, get the same key and so
+    the backend that has that prefix cached already.
+
+    Args:
+        messages (list): The chat messages, {"role", "content"} dicts as the OpenAI API takes them.
+        length (int): How many characters of the conversation to hash.
+    """
+    prefix = []
+    size = 0
+    for message in messages:
+        part = f"{message.get('role', '')}\n{message.get('content') or ''}\n"
+        prefix.append(part)
+        size += len(part)
+        if size >= length:
+            break
+    return hashlib.blake2b("".join(prefix)[:length].encode(), digest_size=16).hexdigest()
+
+
+class Session:
+    __slots__ = ("model", "url", "used")
+
+    def __init__(self, model, url, used):
+        self.model = model
+        self.url = url
+        self.used = used
+
+
+class StickyRouter:
+    """
+    Sends every request with the same key to the same replica of a model, so the backend still has
+    the conversation's prompt in its KV cache.
+
+    Keys are consistent hashed onto the replicas, with bounded loads (Mirrokni et al., "Consistent
+    Hashing with Bounded Loads"): a replica takes at most `balance` times its fair share of the model's
+    sessions, a key whose replica is full goes on round the ring to the next one that isn't. A session
+    sticks to the replica it got, so when a replica goes only its sessions move. When one comes, only
+    as many sessions move to it as it takes to bring the others back under their bound, and it fills
+    up with new ones.
+
+    Every route is counted as a hit (the replica the key had last time), new (a key we hadn't seen)
+    or moved (its replica went away or is full).
+    """
+
+    def __init__(self, balance=STICKY_BALANCE, ttl=STICKY_SESSION_TTL, max_sessions=STICKY_MAX_SESSIONS):
+        self.balance = balance
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        ## (model name, key) -> Session, least recently used first
+        self.sessions = collections.OrderedDict()
+        ## model name -> (the replicas' urls, their ring), rebuilt when the replicas change
+        self.rings = {}
+        ## model name -> url -> sessions on it
+        self.counts = collections.defaultdict(collections.Counter)
+        self.outcomes = collections.Counter()
+
+    def ring(self, model, urls):
+        known = self.rings.get(model)
+        if known is None or known[0] != urls:
+            known = self.rings[model] = (urls, HashRing(urls))
+        return known[1]
+
+    def expire(self, now):
+        """Forget the least recently used sessions that timed out, or are too many."""
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            ## room for the one we may be about to add
+            if len(self.sessions) < self.max_sessions and now - session.used <= self.ttl:
+                return
+            self.sessions.popitem(last=False)
+            self.counts[session.model][session.url] -= 1
+
+    def route(self, replicas, key, now=None):
+        """
+        The replica for a key, the same one every time as long as it's there and not overloaded.
+
+        Args:
+            replicas (list): The model records of the healthy replicas of one model.
+            key (str): A session id, or a `prompt_prefix_key`.
+
+        Returns:
+            tuple: (model record, outcome), outcome is "hit", "new" or "moved".
+        """
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        model = replicas[0]["name"]
+        by_url = {replica["url"]: replica for replica in replicas}
+        counts = self.counts[model]
+        ## the sessions of replicas that went away don't count towards the fair share, there's no one to share with
+        capacity = math.ceil(self.balance * (sum(counts[url] for url in by_url) + 1) / len(by_url))
+        session = self.sessions.get((model, key))
+        if session is not None:
+            if session.url in by_url and counts[session.url] <= capacity:
+                session.used = now
+                self.sessions.move_to_end((model, key))
+                self.outcomes["hit"] += 1
+                return by_url[session.url], "hit"
+            counts[session.url] -= 1
+            outcome = "moved"
+        else:
+            outcome = "new"
+        ring = self.ring(model, frozenset(by_url))
+        url = next((url for url in ring.candidates(key) if counts[url] < capacity), None) or ring.owner(key)
+        counts[url] += 1
+        self.sessions[(model, key)] = Session(model, url, now)
+        self.sessions.move_to_end((model, key))
+        self.outcomes[outcome] += 1
+        return by_url[url], outcome
+
+    def stats(self):
+        """
+        How well sessions stick.
+
+        Returns:
+            dict: The routes per outcome, the sessions we remember, and the hit rate: of the routes of
+                keys we'd seen before, the share that went to the same replica as last time.
+        """
+        returning = self.outcomes["hit"] + self.outcomes["moved"]
+        return {
+            "hits": self.outcomes["hit"],
+            "new": self.outcomes["new"],
+            "moved": self.outcomes["moved"],
+            "sessions": len(self.sessions),
+            "hit_rate": self.outcomes["hit"] / returning if returning else None,
+        }
+
+
+STRATEGIES = {
+    "round_robin": RoundRobin,
+    "least_latency": LeastLatency,
+    "power_of_two": PowerOfTwoChoices,
+}
+
+
+def get_strategy(strategy):
+    """Look up a strategy by name, or pass through anything that already has a `choose` method."""
+    if hasattr(strategy, "choose"):
+        return strategy
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown load balancing strategy: {strategy}, expected one of {', '.join(STRATEGIES)}")
+    return STRATEGIES[strategy]()
@@ -0,0 +1,186 @@
+## prometheus style metrics for the discovery service and its clients, served on a local /metrics endpoint
+import asyncio
+import bisect
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+## the /metrics endpoint is only started when a port is configured
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, value in list(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def set_function(self, function):
+        """Sample the gauge by calling `function` when the metrics are scraped, so nothing is recorded on the hot path."""
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().render()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            ## one count per bucket plus +Inf, then the sum and the total count
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        ## only the bucket the value falls into is counted, they are added up when rendering
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, **labels):
+        """Time a block of code, `with histogram.time(): ...`"""
+        return Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def subject_label(subject):
+    """Reply inboxes are unique per request, count them all under one label. The same for the subjects of every model."""
+    if subject.startswith("_INBOX."):
+        return "_INBOX"
+    if subject.startswith(("inference.available.", "inference.unavailable.")):
+        return subject.rsplit(".", 2)[0] + ".>"
+    return subject
+
+
+def render():
+    """Every metric in the prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+## discovery service
+HEALTH_PROBE_SECONDS = Histogram("discovery_health_probe_seconds", "Latency of health probes per backend.", ["backend", "outcome"])
+REQUEST_HANDLER_SECONDS = Histogram("discovery_request_handler_seconds", "Time spent handling an inference.requested message.")
+MESSAGES_PUBLISHED = Counter("discovery_messages_published_total", "Messages published per subject.", ["subject"])
+CIRCUIT_TRANSITIONS = Counter("discovery_circuit_transitions_total", "Circuit breaker state changes per backend.", ["backend", "state"])
+REGISTRY_MODELS = Gauge("discovery_registry_models", "Models in the discovery service's registry.")
+
+## clients
+CLIENT_DECODE_SECONDS = Histogram("discovery_client_decode_seconds", "Time spent decoding a discovery message.", ["subject"])
+CLIENT_REGISTRY_MODELS = Gauge("discovery_client_registry_models", "Models known to the InferenceServerManagers in this process.")
+CLIENT_STICKY_ROUTES = Counter("discovery_client_sticky_routes_total", "Sticky routes by whether the key kept its backend, moved or was new.", ["outcome"])
+
+metrics_server = None
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Serve the metrics on http://host:port/metrics, once per process.
+
+    Does nothing when no port is configured, or when the endpoint is already running.
+    """
+    global metrics_server
+    if not port or metrics_server is not None:
+        return metrics_server
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) > 1 and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    metrics_server = await asyncio.start_server(handle, host, port)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return metrics_server
@@ -0,0 +1,282 @@
+## reading a server's /models catalog a page and a chunk at a time, into compact model entries
+import codecs
+import json
+import os
+import re
+
+## models per page to ask paginating servers for, 0 leaves it to the server
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "0"))
+## stop following a server's pages after this many, in case its cursor never ends
+CATALOG_MAX_PAGES = int(os.getenv("CATALOG_MAX_PAGES", "100"))
+
+WHITESPACE = re.compile(r"\s*")
+decoder = json.JSONDecoder()
+
+## a GGUF quantization type somewhere in a model id, e.g. the Q4_K_M of "org/llama-3-8b.Q4_K_M.gguf"
+QUANTIZATION_PATTERN = re.compile(r"(?<![A-Za-z0-9])(I?Q\d_(?:K(?:_[A-Z]+)?|\d|[A-Z]+(?:_[A-Z]+)?)|BF16|FP16|F16|FP32|F32)(?![A-Za-z0-9])", re.IGNORECASE)
+## the size in a model id, e.g. the 8b of "llama-3-8b" or the 8x7B of "mixtral-8x7B"
+PARAMETERS_PATTERN = re.compile(r"(?<![A-Za-z0-9.])(?:(\d+)x)?(\d+(?:\.\d+)?)([bBmM])(?![A-Za-z0-9])")
+## roughly how many bits per weight each quantization takes, the more the closer to the original model
+QUANT_BITS = {
+    "IQ1_S": 1.56, "IQ1_M": 1.75, "IQ2_XXS": 2.06, "IQ2_XS": 2.31, "IQ2_S": 2.5, "IQ2_M": 2.7,
+    "IQ3_XXS": 3.06, "IQ3_XS": 3.3, "IQ3_S": 3.44, "IQ3_M": 3.66, "IQ4_XS": 4.25, "IQ4_NL": 4.5,
+    "Q2_K": 2.63, "Q3_K_S": 3.5, "Q3_K_M": 3.91, "Q3_K_L": 4.27, "Q4_0": 4.55, "Q4_1": 5.0,
+    "Q4_K_S": 4.58, "Q4_K_M": 4.89, "Q5_0": 5.54, "Q5_1": 6.0, "Q5_K_S": 5.54, "Q5_K_M": 5.69,
+    "Q6_K": 6.59, "Q8_0": 8.5, "F16": 16.0, "BF16": 16.0, "F32": 32.0,
+}
+## what the servers that say who they are in `owned_by` can do, descriptor labels take precedence
+SERVER_CAPABILITIES = {
+    "vllm": {"streaming": True, "batching": True},
+    "llamacpp": {"streaming": True},
+}
+
+
+class CatalogModel:
+    """One entry of a server's catalog, the fields we use and nothing else."""
+    __slots__ = ("id", "owned_by", "max_model_len", "meta")
+
+    def __init__(self, id, owned_by=None, max_model_len=None, meta=None):
+        self.id = id
+        self.owned_by = owned_by
+        self.max_model_len = max_model_len
+        self.meta = meta
+
+    def __repr__(self):
+        return f"CatalogModel({self.id!r})"
+
+
+def catalog_model(entry):
+    """Build a CatalogModel from an entry of a catalog's `data` list, None for entries that aren't models."""
+    if not isinstance(entry, dict) or not isinstance(entry.get("id"), str):
+        return None
+    ## vLLM tells us max_model_len, llama.cpp a meta dict with n_ctx_train and friends
+    meta = entry.get("meta")
+    return CatalogModel(entry["id"], entry.get("owned_by"), entry.get("max_model_len"), meta if isinstance(meta, dict) else None)
+
+
+def parse_quantization(model_id):
+    """The quantization of a model id, the GGUF type in it if there is one, else the part before its extension."""
+    found = QUANTIZATION_PATTERN.search(model_id)
+    if found:
+        return found.group(1).upper().replace("FP", "F")
+    parts = model_id.split(".")
+    return parts[-2] if len(parts) > 1 else ""
+
+
+def quant_family(quantization):
+    """The GGUF family of a quantization: "IQ", "K", "legacy" or "float", "" if it isn't a GGUF one."""
+    if quantization in ("F16", "BF16", "F32"):
+        return "float"
+    if quantization.startswith("IQ"):
+        return "IQ"
+    if quantization not in QUANT_BITS and not QUANTIZATION_PATTERN.fullmatch(quantization):
+        return ""
+    return "K" if "_K" in quantization else "legacy"
+
+
+def quant_bits(quantization):
+    """Roughly the bits per weight of a quantization, None if we can't tell."""
+    if quantization in QUANT_BITS:
+        return QUANT_BITS[quantization]
+    found = re.match(r"I?Q(\d)_", quantization)
+    return float(found.group(1)) if found else None
+
+
+def parameter_count(model_id, meta=None):
+    """The number of parameters of a model, from llama.cpp's meta or else its id. None if neither says."""
+    if meta and isinstance(meta.get("n_params"), int):
+        return meta["n_params"]
+    found = PARAMETERS_PATTERN.search(model_id.split("/")[-1])
+    if not found:
+        return None
+    experts, size, unit = found.groups()
+    return int(float(size) * (1e9 if unit in "bB" else 1e6) * int(experts or 1))
+
+
+def capabilities(entry, labels=None):
+    """
+    What a model can do, from its catalog entry and the labels its server was registered with.
+
+    Returns:
+        dict: Any of quant_family, quant_bits, parameters, context_length, streaming, batching and cost,
+            the ones we can't tell are left out. cost is the `cost` label if there is one, else the size
+            of the weights in GB.
+    """
+    labels = labels or {}
+    quantization = parse_quantization(entry.id)
+    meta = entry.meta or {}
+    found = dict(SERVER_CAPABILITIES.get(entry.owned_by, {}))
+    found.update({
+        "quant_family": quant_family(quantization) or None,
+        "quant_bits": quant_bits(quantization),
+        "parameters": parameter_count(entry.id, meta),
+        "context_length": labels.get("context_length") or entry.max_model_len or meta.get("n_ctx_train"),
+    })
+    for capability in ("streaming", "batching"):
+        if capability in labels:
+            found[capability] = bool(labels[capability])
+    if "cost" in labels:
+        found["cost"] = labels["cost"]
+    elif found["parameters"] and found["quant_bits"]:
+        found["cost"] = round(found["parameters"] * found["quant_bits"] / 8e9, 3)
+    return {key: value for key, value in found.items() if value is not None}
+
+
+class CatalogParser:
+    """
+    Parses a /models response as it arrives, without ever holding the whole document.
+
+    The `data` list is turned into CatalogModels one entry at a time, every other top level
+    field, e.g. `has_more` and `last_id` of a paginated catalog, ends up in `fields`.
+    Feed it the body in chunks and call `close` at the end, it raises ValueError for anything
+    that isn't a JSON object.
+    """
+
+    def __init__(self):
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.state = "start"
+        self.key = None
+        self.fields = {}
+        self.models = []
+
+    def feed(self, chunk, final=False):
+        self.buffer += self.text.decode(chunk, final)
+        position = self.parse(0, final)
+        self.buffer = self.buffer[position:]
+
+    def close(self):
+        self.feed(b"", final=True)
+        if self.state != "done":
+            raise ValueError("the catalog ended early")
+        return self
+
+    def value(self, position, final):
+        """Decode the JSON value at `position`, returns (value, end) or None if it isn't all there yet."""
+        try:
+            value, end = decoder.raw_decode(self.buffer, position)
+        except json.JSONDecodeError:
+            if final:
+                raise ValueError(f"damaged catalog at {position}")
+            return None
+        ## a number at the end of what we have may still go on in the next chunk
+        if not final and WHITESPACE.match(self.buffer, end).end() == len(self.buffer):
+            return None
+        return value, end
+
+    def entries(self, position):
+        """
+        Decode every complete entry of the `data` list from `position` on in one go, returns where they end or None.
+
+        Entries are objects, so the list can only end at a '}'. Cutting it at one that is inside a
+        string or a nested object leaves invalid JSON, so we try the last few and keep the first that decodes.
+        """
+        limit = len(self.buffer)
+        for _ in range(3):
+            cut = self.buffer.rfind("}", position, limit)
+            if cut < 0:
+                return None
+            try:
+                entries = json.loads("[" + self.buffer[position:cut + 1] + "]")
+            except ValueError:
+                limit = cut
+                continue
+            ## catalog_model inlined, this loop is most of the time spent on a big catalog
+            append = self.models.append
+            for entry in entries:
+                if type(entry) is dict:
+                    model_id = entry.get("id")
+                    if type(model_id) is str:
+                        meta = entry.get("meta")
+                        append(CatalogModel(model_id, entry.get("owned_by"), entry.get("max_model_len"),
+                                            meta if type(meta) is dict else None))
+            return cut + 1
+        return None
+
+    def parse(self, position, final):
+        buffer = self.buffer
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position == len(buffer) or self.state == "done":
+                return position
+            char = buffer[position]
+            if self.state == "start":
+                if char != "{":
+                    raise ValueError("the catalog isn't a JSON object")
+                self.state = "key"
+                position += 1
+            elif self.state == "key":
+                if char == "}":
+                    self.state = "done"
+                    return position + 1
+                if char == ",":
+                    position += 1
+                    continue
+                decoded = self.value(position, final)
+                if decoded is None:
+                    return position
+                self.key, position = decoded
+                self.state = "colon"
+            elif self.state == "colon":
+                if char != ":":
+                    raise ValueError(f"damaged catalog at {position}")
+                self.state = "value"
+                position += 1
+            elif self.state == "value":
+                if self.key == "data" and char == "[":
+                    self.state = "data"
+                    position += 1
+                    continue
+                decoded = self.value(position, final)
+                if decoded is None:
+                    return position
+                self.fields[self.key], position = decoded
+                self.state = "key"
+            elif self.state == "data":
+                if char == "]":
+                    self.state = "key"
+                    position += 1
+                    continue
+                if char == ",":
+                    position += 1
+                    continue
+                end = self.entries(position)
+                if end is not None:
+                    position = end
+                    continue
+                decoded = self.value(position, final)
+                if decoded is None:
+                    return position
+                entry, position = decoded
+                model = catalog_model(entry)
+                if model is not None:
+                    self.models.append(model)
+
+
+class CatalogPage:
+    """What we know about one page of a server's catalog, to tell whether it changed since."""
+    __slots__ = ("etag", "digest", "models", "after")
+
+    def __init__(self, etag, digest, models, after):
+        self.etag = etag
+        self.digest = digest
+        self.models = models
+        ## the cursor of the next page, None on the last one
+        self.after = after
+
+
+def next_cursor(fields, models):
+    """The `after` cursor of the next page, following OpenAI's list pagination with has_more and last_id."""
+    if not fields.get("has_more"):
+        return None
+    last_id = fields.get("last_id") or (models[-1].id if models else None)
+    return last_id if isinstance(last_id, str) else None
+
+
+def page_params(after=None, page_size=CATALOG_PAGE_SIZE):
+    params = {}
+    if after is not None:
+        params["after"] = after
+    if page_size:
+        params["limit"] = page_size
+    return params
@@ -0,0 +1,315 @@
+## an indexed registry of the models our inference servers are serving
+import bisect
+import functools
+import os
+import re
+from model_catalog import capabilities, parse_quantization
+from query_planner import matches_where, predicates, RANGE_FIELDS, RANGE_OPERATORS
+
+REGEX_CACHE_SIZE = int(os.getenv("REGEX_CACHE_SIZE", "256"))
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_pattern(pattern):
+    """Compile a client supplied pattern, each distinct pattern is only compiled once."""
+    return re.compile(pattern)
+
+
+def field_matches(value, expected, use_regex):
+    """Check one model field against the query, an empty expectation matches anything."""
+    if not expected:
+        return True
+    if use_regex:
+        try:
+            return compile_pattern(expected).match(value) is not None
+        except re.error:
+            return False
+    return value == expected
+
+
+def matches_query(query, model):
+    """
+    Check whether a model satisfies a query config.
+
+    Args:
+        query (dict): The query config, e.g. {"name": "", "quantization": "", "use_regex_model_name": False, "use_regex_quantization": False},
+            optionally with the predicates of `query_planner.model_query` in "where".
+        model (dict): The model record, with at least "name" and "quantization".
+    """
+    return field_matches(model["name"], query.get("name"), query.get("use_regex_model_name")) and \
+        field_matches(model["quantization"], query.get("quantization"), query.get("use_regex_quantization")) and \
+        matches_where(query, model)
+
+
+def model_record(entry, server_url, labels=None):
+    """
+    Build our model record from one entry of a server's /models catalog.
+
+    Besides its name and quantization the record has whatever `model_catalog.capabilities` can tell
+    about the model, and the labels its server was registered with.
+
+    Args:
+        entry (CatalogModel): An entry of the catalog, e.g. CatalogModel("org/model.Q4_K_M.gguf")
+        server_url (str): The base url of the server that serves it.
+        labels (dict): The labels of the server, see `server_registration.server_descriptor`.
+    """
+    model_id = entry.id
+    record = {
+        "name": model_id,
+        "quantization": parse_quantization(model_id),
+        "url": server_url,
+        "filename": model_id.split("/")[-1]
+    }
+    record.update(capabilities(entry, labels))
+    if labels:
+        record["labels"] = labels
+    return record
+
+
+def model_key(model):
+    """The same model name served by two servers is two different entries."""
+    return (model["url"], model["name"])
+
+
+class ModelRegistry:
+    """
+    Holds model records with hash indexes by name, by quantization, by (name, quantization) and
+    by quant family, and sorted indexes of the numeric capabilities in `RANGE_FIELDS`.
+
+    Exact lookups are dictionary hits and ranges a bisect, a query is answered from whichever
+    of its indexes has the fewest candidates. Regex lookups only run the (cached) pattern
+    once per distinct name or quantization rather than once per model.
+
+    It also keeps the last snapshot of every server's catalog, so a health check only
+    has to announce what changed. `revision` goes up by one for every change.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.by_name = {}
+        self.by_quantization = {}
+        self.by_name_quantization = {}
+        self.by_family = {}
+        ## field: (sorted values, the key of the model each value belongs to)
+        self.ranges = {field: ([], []) for field in RANGE_FIELDS}
+        self.snapshots = {}
+        self.revision = 0
+        ## servers restored from disk that haven't been health checked since
+        self.stale = set()
+
+    def __len__(self):
+        return len(self.models)
+
+    def __iter__(self):
+        return iter(list(self.models.values()))
+
+    def __contains__(self, model):
+        return model_key(model) in self.models
+
+    def all(self):
+        return list(self.models.values())
+
+    def add(self, model):
+        """Add a model, replacing any previous record for the same server and name."""
+        key = model_key(model)
+        if key in self.models:
+            self.remove(model)
+        self.models[key] = model
+        self.by_name.setdefault(model["name"], {})[key] = model
+        self.by_quantization.setdefault(model["quantization"], {})[key] = model
+        self.by_name_quantization.setdefault((model["name"], model["quantization"]), {})[key] = model
+        self.by_family.setdefault(model.get("quant_family"), {})[key] = model
+        for field, (values, keys) in self.ranges.items():
+            value = model.get(field)
+            if isinstance(value, (int, float)):
+                position = bisect.bisect_right(values, value)
+                values.insert(position, value)
+                keys.insert(position, key)
+
+    def remove(self, model):
+        """Remove a model, returns the stored record or None if we didn't have it."""
+        key = model_key(model)
+        stored = self.models.pop(key, None)
+        if stored is None:
+            return None
+        for index, index_key in (
+            (self.by_name, stored["name"]),
+            (self.by_quantization, stored["quantization"]),
+            (self.by_name_quantization, (stored["name"], stored["quantization"])),
+            (self.by_family, stored.get("quant_family")),
+        ):
+            bucket = index[index_key]
+            del bucket[key]
+            if not bucket:
+                del index[index_key]
+        for field, (values, keys) in self.ranges.items():
+            value = stored.get(field)
+            if isinstance(value, (int, float)):
+                start = bisect.bisect_left(values, value)
+                position = keys.index(key, start, bisect.bisect_right(values, value))
+                del values[position]
+                del keys[position]
+        return stored
+
+    def clear(self):
+        self.models.clear()
+        self.by_name.clear()
+        self.by_quantization.clear()
+        self.by_name_quantization.clear()
+        self.by_family.clear()
+        for values, keys in self.ranges.values():
+            values.clear()
+            keys.clear()
+        self.snapshots.clear()
+
+    def update_server(self, server_url, models):
+        """
+        Replace the snapshot of a server's models and work out what changed.
+
+        Args:
+            server_url (str): The base url of the server.
+            models (list): Every model record the server serves right now.
+
+        Returns:
+            tuple: (added, removed) model lists, a model whose record changed counts as added.
+        """
+        snapshot = self.snapshots.get(server_url)
+        previous = snapshot["models"] if snapshot else {}
+        current = {model["name"]: model for model in models}
+        ## once a stale server checks out, all of its models get announced again as verified
+        if server_url in self.stale:
+            self.stale.discard(server_url)
+            added = list(current.values())
+        else:
+            added = [model for name, model in current.items() if previous.get(name) != model]
+        removed = [model for name, model in previous.items() if name not in current]
+        if snapshot and not added and not removed:
+            return [], []
+        if added or removed:
+            self.revision += 1
+        for model in removed:
+            self.remove(model)
+        for model in added:
+            self.add(model)
+        self.snapshots[server_url] = {"version": self.revision, "models": current}
+        return added, removed
+
+    def restore_server(self, server_url, models, version):
+        """Put back a server's snapshot as it was saved, flagged stale until `update_server` sees it again."""
+        for model in models:
+            self.add(model)
+        self.snapshots[server_url] = {"version": version, "models": {model["name"]: model for model in models}}
+        self.stale.add(server_url)
+
+    def remove_server(self, server_url):
+        """Forget a server's snapshot, returns the models it was serving."""
+        snapshot = self.snapshots.pop(server_url, None)
+        self.stale.discard(server_url)
+        if not snapshot or not snapshot["models"]:
+            return []
+        self.revision += 1
+        removed = list(snapshot["models"].values())
+        for model in removed:
+            self.remove(model)
+        return removed
+
+    def match(self, query):
+        """
+        Find every model that satisfies a query config.
+
+        Args:
+            query (dict): The query config, see `matches_query`.
+
+        Returns:
+            list: The matching models, grouped by the index bucket they were found in.
+        """
+        if not query.get("where"):
+            return self.match_fields(query)
+        candidates = self.plan(query)
+        if candidates is None:
+            return [model for model in self.match_fields(query) if matches_where(query, model)]
+        return [model for model in candidates if matches_query(query, model)]
+
+    def plan(self, query):
+        """
+        Pick the index lookup with the fewest candidates for a query, None if none of its fields are indexed.
+
+        Returns:
+            list: The candidates, they still have to be checked against the whole query.
+        """
+        name, quantization = query.get("name"), query.get("quantization")
+        exact_name = name and not query.get("use_regex_model_name")
+        exact_quantization = quantization and not query.get("use_regex_quantization")
+        ## (number of candidates, how to get them)
+        options = []
+        if exact_name and exact_quantization:
+            bucket = self.by_name_quantization.get((name, quantization), {})
+            options.append((len(bucket), bucket.values))
+        elif exact_name:
+            bucket = self.by_name.get(name, {})
+            options.append((len(bucket), bucket.values))
+        elif exact_quantization:
+            bucket = self.by_quantization.get(quantization, {})
+            options.append((len(bucket), bucket.values))
+        ## every range on the same field narrows down one slice of its sorted index
+        bounds = {}
+        for field, op, value in predicates(query):
+            if field == "quant_family" and op == "==":
+                bucket = self.by_family.get(value, {})
+                options.append((len(bucket), bucket.values))
+            elif field in self.ranges and op in RANGE_OPERATORS and isinstance(value, (int, float)):
+                values = self.ranges[field][0]
+                start, end = bounds.get(field, (0, len(values)))
+                if op in ("==", ">="):
+                    start = max(start, bisect.bisect_left(values, value))
+                elif op == ">":
+                    start = max(start, bisect.bisect_right(values, value))
+                if op in ("==", "<="):
+                    end = min(end, bisect.bisect_right(values, value))
+                elif op == "<":
+                    end = min(end, bisect.bisect_left(values, value))
+                bounds[field] = (start, end)
+        for field, (start, end) in bounds.items():
+            keys = self.ranges[field][1]
+            options.append((max(end - start, 0), lambda keys=keys, start=start, end=end: [self.models[key] for key in keys[start:end]]))
+        if not options:
+            return None
+        return list(min(options, key=lambda option: option[0])[1]())
+
+    def match_fields(self, query):
+        """Find every model whose name and quantization satisfy a query config."""
+        name = query.get("name")
+        quantization = query.get("quantization")
+        regex_name = query.get("use_regex_model_name")
+        regex_quantization = query.get("use_regex_quantization")
+
+        if name and not regex_name:
+            if quantization and not regex_quantization:
+                return list(self.by_name_quantization.get((name, quantization), {}).values())
+            candidates = self.by_name.get(name, {}).values()
+            return [model for model in candidates if field_matches(model["quantization"], quantization, regex_quantization)]
+
+        if quantization and not regex_quantization:
+            candidates = self.by_quantization.get(quantization, {}).values()
+            return [model for model in candidates if field_matches(model["name"], name, regex_name)]
+
+        ## no exact field to look up, so run the pattern over the distinct keys of an index instead of every model
+        matches = []
+        if name:
+            for model_name, bucket in self.by_name.items():
+                if field_matches(model_name, name, True):
+                    matches.extend(model for model in bucket.values() if field_matches(model["quantization"], quantization, regex_quantization))
+        elif quantization:
+            for model_quantization, bucket in self.by_quantization.items():
+                if field_matches(model_quantization, quantization, True):
+                    matches.extend(bucket.values())
+        else:
+            matches.extend(self.models.values())
+        return matches
+
+    def select(self, query):
+        """Return a single model that satisfies the query, or None."""
+        matches = self.match(query)
+        if not matches:
+            return None
+        return matches[0]
@@ -0,0 +1,115 @@
+## a small query language over model records: predicates on their capabilities, ranges and ordering
+import operator
+from load_balancing import load_score
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, expected: value in expected,
+}
+## the numeric fields the registry keeps sorted indexes of, so a range is a bisect instead of a scan
+RANGE_FIELDS = ("context_length", "parameters", "quant_bits", "cost")
+RANGE_OPERATORS = ("==", "<", "<=", ">", ">=")
+
+
+def model_query(name="", quantization="", regex=False, where=None, order_by=None, limit=None, **criteria):
+    """
+    Build a query config with capability predicates.
+
+    Every keyword criterion is a predicate on the model field of the same name: a tuple is an inclusive
+    (low, high) range with None for an open end, a list or set is "one of these", anything else has to be equal.
+
+        model_query("llama.*", regex=True, context_length=(32768, None), quant_family=["K", "IQ"],
+                    streaming=True, order_by=["latency", "-quality"], limit=3)
+
+    Args:
+        where (list): More predicates as [field, operator, value], with the operators of `OPERATORS`.
+        order_by (list): Best first by "cost", "latency" (the backend's load score), "quality" (the
+            quantization's bits per weight, highest first) or any numeric field, a leading "-" reverses one.
+        limit (int): Only the first this many models, after ordering.
+    """
+    predicates = [list(predicate) for predicate in where or []]
+    for field, expected in criteria.items():
+        if isinstance(expected, tuple):
+            low, high = expected
+            if low is not None:
+                predicates.append([field, ">=", low])
+            if high is not None:
+                predicates.append([field, "<=", high])
+        elif isinstance(expected, (list, set, frozenset)):
+            predicates.append([field, "in", sorted(expected)])
+        else:
+            predicates.append([field, "==", expected])
+    for predicate in predicates:
+        if len(predicate) != 3 or predicate[1] not in OPERATORS:
+            raise ValueError(f"Not a predicate: {predicate}, expected [field, operator, value] with one of {', '.join(OPERATORS)}")
+    query = {"name": name, "quantization": quantization, "use_regex_model_name": regex, "use_regex_quantization": regex}
+    if predicates:
+        query["where"] = predicates
+    if order_by:
+        query["order_by"] = [order_by] if isinstance(order_by, str) else list(order_by)
+    if limit is not None:
+        query["limit"] = limit
+    return query
+
+
+def predicates(query):
+    """The well formed predicates of a query as (field, operator, value), anything else it came with is skipped."""
+    return [tuple(predicate) for predicate in query.get("where") or ()
+            if isinstance(predicate, (list, tuple)) and len(predicate) == 3 and predicate[1] in OPERATORS]
+
+
+def predicate_matches(model, field, op, expected):
+    """A model without the field doesn't match, whatever the predicate."""
+    value = model.get(field)
+    if value is None:
+        return False
+    try:
+        return OPERATORS[op](value, expected)
+    except TypeError:
+        return False
+
+
+def matches_where(query, model):
+    where = query.get("where")
+    if not where:
+        return True
+    return all(predicate_matches(model, field, op, expected) for field, op, expected in predicates(query))
+
+
+def order_key(order, loads):
+    """A sort key function for one entry of order_by, models missing the field go last."""
+    descending = order.startswith("-")
+    field = order.lstrip("-")
+    ## the best quality first, "-quality" is the smallest quantization first
+    if field == "quality":
+        field, descending = "quant_bits", not descending
+
+    def key(model):
+        value = load_score(loads.get(model["url"])) if field == "latency" else model.get(field)
+        if not isinstance(value, (int, float)):
+            return (1, 0)
+        return (0, -value if descending else value)
+    return key
+
+
+def order_models(models, query, loads=None, demoted=()):
+    """
+    Order and limit models the way a query asks for, best first. Without order_by they keep their order.
+
+    Args:
+        loads (dict): The load of each backend by url, for ordering by latency.
+        demoted (set): Urls of backends whose models go after all the others, whatever the order.
+    """
+    order_by = query.get("order_by")
+    if order_by or demoted:
+        keys = [order_key(order, loads or {}) for order in order_by or () if isinstance(order, str)]
+        models = sorted(models, key=lambda model: (model["url"] in demoted,) + tuple(key(model) for key in keys))
+    limit = query.get("limit")
+    if isinstance(limit, int) and limit >= 0:
+        models = models[:limit]
+    return models
@@ -0,0 +1,149 @@
+## keeps the discovery service's registry on disk, so a restart can answer requests straight away
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+## where the registry is kept, e.g. /var/lib/discovery/registry_snapshot.json. Persistence is opt-in,
+## empty by default keeps it in memory only, so a run doesn't pick up what an unrelated one left in its working directory
+REGISTRY_SNAPSHOT_PATH = os.getenv("REGISTRY_SNAPSHOT_PATH", "")
+## how many journal entries we append before folding them into a new snapshot
+REGISTRY_COMPACT_EVERY = int(os.getenv("REGISTRY_COMPACT_EVERY", "1000"))
+SNAPSHOT_FORMAT = 1
+
+
+def empty_state():
+    return {"format": SNAPSHOT_FORMAT, "revision": 0, "servers": [], "descriptors": {}, "snapshots": {}, "last_seen": {}}
+
+
+def apply_entry(state, entry):
+    """Replay one journal entry onto a state, entries only ever set things so replaying twice is harmless."""
+    op = entry.get("op")
+    url = entry.get("url")
+    if op == "add_server":
+        if url not in state["servers"]:
+            state["servers"].append(url)
+        if entry.get("descriptor"):
+            state["descriptors"][url] = entry["descriptor"]
+    elif op == "remove_server":
+        if url in state["servers"]:
+            state["servers"].remove(url)
+        state["snapshots"].pop(url, None)
+        state["last_seen"].pop(url, None)
+        state["descriptors"].pop(url, None)
+    elif op == "update_server":
+        state["snapshots"][url] = {"version": entry["version"], "models": entry["models"]}
+        if entry.get("last_seen"):
+            state["last_seen"][url] = entry["last_seen"]
+    elif op == "drop_models":
+        state["snapshots"].pop(url, None)
+    state["revision"] = max(state["revision"], entry.get("revision", 0))
+
+
+class RegistryStore:
+    """
+    A snapshot file plus an append-only journal of the changes made since it was written.
+
+    Every change is one short JSON line appended to `<path>.journal`. Every `compact_every`
+    entries the whole state is written to a temporary file and renamed over the snapshot,
+    which is atomic, and the journal starts over.
+    """
+
+    def __init__(self, path=REGISTRY_SNAPSHOT_PATH, compact_every=REGISTRY_COMPACT_EVERY):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.compact_every = compact_every
+        self.journal = None
+        self.entries = 0
+        ## entries journaled while a snapshot is being written, they go into the next journal
+        self.compacting = None
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal on top of it.
+
+        Returns:
+            dict: {"revision", "servers", "descriptors": {url: descriptor}, "snapshots": {url: {"version", "models"}},
+                "last_seen": {url: timestamp}}
+        """
+        state = empty_state()
+        try:
+            with open(self.path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if snapshot.get("format") == SNAPSHOT_FORMAT:
+                state.update(snapshot)
+            else:
+                logger.warning("Ignoring registry snapshot %s with unknown format %s", self.path, snapshot.get("format"))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read registry snapshot %s: %s", self.path, e)
+        try:
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        apply_entry(state, json.loads(line))
+                    except ValueError:
+                        ## a crash can leave half a line at the end of the journal
+                        logger.warning("Skipping a damaged entry in %s", self.journal_path)
+                    self.entries += 1
+        except FileNotFoundError:
+            pass
+        return state
+
+    def append(self, entry):
+        """
+        Journal one change.
+
+        Returns:
+            bool: True when enough has been journaled that it's time to `compact`.
+        """
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+            ## don't glue the entry onto half a line left by a crash
+            if self.journal.tell() > 0:
+                with open(self.journal_path, "rb") as journal_file:
+                    journal_file.seek(-1, os.SEEK_END)
+                    if journal_file.read(1) != b"\n":
+                        self.journal.write("\n")
+        self.journal.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.journal.flush()
+        self.entries += 1
+        if self.compacting is not None:
+            self.compacting.append(entry)
+            return False
+        return self.entries >= self.compact_every
+
+    def write_snapshot(self, state):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as snapshot_file:
+            json.dump(state, snapshot_file, separators=(",", ":"))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.path)
+
+    async def compact(self, state):
+        """Write `state` as the new snapshot and start a new journal."""
+        state = dict(state, format=SNAPSHOT_FORMAT)
+        self.compacting = []
+        try:
+            ## the snapshot can be big, write it off the event loop
+            await asyncio.to_thread(self.write_snapshot, state)
+        finally:
+            pending, self.compacting = self.compacting, None
+        ## the new journal only holds what changed while the snapshot was being written
+        if self.journal is not None:
+            self.journal.close()
+        temporary_path = f"{self.journal_path}.tmp"
+        with open(temporary_path, "w") as journal_file:
+            journal_file.writelines(json.dumps(entry, separators=(",", ":")) + "\n" for entry in pending)
+        os.replace(temporary_path, self.journal_path)
+        self.journal = open(self.journal_path, "a")
+        self.entries = len(pending)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
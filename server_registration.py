@@ -0,0 +1,133 @@
+## registering inference servers with the discovery services, one at a time or a whole rack at once
+import json
+import logging
+import os
+from nats.errors import TimeoutError as NATSTimeoutError
+from wire_format import chunk_encoded, DEFAULT_MAX_PAYLOAD, HEADERS_ALLOWANCE
+
+logger = logging.getLogger(__name__)
+
+## how long register_servers() and deregister_servers() wait for a discovery service to answer, in seconds
+REGISTRATION_TIMEOUT = float(os.getenv("REGISTRATION_TIMEOUT", "10"))
+
+
+def server_descriptor(url, labels=None, models=None):
+    """
+    Describe a server to register.
+
+    Args:
+        url (str): The base url of its OpenAI compatible API, e.g. "http://10.0.0.5:8080/v1"
+        labels (dict): Anything to tag its models with, e.g. {"rack": "r12", "gpu": "a100"}
+        models (list): The model ids it's expected to serve, reported back when they're missing.
+    """
+    return {"url": url, "labels": dict(labels or {}), "models": list(models or [])}
+
+
+def parse_descriptors(data):
+    """
+    Read the servers of a registration message: a JSON list of urls or descriptors, or a single one of them.
+
+    Returns:
+        list: The descriptors, with anything that isn't one skipped.
+    """
+    try:
+        servers = json.loads(data)
+    except ValueError:
+        ## a plain url, the way inference.new_server has always taken them
+        servers = data.decode() if isinstance(data, bytes) else data
+    if not isinstance(servers, list):
+        servers = [servers]
+    descriptors = []
+    for server in servers:
+        if isinstance(server, str) and server:
+            descriptors.append(server_descriptor(server))
+        elif isinstance(server, dict) and isinstance(server.get("url"), str) and server["url"]:
+            descriptors.append(server_descriptor(server["url"], server.get("labels"), server.get("models")))
+        else:
+            logger.warning("Skipping a server that isn't a url or descriptor: %r", server)
+    return descriptors
+
+
+class ServerList:
+    """
+    The registered servers in the order they were added, with their descriptors.
+
+    Works like the list it replaces, but membership tests are a dict lookup and adding
+    a server that is already there does nothing.
+    """
+
+    def __init__(self, urls=()):
+        self.servers = {}
+        self.extend(urls)
+
+    def __contains__(self, url):
+        return url in self.servers
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def append(self, url, descriptor=None):
+        """Add a server, returns False if it was already there, in which case it keeps its old descriptor."""
+        if url in self.servers:
+            return False
+        self.servers[url] = descriptor or server_descriptor(url)
+        return True
+
+    def extend(self, urls):
+        for url in urls:
+            self.append(url)
+
+    def remove(self, url):
+        del self.servers[url]
+
+    def descriptor(self, url):
+        return self.servers.get(url)
+
+    def labels(self, url):
+        descriptor = self.servers.get(url)
+        return descriptor["labels"] if descriptor else {}
+
+
+async def request_in_batches(nats_client, subject, items, timeout):
+    """Send a list in as few requests as fit the server's max_payload, returns the replies."""
+    max_payload = getattr(nats_client, "max_payload", None) or DEFAULT_MAX_PAYLOAD
+    replies = []
+    for frame in chunk_encoded([json.dumps(item).encode() for item in items], b"[", b"]", max_payload - HEADERS_ALLOWANCE):
+        try:
+            reply = await nats_client.request(subject, frame, timeout=timeout)
+        except NATSTimeoutError:
+            logger.warning("No discovery service answered on %s within %.1fs", subject, timeout)
+            continue
+        replies.append(json.loads(reply.data))
+    return replies
+
+
+async def register_servers(nats_client, servers, timeout=REGISTRATION_TIMEOUT):
+    """
+    Register a batch of servers with the discovery services in one message.
+
+    Every discovery service checks the new ones concurrently and announces their models together.
+
+    Args:
+        nats_client: A connected NATS client.
+        servers (list): Urls or `server_descriptor`s.
+
+    Returns:
+        list: The answer of the first discovery service for every batch it was sent in,
+            {"node", "registered", "known", "healthy", "missing_models": {url: [model ids]}}
+    """
+    descriptors = [server_descriptor(server) if isinstance(server, str) else server for server in servers]
+    return await request_in_batches(nats_client, "inference.register", descriptors, timeout)
+
+
+async def deregister_servers(nats_client, urls, timeout=REGISTRATION_TIMEOUT):
+    """
+    Deregister a batch of servers in one message, e.g. before a rolling deploy takes them down.
+
+    Returns:
+        list: The answer of the first discovery service for every batch, {"node", "deregistered", "unknown"}
+    """
+    return await request_in_batches(nats_client, "inference.deregister", list(urls), timeout)
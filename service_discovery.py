@@ -1,178 +1,294 @@
+## the settings in .env go into the environment before the modules below read theirs,
+## imported as a library it leaves the environment alone
+if __name__ == '__main__':
+    import dotenv
+    dotenv.load_dotenv()
+
 import asyncio
 from nats.aio.client import Client as NATS
 from nats.aio.errors import ErrConnectionClosed, ErrTimeout, ErrNoServers
-import json
-import re
+import logging
 import signal
-import sys
-import dotenv
-import requests 
+import uuid
 import os
-dotenv.load_dotenv()
+from health_check import HealthChecker
+from health_scheduler import HealthScheduler
+from model_registry import ModelRegistry, model_record
+from query_planner import order_models
+from circuit_breaker import CircuitBreakers, CLOSED, OPEN, BREAKER_WINDOW
+from telemetry import decode_telemetry, TELEMETRY_SUBJECT
+from subjects import by_subject, AVAILABLE_SUBJECT, UNAVAILABLE_SUBJECT, WITHDRAWN_SUBJECT, SUBJECT_MIRROR
+from load_balancing import LoadTracker, PowerOfTwoChoices
+from wire_format import (BATCH_ANNOUNCEMENTS, encode_available, encode_unavailable, encode_load_report, encode_reply, decode_request,
+                         reply_encoding, with_encoding, WIRE_FORMAT)
+from metrics import CIRCUIT_TRANSITIONS, HEALTH_PROBE_SECONDS, REQUEST_HANDLER_SECONDS, MESSAGES_PUBLISHED, REGISTRY_MODELS, subject_label, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+## how often the load of every backend is published on inference.load, in seconds
+LOAD_REPORT_INTERVAL = float(os.getenv("LOAD_REPORT_INTERVAL", "30"))
+## how long the handlers still running on shutdown get to finish, in seconds
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "5"))
 
 our_servers = [
     "https://916f-97-115-139-28.ngrok-free.app/v1"
 ]
 
-our_models = []
+our_models = ModelRegistry()
+REGISTRY_MODELS.set_function(lambda: len(our_models))
 
 async def run_nats_client():
     # Establish a connection to the NATS server
     nats_client = NATS()
     nats_client_url = os.getenv("NATS_SERVER_URL", "nats://0.0.0.0:4222")
-    print(f"Connecting to NATS server at {nats_client_url}")
-    await nats_client.connect(nats_client_url)
+    logger.info("Connecting to NATS server at %s", nats_client_url)
+    ## on shutdown drain() waits this long for the handlers of the messages we already have
+    await nats_client.connect(nats_client_url, drain_timeout=SHUTDOWN_TIMEOUT)
+    await start_metrics_server()
+    
+    loop = asyncio.get_running_loop()
+    ## one pooled http client for all health checks, so connections are reused between checks
+    health_checker = HealthChecker()
+    ## when each server is due for its next check, and the checks in flight
+    scheduler = HealthScheduler()
+    checks = set()
+    ## set on SIGINT or SIGTERM, from then on the clients are left to the other discovery nodes
+    stopping = asyncio.Event()
+    ## identifies this discovery node in replies, so clients can tell the nodes apart
+    node_id = uuid.uuid4().hex
+    ## probe latency, error rate and queue depth of every backend, sent along with the models they serve
+    load_tracker = LoadTracker()
+    balancer = PowerOfTwoChoices()
+    ## how the requests clients send to each backend are going
+    breakers = CircuitBreakers()
+
+    async def publish(subject, payload, headers=None):
+        """Publish a message and count it per subject."""
+        MESSAGES_PUBLISHED.inc(subject=subject_label(subject))
+        await nats_client.publish(subject, payload, headers=headers)
+
+    def with_load(models, demoted=()):
+        """Copy the models with the current load of their backend attached, and flagged if its circuit is half open."""
+        annotated = []
+        for model in models:
+            model = dict(model, load=load_tracker.load(model["url"]))
+            if model["url"] in demoted:
+                model["half_open"] = True
+            annotated.append(model)
+        return annotated
 
     async def announce_service():
         """Announce service availability and capabilities."""
-        # Convert dict to JSON string if using json for message payload
-        for model in our_models:
-            await nats_client.publish("inference.available", json.dumps({
-                "selected_model": model
-                }).encode())
-        print("announced service availability for models: ", our_models)
+        await announce_available(our_models.all())
+        logger.info("announced service availability for %d models", len(our_models))
         
-    async def announce_service_unavailability(model):
-        """Announce that the service is no longer available."""
-        # Implement service unavailability announcement
-        if not model:
-            await nats_client.publish("inference.unavailable", json.dumps(our_models).encode())
-        else:
-            await nats_client.publish("inference.unavailable", json.dumps([model]).encode())
-        print("announced service unavailability for models: ", our_models)
+    async def announce_available(models):
+        """Announce models on the subjects of their family and quantization, see `subjects.by_subject`."""
+        headers = with_encoding(WIRE_FORMAT, {"Node": node_id})
+        for subject, group in by_subject(AVAILABLE_SUBJECT, with_load(models)).items():
+            ## only clients that read batched frames subscribe to the per-family subjects, so those always get one
+            ## frame for the lot. The flat mirror is for older clients and batched only if the fleet is ready for it
+            batch = BATCH_ANNOUNCEMENTS if subject == AVAILABLE_SUBJECT else True
+            for frame in encode_available(group, our_models.revision, nats_client.max_payload, batch=batch):
+                await publish(subject, frame, headers=headers)
+
+    async def announce_changes(added, removed):
+        """Announce the models that were added or removed since the last health check."""
+        ## we've withdrawn already, whatever changes now is for the other nodes to tell
+        if stopping.is_set():
+            return
+        ## the revision lets clients tell which announcements are newer, the node which of them told them about a model
+        await announce_available(added)
+        ## inference.unavailable stays a plain list of models for older clients, so the revision goes in a header
+        headers = with_encoding(WIRE_FORMAT, {"Revision": str(our_models.revision), "Node": node_id})
+        for subject, group in by_subject(UNAVAILABLE_SUBJECT, removed).items():
+            for frame in encode_unavailable(group, nats_client.max_payload):
+                await publish(subject, frame, headers=headers)
+        if added or removed:
+            logger.info("announced revision %d: %d added, %d removed", our_models.revision, len(added), len(removed))
+
+    async def announce_service_unavailability():
+        """
+        Announce that this node is going away, in one message with every server we look after.
+
+        It goes on inference.withdrawn, and on inference.unavailable for older clients. There the servers
+        are models without a name, which they take as the whole server being gone. Newer clients only drop
+        what no other node told them about.
+        """
+        servers = [{"url": url} for url in our_servers]
+        subjects = [WITHDRAWN_SUBJECT, UNAVAILABLE_SUBJECT] if SUBJECT_MIRROR else [WITHDRAWN_SUBJECT]
+        for frame in encode_unavailable(servers, nats_client.max_payload):
+            for subject in subjects:
+                await publish(subject, frame, headers=with_encoding(WIRE_FORMAT, {"Node": node_id, "Withdrawn": "true"}))
+        logger.info("announced service unavailability for %d servers", len(servers))
 
     async def listen_for_requests():
         """Listen on 'inference.requested' and process inference requests."""
         async def request_handler(msg):
+            with REQUEST_HANDLER_SECONDS.time():
+                await answer_request(msg)
+
+        async def answer_request(msg):
             subject = msg.subject
-            data = json.loads(msg.data.decode())
-            print(f"Received a request on '{subject}': {data}")
+            data = decode_request(msg.data, msg.headers)
+            logger.debug("Received a request on '%s': %s", subject, data)
             requested_model = data
-            # Reply to the request, if no specific model is requested, reply with any available model
-            if data.get("name", "") == "":
-                ## no model requested, reply with any available model from our_models
-                selected_model = our_models[0]
-            else:
-                ## model requested, reply with the requested model
-                matching_models= []
-                selected_model = None
-                ## do we have this model loaded?
-                for model in our_models:
-                    ## first filter out any models that don't match the requested model name
-                    ## check if use_regex_model_name is set to True, if so match using regex, if not match using exact string match
-                    if requested_model["use_regex_model_name"]:
-                        if re.match(requested_model["name"], model["name"]):
-                            matching_models.append(model)
-                    else:
-                        if requested_model.get("name") == model["name"]:
-                            matching_models.append(model)
-                            
-                    ## check if the model has a quantization attribute with a value
-                    
-                    if requested_model.get("quantization") is None:
-                        selected_model = matching_models[0]
-                    ## if we have a match, check if the model is quantized
-                    if len(matching_models) > 0:
-                        ## get the first model that matches the requested quantization
-                        for model in matching_models:
-                            ## check if use_regex_quantization is set to True, if so match using regex, if not match using exact string match
-                            if requested_model["use_regex_quantization"]:
-                                if re.match(requested_model["quantization"], model["quantization"]):
-                                    selected_model = model
-                            else:
-                                if requested_model["quantization"] == model["quantization"]:
-                                    selected_model = model
-            if selected_model is None:
+            if stopping.is_set():
+                return
+            ## a request with a reply inbox gets every matching model back on the inbox only,
+            ## split over frames that say which node sent them and how many there are.
+            ## A node without matches answers too, with one empty frame, so the client can tell it's there
+            ## backends whose circuit is open aren't handed out, half open ones only after the rest
+            matches, demoted = breakers.screen(our_models.match(requested_model), loop.time())
+            if msg.reply:
+                matches = order_models(matches, requested_model, load_tracker.loads, demoted)
+                ## answered in binary if the request says it can read that
+                encoding = reply_encoding(msg.headers)
+                frames = encode_available(with_load(matches, demoted), our_models.revision, nats_client.max_payload, batch=True, encoding=encoding)
+                for number, frame in enumerate(frames, 1):
+                    await publish(msg.reply, frame, headers=with_encoding(encoding, {"Node": node_id, "Frame": f"{number}/{len(frames)}"}))
+                return
+            # Reply to the request with a model that matches, if no specific model is requested reply with any available model
+            ## of the replicas that match, prefer the less loaded ones
+            if not matches:
                 return 
+            matches = [model for model in matches if model["url"] not in demoted] or matches
+            ## a query that says what it likes best gets exactly that, anything else is spread over the replicas
+            if requested_model.get("order_by"):
+                selected_model = order_models(matches, requested_model, load_tracker.loads)[0]
             else:
-                reply = json.dumps({
-                    "requested_model": requested_model,
-                    "selected_model": selected_model
-                })
-                await nats_client.publish("inference.available", reply.encode())
-                print(f"Published a message on 'inference.available': {reply}")
+                selected_model = balancer.choose(matches, load_tracker.loads)
+            ## everyone subscribed to the model gets this, so it goes in the fleet-wide encoding
+            reply = encode_reply(requested_model, with_load([selected_model], demoted)[0], our_models.revision)
+            for subject in by_subject(AVAILABLE_SUBJECT, [selected_model]):
+                await publish(subject, reply, headers=with_encoding(WIRE_FORMAT, {"Node": node_id}))
+            logger.debug("Published a message on the subjects of %s: %s", selected_model["name"], reply)
 
         # Subscribe to the channel
         await nats_client.subscribe("inference.requested", cb=request_handler)
 
+    async def listen_for_telemetry():
+        """Listen for what clients report of their requests to the backends, and open or close their circuits."""
+        async def telemetry_handler(msg):
+            now = loop.time()
+            for report in decode_telemetry(msg.data):
+                url = report["url"]
+                if url not in our_servers:
+                    continue
+                transition = breakers.record(report, now)
+                if transition is None:
+                    continue
+                CIRCUIT_TRANSITIONS.inc(backend=url, state=transition)
+                snapshot = our_models.snapshots.get(url)
+                models = list(snapshot["models"].values()) if snapshot else []
+                if transition == OPEN:
+                    ## clients stop using it right away, and a check tells a dead backend from one that only fails requests.
+                    ## One that is being checked right now already has its check
+                    await announce_changes([], models)
+                    scheduler.expedite(url, now)
+                else:
+                    await announce_changes(models, [])
+
+        await nats_client.subscribe(TELEMETRY_SUBJECT, cb=telemetry_handler)
+
+    async def check_server(server_url):
+        """Health check one server, announce what changed and schedule its next check."""
+        result = await health_checker.probe(server_url)
+        ## the checker only remembers that a catalog is the same, not what's in it, so one we have no models for is fetched in full
+        if result.unchanged and (result.url not in our_models.snapshots or result.url in our_models.stale):
+            health_checker.forget(result.url)
+            result = await health_checker.probe(result.url)
+        now = loop.time()
+        scheduler.record(result, now, serving=breakers.serving(result.url, now, BREAKER_WINDOW))
+        ## a half open backend gets no requests while other replicas are around, so its health check closes or opens its circuit
+        circuit = breakers.probed(result.url, result.ok, now)
+        if circuit is not None:
+            CIRCUIT_TRANSITIONS.inc(backend=result.url, state=circuit)
+        ## and an open one is checked as soon as it goes half open
+        half_open_at = breakers.half_open_at(result.url)
+        if half_open_at is not None:
+            scheduler.expedite(result.url, half_open_at)
+        load_tracker.record_probe(result)
+        HEALTH_PROBE_SECONDS.observe(result.latency, backend=result.url, outcome="ok" if result.ok else "error")
+        ## the same catalog as last time, there's nothing to rebuild, only models to bring back if its circuit just closed
+        if result.unchanged and result.url in our_models.snapshots and result.url not in our_models.stale:
+            if circuit == CLOSED:
+                await announce_changes(list(our_models.snapshots[result.url]["models"].values()), [])
+            return
+        if result.ok:
+            logger.debug("Model health check response from %s: %s", result.url, result.models)
+            models = [model_record(model, result.url) for model in result.models]
+            added, removed = our_models.update_server(result.url, models)
+            ## its models were withdrawn when its circuit opened, so they all come back
+            if circuit == CLOSED:
+                added = models
+        ## if the model is not healthy, everything it was serving is no longer available
+        else:
+            logger.warning("Error checking model health of %s: %s", result.url, result.error)
+            added, removed = [], our_models.remove_server(result.url)
+        ## only announce what changed since the last check
+        await announce_changes(added, removed)
+
+    def check_done(task):
+        checks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Health check of a server failed", exc_info=task.exception())
+
     async def periodic_health_check():
-        """Periodically check the health of the service and re-announce if necessary."""
-        our_models.clear()
+        """Check every server whenever its schedule says it's due and announce any changes."""
+        for server_url in our_servers:
+            scheduler.add(server_url, loop.time())
+        last_load_report = loop.time()
         while True:
-            ## ping every server
-            for model in our_servers:
-                model_url = model
-                ## it's the baseurl of the model, you can check /models endpoint to see if the model is healthy
-                try:
-                    response = requests.get(f"{model_url}/models")
-                    response.raise_for_status()
-                    
-                    response_json = response.json()
-                    response_json = response_json.get("data", {})
-                    ## you can get a list of models loaded on the server from this url
-                    ## you could dynamically check add all of the models to the list above
-                    ## but I've left that as an exercise for you to figure out
-                    print(f"Model health check response: {response_json}")
-                    models = response_json
-                    for model in models:
-                        filename = model.get("id","").split("/")[-1]
-                        quantization = model.get("id","").split(".")[-2]
-                        
-                        our_model = {
-                            "name": model["id"],
-                            "quantization": quantization,
-                            "url": model_url,
-                            "filename": filename
-                        }
-                        our_models.append(our_model)
-                    ## announce the service availability
-                    await announce_service()
-                ## if the model is not healthy, announce the service unavailability
-                except requests.exceptions.RequestException as e:
-                    print(f"Error checking model health: {e}")
-                    ## announce that the model is no longer available
-                    await announce_service_unavailability(model)
-                
-            await asyncio.sleep(60 * 5)  # Check every 5 minutes
+            ## start every check that is due, each server is the baseurl of the model
+            ## and its /models endpoint tells us whether it is healthy
+            for server_url in scheduler.pop_due(loop.time()):
+                task = asyncio.create_task(check_server(server_url))
+                checks.add(task)
+                task.add_done_callback(check_done)
+            ## the load of every backend changes all the time, so it goes out every so often on its own subject
+            if loop.time() - last_load_report >= LOAD_REPORT_INTERVAL:
+                for frame in encode_load_report(load_tracker.report(), nats_client.max_payload):
+                    await publish("inference.load", frame, headers=with_encoding(WIRE_FORMAT))
+                last_load_report = loop.time()
+            await scheduler.wait(loop.time(), longest=last_load_report + LOAD_REPORT_INTERVAL - loop.time())
 
     # Announce service availability at startup
     await announce_service()
 
     # Start listening for inference requests
     await listen_for_requests()
-    
-    
-    
-    ## when the script exits, announce that the service is no longer available
-    ## this is a good practice to let the clients know that the service is no longer available
-    ## and they should look for another service
-    ## you can do this by adding a signal handler for SIGTERM or SIGINT
-    def signal_handler(sig, frame):
-        print("Service is shutting down")
-        loop = asyncio.get_event_loop()
-        loop.create_task(announce_service_unavailability())
-        loop.create_task(nats_client.close())
-        loop.stop()
-        sys.exit(0)
-        
-        
-    
-        
-    ## add a signal handler for SIGTERM or SIGINT to announce that the service is no longer available
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
 
+    await listen_for_telemetry()
+
+    async def shutdown():
+        """Withdraw from the clients, let the handlers still running finish and disconnect."""
+        logger.info("Service is shutting down")
+        health_checks.cancel()
+        for task in list(checks):
+            task.cancel()
+        ## the clients hear about it first, so they stop waiting on us while we finish up
+        await announce_service_unavailability()
+        ## no new messages come in, the ones we have are handled and what they publish is flushed before the connection closes
+        await nats_client.drain()
+        await health_checker.close()
+        logger.info("Service stopped")
+
+    ## when the script exits, announce that the service is no longer available
+    ## so the clients know right away and look for another service
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
 
     # Start periodic health checks
-    asyncio.create_task(periodic_health_check())
+    health_checks = asyncio.create_task(periodic_health_check())
+
+    # Keep the service running until we're told to stop
+    await stopping.wait()
+    await shutdown()
+
 
-    # Keep the service running
-    while True:
-        await asyncio.sleep(3600)  # Keep the connection alive
-    
-    
-        
 if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(run_nats_client())
 
 
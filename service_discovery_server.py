@@ -1,99 +1,324 @@
+## the settings in .env go into the environment before the modules below read theirs,
+## imported as a library it leaves the environment alone
+if __name__ == '__main__':
+    import dotenv
+    dotenv.load_dotenv()
+
 import asyncio
 from nats.aio.client import Client as NATS
 from nats.aio.errors import ErrConnectionClosed, ErrTimeout, ErrNoServers
+from nats.errors import TimeoutError as NATSTimeoutError
 import json
-import re
+import logging
 import signal
-import sys
-import dotenv
-import requests 
+import time
+import uuid
 import os
-dotenv.load_dotenv()
+from health_check import HealthChecker, HEALTH_CHECK_TIMEOUT
+from health_scheduler import HealthScheduler
+from model_registry import ModelRegistry, model_record
+from query_planner import order_models
+from circuit_breaker import CircuitBreakers, CLOSED, OPEN, BREAKER_WINDOW
+from telemetry import decode_telemetry, TELEMETRY_SUBJECT
+from subjects import by_subject, AVAILABLE_SUBJECT, UNAVAILABLE_SUBJECT, WITHDRAWN_SUBJECT, SUBJECT_MIRROR
+from load_balancing import LoadTracker, PowerOfTwoChoices
+from wire_format import (BATCH_ANNOUNCEMENTS, encode_available, encode_unavailable, encode_load_report, encode_reply, decode_request,
+                         decode_load_report, chunk_encoded, is_binary, reply_encoding, with_encoding, WIRE_FORMAT,
+                         HEADERS_ALLOWANCE)
+from registry_store import RegistryStore, REGISTRY_SNAPSHOT_PATH
+from kv_registry import KVRegistry, REGISTRY_KV_BUCKET
+from server_registration import ServerList, parse_descriptors
+from sharding import (ShardMembership, supervise, DISCOVERY_WORKERS, DISCOVERY_WORKER_ID, DISCOVERY_NODE_ID,
+                      SHARD_HEARTBEAT_INTERVAL)
+from metrics import CIRCUIT_TRANSITIONS, HEALTH_PROBE_SECONDS, REQUEST_HANDLER_SECONDS, MESSAGES_PUBLISHED, REGISTRY_MODELS, subject_label, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+## how often the load of every backend is published on inference.load, in seconds
+LOAD_REPORT_INTERVAL = float(os.getenv("LOAD_REPORT_INTERVAL", "30"))
+## how long the handlers still running on shutdown get to finish, in seconds
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "5"))
+
+our_servers = ServerList()
 
-our_servers = []
+our_models = ModelRegistry()
+REGISTRY_MODELS.set_function(lambda: len(our_models))
 
-our_models = []
+def restore_registry(state):
+    """Put back the registry saved by the last run, its models are stale until they are health checked again."""
+    descriptors = state.get("descriptors", {})
+    for url in state["servers"]:
+        our_servers.append(url, descriptors.get(url))
+    for url, snapshot in state["snapshots"].items():
+        our_models.restore_server(url, snapshot["models"], snapshot["version"])
+    our_models.revision = max(our_models.revision, state["revision"])
+    logger.info("Restored %d servers and %d models at revision %d", len(our_servers), len(our_models), our_models.revision)
 
 async def run_nats_client():
+    ## pick up where the last run left off, so we can answer requests before the first health check
+    ## the workers of a sharded node keep a file each
+    if REGISTRY_SNAPSHOT_PATH and DISCOVERY_WORKER_ID is not None:
+        registry_store = RegistryStore(f"{REGISTRY_SNAPSHOT_PATH}.worker{DISCOVERY_WORKER_ID}")
+    else:
+        registry_store = RegistryStore() if REGISTRY_SNAPSHOT_PATH else None
+    ## when each server last passed a health check
+    last_seen = {}
+    if registry_store:
+        state = registry_store.load()
+        restore_registry(state)
+        last_seen.update(state["last_seen"])
+
     # Establish a connection to the NATS server
     nats_client = NATS()
     nats_client_url = os.getenv("NATS_SERVER_URL", "nats://0.0.0.0:4222")
-    print(f"Connecting to NATS server at {nats_client_url}")
-    await nats_client.connect(nats_client_url)
+    logger.info("Connecting to NATS server at %s", nats_client_url)
+    ## on shutdown drain() waits this long for the handlers of the messages we already have
+    await nats_client.connect(nats_client_url, drain_timeout=SHUTDOWN_TIMEOUT)
+    await start_metrics_server()
+    
+    loop = asyncio.get_running_loop()
+    ## one pooled http client for all health checks, so connections are reused between checks
+    health_checker = HealthChecker()
+    ## when each server is due for its next check, and the checks in flight
+    scheduler = HealthScheduler()
+    checks = set()
+    ## the tasks running in the background, cancelled on shutdown
+    background = []
+    ## set on SIGINT or SIGTERM, from then on the clients are left to the other discovery nodes
+    stopping = asyncio.Event()
+    ## identifies this discovery node in replies, so clients can tell the nodes apart
+    node_id = DISCOVERY_NODE_ID or uuid.uuid4().hex
+    ## probe latency, error rate and queue depth of every backend, sent along with the models they serve
+    load_tracker = LoadTracker()
+    balancer = PowerOfTwoChoices()
+    ## how the requests clients send to each backend are going
+    breakers = CircuitBreakers()
+    ## as one worker of a sharded node we health check only the servers the hash ring gives us,
+    ## and hear about the others from the workers that own them
+    membership = None
+    if DISCOVERY_WORKER_ID is not None:
+        membership = ShardMembership(DISCOVERY_WORKER_ID, [str(worker) for worker in range(DISCOVERY_WORKERS)], loop.time())
+        logger.info("Running as shard worker %s of %d", DISCOVERY_WORKER_ID, DISCOVERY_WORKERS)
+    shard_subject = f"discovery.{node_id}"
+
+    def owns(url):
+        return membership is None or membership.owns(url)
+
+    ## the registry shared with the other discovery nodes through JetStream, if there is a bucket for it
+    kv_registry = None
+    if REGISTRY_KV_BUCKET:
+        kv_registry = await KVRegistry.open(nats_client)
+        state = await kv_registry.load()
+        restore_registry(state)
+        for url, load in state["loads"].items():
+            load_tracker.update(url, load)
+
+    async def publish(subject, payload, headers=None, reply=""):
+        """Publish a message and count it per subject."""
+        MESSAGES_PUBLISHED.inc(subject=subject_label(subject))
+        await nats_client.publish(subject, payload, reply=reply, headers=headers)
+
+    def with_load(models, demoted=()):
+        """
+        Copy the models with the current load of their backend attached, flagged if they are restored and not
+        checked yet, and if their backend's circuit is half open, see `CircuitBreakers.screen`.
+        """
+        annotated = []
+        for model in models:
+            model = dict(model, load=load_tracker.load(model["url"]))
+            if model["url"] in our_models.stale:
+                model["stale"] = True
+            if model["url"] in demoted:
+                model["half_open"] = True
+            annotated.append(model)
+        return annotated
+
+    def registry_state():
+        return {
+            "revision": our_models.revision,
+            "servers": list(our_servers),
+            "descriptors": {url: our_servers.descriptor(url) for url in our_servers},
+            "snapshots": {url: {"version": snapshot["version"], "models": list(snapshot["models"].values())}
+                          for url, snapshot in our_models.snapshots.items()},
+            "last_seen": dict(last_seen),
+        }
+
+    async def journal(entry):
+        """Save a change to the registry, and fold the journal into a new snapshot every so often."""
+        if registry_store and registry_store.append(entry):
+            await registry_store.compact(registry_state())
+
+    async def apply_models(url, models):
+        """
+        Put the models a server serves in the registry and journal the change.
+
+        Args:
+            models (list): The models, None if the server is down.
+
+        Returns:
+            tuple: (added, removed)
+        """
+        if models is None:
+            added, removed = [], our_models.remove_server(url)
+            if removed:
+                await journal({"op": "drop_models", "url": url, "revision": our_models.revision})
+            return added, removed
+        added, removed = our_models.update_server(url, models)
+        last_seen[url] = time.time()
+        if added or removed:
+            await journal({"op": "update_server", "url": url, "version": our_models.snapshots[url]["version"],
+                           "revision": our_models.revision, "models": models, "last_seen": last_seen[url]})
+        return added, removed
+
+    async def share_servers(urls):
+        """Tell the other workers of a sharded node which models our servers serve and how loaded they are."""
+        if membership is None or not urls:
+            return
+        parts = []
+        for url in urls:
+            snapshot = our_models.snapshots.get(url)
+            models = list(snapshot["models"].values()) if snapshot else None
+            parts.append(json.dumps({"url": url, "models": models, "load": load_tracker.load(url)}).encode())
+        prefix = json.dumps({"worker": DISCOVERY_WORKER_ID, "revision": our_models.revision})[:-1].encode() + b', "servers": ['
+        for frame in chunk_encoded(parts, prefix, b"]}", nats_client.max_payload - HEADERS_ALLOWANCE):
+            await publish(f"{shard_subject}.update", frame)
+
+    async def store_server(url):
+        """Write what we know of one of our servers to the shared registry."""
+        if kv_registry is None:
+            return
+        snapshot = our_models.snapshots.get(url)
+        if snapshot:
+            await kv_registry.put_models(url, snapshot["version"], list(snapshot["models"].values()), load_tracker.load(url))
+        else:
+            await kv_registry.delete_models(url)
+
+    async def add_server(url, descriptor=None, delay=0.0):
+        """Register a server, returns False if we already had it. Its first check is due after `delay` seconds."""
+        if not our_servers.append(url, descriptor):
+            return False
+        logger.info("New server available: %s", url)
+        await journal({"op": "add_server", "url": url, "descriptor": descriptor})
+        ## one check straight away, after that it's on the schedule like every other server
+        if owns(url):
+            scheduler.add(url, loop.time(), delay)
+        return True
+
+    async def remove_server(url):
+        """Forget a server, returns the models it was serving."""
+        our_servers.remove(url)
+        logger.info("Server unavailable: %s", url)
+        removed = our_models.remove_server(url)
+        load_tracker.forget(url)
+        scheduler.remove(url)
+        health_checker.forget(url)
+        breakers.forget(url)
+        await journal({"op": "remove_server", "url": url, "revision": our_models.revision})
+        return removed
+
+    def rebalance():
+        """Health check the servers the ring gives us now, and stop checking the ones another worker took over."""
+        now = loop.time()
+        for url in our_servers:
+            if owns(url):
+                if url not in scheduler:
+                    scheduler.add(url, now)
+            elif url in scheduler:
+                scheduler.remove(url)
+                health_checker.forget(url)
 
     async def announce_service():
         """Announce service availability and capabilities."""
-        # Convert dict to JSON string if using json for message payload
-        for model in our_models:
-            await nats_client.publish("inference.available", json.dumps({
-                "selected_model": model
-                }).encode())
-        print("announced service availability for models: ", our_models)
+        ## each worker of a sharded node announces the models of its own servers
+        models = [model for model in our_models.all() if owns(model["url"])]
+        await announce_available(models)
+        logger.info("announced service availability for %d models", len(models))
         
-    async def announce_service_unavailability(model):
-        """Announce that the service is no longer available."""
-        # Implement service unavailability announcement
-        if not model:
-            await nats_client.publish("inference.unavailable", json.dumps(our_models).encode())
-        else:
-            await nats_client.publish("inference.unavailable", json.dumps([model]).encode())
-        print("announced service unavailability for models: ", our_models)
+    async def announce_available(models):
+        """Announce models on the subjects of their family and quantization, see `subjects.by_subject`."""
+        headers = with_encoding(WIRE_FORMAT, {"Node": node_id})
+        for subject, group in by_subject(AVAILABLE_SUBJECT, with_load(models)).items():
+            ## only clients that read batched frames subscribe to the per-family subjects, so those always get one
+            ## frame for the lot. The flat mirror is for older clients and batched only if the fleet is ready for it
+            batch = BATCH_ANNOUNCEMENTS if subject == AVAILABLE_SUBJECT else True
+            for frame in encode_available(group, our_models.revision, nats_client.max_payload, batch=batch):
+                await publish(subject, frame, headers=headers)
+
+    async def announce_changes(added, removed):
+        """Announce the models that were added or removed since the last health check."""
+        ## we've withdrawn already, whatever changes now is for the other nodes to tell
+        if stopping.is_set():
+            return
+        ## the revision lets clients tell which announcements are newer, the node which of them told them about a model
+        await announce_available(added)
+        ## inference.unavailable stays a plain list of models for older clients, so the revision goes in a header
+        headers = with_encoding(WIRE_FORMAT, {"Revision": str(our_models.revision), "Node": node_id})
+        for subject, group in by_subject(UNAVAILABLE_SUBJECT, removed).items():
+            for frame in encode_unavailable(group, nats_client.max_payload):
+                await publish(subject, frame, headers=headers)
+        if added or removed:
+            logger.info("announced revision %d: %d added, %d removed", our_models.revision, len(added), len(removed))
+
+    async def announce_service_unavailability():
+        """
+        Announce that this node is going away, in one message with every server we look after.
+
+        It goes on inference.withdrawn, and on inference.unavailable for older clients. There the servers
+        are models without a name, which they take as the whole server being gone. Newer clients only drop
+        what no other node told them about.
+        """
+        servers = [{"url": url} for url in our_servers if owns(url)]
+        subjects = [WITHDRAWN_SUBJECT, UNAVAILABLE_SUBJECT] if SUBJECT_MIRROR else [WITHDRAWN_SUBJECT]
+        for frame in encode_unavailable(servers, nats_client.max_payload):
+            for subject in subjects:
+                await publish(subject, frame, headers=with_encoding(WIRE_FORMAT, {"Node": node_id, "Withdrawn": "true"}))
+        logger.info("announced service unavailability for %d servers", len(servers))
 
     async def listen_for_requests():
         """Listen on 'inference.requested' and process inference requests."""
         async def request_handler(msg):
+            with REQUEST_HANDLER_SECONDS.time():
+                await answer_request(msg)
+
+        async def answer_request(msg):
             subject = msg.subject
-            data = json.loads(msg.data.decode())
-            print(f"Received a request on '{subject}': {data}")
+            data = decode_request(msg.data, msg.headers)
+            logger.debug("Received a request on '%s': %s", subject, data)
             requested_model = data
-            # Reply to the request, if no specific model is requested, reply with any available model
-            if data.get("name", "") == "":
-                ## no model requested, reply with any available model from our_models
-                if len(our_models) == 0:
-                    return
-                selected_model = our_models[0]
-            else:
-                ## model requested, reply with the requested model
-                matching_models= []
-                selected_model = None
-                ## do we have this model loaded?
-                for model in our_models:
-                    ## first filter out any models that don't match the requested model name
-                    ## check if use_regex_model_name is set to True, if so match using regex, if not match using exact string match
-                    if requested_model["use_regex_model_name"]:
-                        if re.match(requested_model["name"], model["name"]):
-                            matching_models.append(model)
-                    else:
-                        if requested_model.get("name") == model["name"]:
-                            matching_models.append(model)
-                            
-                    ## check if the model has a quantization attribute with a value
-                    
-                    if requested_model.get("quantization") is None:
-                        selected_model = matching_models[0]
-                    ## if we have a match, check if the model is quantized
-                    if len(matching_models) > 0:
-                        ## get the first model that matches the requested quantization
-                        for model in matching_models:
-                            ## check if use_regex_quantization is set to True, if so match using regex, if not match using exact string match
-                            if requested_model["use_regex_quantization"]:
-                                if re.match(requested_model["quantization"], model["quantization"]):
-                                    selected_model = model
-                            else:
-                                if requested_model["quantization"] == model["quantization"]:
-                                    selected_model = model
-            if selected_model is None:
+            if stopping.is_set():
+                return
+            ## a request with a reply inbox gets every matching model back on the inbox only,
+            ## split over frames that say which node sent them and how many there are.
+            ## A node without matches answers too, with one empty frame, so the client can tell it's there
+            ## backends whose circuit is open aren't handed out, half open ones only after the rest
+            matches, demoted = breakers.screen(our_models.match(requested_model), loop.time())
+            if msg.reply:
+                matches = order_models(matches, requested_model, load_tracker.loads, demoted)
+                ## answered in binary if the request says it can read that
+                encoding = reply_encoding(msg.headers)
+                frames = encode_available(with_load(matches, demoted), our_models.revision, nats_client.max_payload, batch=True, encoding=encoding)
+                for number, frame in enumerate(frames, 1):
+                    await publish(msg.reply, frame, headers=with_encoding(encoding, {"Node": node_id, "Frame": f"{number}/{len(frames)}"}))
+                return
+            # Reply to the request with a model that matches, if no specific model is requested reply with any available model
+            ## of the replicas that match, prefer the less loaded ones
+            if not matches:
                 return 
+            matches = [model for model in matches if model["url"] not in demoted] or matches
+            ## a query that says what it likes best gets exactly that, anything else is spread over the replicas
+            if requested_model.get("order_by"):
+                selected_model = order_models(matches, requested_model, load_tracker.loads)[0]
             else:
-                reply = json.dumps({
-                    "requested_model": requested_model,
-                    "selected_model": selected_model
-                })
-                await nats_client.publish("inference.available", reply.encode())
-                print(f"Published a message on 'inference.available': {reply}")
+                selected_model = balancer.choose(matches, load_tracker.loads)
+            ## everyone subscribed to the model gets this, so it goes in the fleet-wide encoding
+            reply = encode_reply(requested_model, with_load([selected_model], demoted)[0], our_models.revision)
+            for subject in by_subject(AVAILABLE_SUBJECT, [selected_model]):
+                await publish(subject, reply, headers=with_encoding(WIRE_FORMAT, {"Node": node_id}))
+            logger.debug("Published a message on the subjects of %s: %s", selected_model["name"], reply)
 
         # Subscribe to the channel
-        await nats_client.subscribe("inference.requested", cb=request_handler)
+        ## the workers of a sharded node share a queue group, so each request is answered by one of them
+        await nats_client.subscribe("inference.requested", queue=shard_subject if membership else "", cb=request_handler)
     
     async def listen_for_new_servers():
         """Listen on 'inference.new_server' and process new server announcements. Add to our_servers list."""
@@ -102,11 +327,9 @@ async def run_nats_client():
         async def new_server_handler(msg):
             subject = msg.subject
             data = msg.data.decode()
-            print(f"Received a request on '{subject}': {data}")
-            our_servers.append(data)
-            print(f"New server available: {data}")
-            await periodic_health_check()
-            await announce_service()
+            logger.debug("Received a request on '%s': %s", subject, data)
+            if await add_server(data) and kv_registry and owns(data):
+                await kv_registry.put_server(data)
             
         await nats_client.subscribe("inference.new_server", cb=new_server_handler)
         
@@ -116,56 +339,339 @@ async def run_nats_client():
         
         async def unavailable_server_handler(msg):
             subject = msg.subject
+            ## binary frames and withdrawals are announcements to the clients, a server going away is always a plain url
+            if is_binary(msg.headers) or (msg.headers or {}).get("Withdrawn"):
+                return
             data = msg.data.decode()
-            print(f"Received a request on '{subject}': {data}")
+            logger.debug("Received a request on '%s': %s", subject, data)
             if data in our_servers:
-                our_servers.remove(data)
-                print(f"Server unavailable: {data}")
+                removed = await remove_server(data)
+                if owns(data):
+                    await announce_changes([], removed)
+                    if kv_registry:
+                        await kv_registry.delete_server(data)
                 
         await nats_client.subscribe("inference.unavailable", cb=unavailable_server_handler)
-        
-        
-    
+
+    async def listen_for_telemetry():
+        """Listen for what clients report of their requests to the backends, and open or close their circuits."""
+        async def telemetry_handler(msg):
+            now = loop.time()
+            for report in decode_telemetry(msg.data):
+                url = report["url"]
+                if url not in our_servers:
+                    continue
+                transition = breakers.record(report, now)
+                if transition is None:
+                    continue
+                CIRCUIT_TRANSITIONS.inc(backend=url, state=transition)
+                ## every worker keeps the circuits of every backend, the one that checks it tells the clients
+                if not owns(url):
+                    continue
+                snapshot = our_models.snapshots.get(url)
+                models = list(snapshot["models"].values()) if snapshot else []
+                if transition == OPEN:
+                    ## clients stop using it right away, and a check tells a dead backend from one that only fails requests.
+                    ## One that is being checked right now already has its check
+                    await announce_changes([], models)
+                    scheduler.expedite(url, now)
+                else:
+                    await announce_changes(models, [])
+
+        await nats_client.subscribe(TELEMETRY_SUBJECT, cb=telemetry_handler)
+
+
+    async def record_check(result):
+        """Take in the outcome of a health check and schedule the next one, returns the (added, removed) models."""
+        ## the checker only remembers that a catalog is the same, not what's in it, so one we have no models for is fetched in full
+        if result.unchanged and result.url in our_servers and (result.url not in our_models.snapshots or result.url in our_models.stale):
+            health_checker.forget(result.url)
+            result = await health_checker.probe(result.url)
+        now = loop.time()
+        scheduler.record(result, now, serving=breakers.serving(result.url, now, BREAKER_WINDOW))
+        ## a half open backend gets no requests while other replicas are around, so its health check closes or opens its circuit
+        circuit = breakers.probed(result.url, result.ok, now)
+        if circuit is not None:
+            CIRCUIT_TRANSITIONS.inc(backend=result.url, state=circuit)
+        ## and an open one is checked as soon as it goes half open
+        half_open_at = breakers.half_open_at(result.url)
+        if half_open_at is not None:
+            scheduler.expedite(result.url, half_open_at)
+        ## it may have been removed while we were checking it
+        if result.url not in our_servers:
+            return [], []
+        load_tracker.record_probe(result)
+        HEALTH_PROBE_SECONDS.observe(result.latency, backend=result.url, outcome="ok" if result.ok else "error")
+        ## the same catalog as last time, there's nothing to rebuild, only models to bring back if its circuit just closed
+        if result.unchanged and result.url in our_models.snapshots and result.url not in our_models.stale:
+            last_seen[result.url] = time.time()
+            if circuit == CLOSED:
+                return list(our_models.snapshots[result.url]["models"].values()), []
+            return [], []
+        if result.ok:
+            logger.debug("Model health check response from %s: %s", result.url, result.models)
+            ## the labels a server was registered with go along with each of its models
+            labels = our_servers.labels(result.url)
+            models = [model_record(model, result.url, labels) for model in result.models]
+            added, removed = await apply_models(result.url, models)
+            ## its models were withdrawn when its circuit opened, so they all come back
+            if circuit == CLOSED:
+                added = models
+        ## if the model is not healthy, everything it was serving is no longer available
+        else:
+            logger.warning("Error checking model health of %s: %s", result.url, result.error)
+            added, removed = await apply_models(result.url, None)
+        if added or removed:
+            await store_server(result.url)
+        return added, removed
+
+    async def check_server(server_url):
+        """Health check one server, announce what changed and schedule its next check."""
+        added, removed = await record_check(await health_checker.probe(server_url))
+        ## only announce what changed since the last check
+        await announce_changes(added, removed)
+        if added or removed:
+            await share_servers([server_url])
+
+    async def register_servers(descriptors):
+        """
+        Register a batch of servers, check the new ones all at once and announce their models together.
+
+        As one worker of a sharded node, the other workers register the new ones too and check their
+        share of them while we check ours, and the answer covers all of them.
+
+        Returns:
+            dict: {"node", "registered", "known", "healthy", "missing_models": {url: [model ids]}}
+        """
+        registered, known = [], []
+        for descriptor in descriptors:
+            url = descriptor["url"]
+            ## not due until the check below has been recorded, so the schedule doesn't check them a second time
+            if await add_server(url, descriptor, delay=scheduler.min_interval):
+                registered.append(url)
+            else:
+                known.append(url)
+        others = [member for member in membership.last_seen if member != DISCOVERY_WORKER_ID] if membership else []
+        subscription = None
+        if others and registered:
+            inbox = nats_client.new_inbox()
+            subscription = await nats_client.subscribe(inbox)
+            new = [our_servers.descriptor(url) for url in registered]
+            await publish(f"{shard_subject}.register", json.dumps(new).encode(), reply=inbox)
+        checked = await check_new_servers(registered)
+        if subscription is not None:
+            ## their checks take as long as ours at most
+            deadline = loop.time() + HEALTH_CHECK_TIMEOUT + SHARD_HEARTBEAT_INTERVAL
+            answered = set()
+            try:
+                while len(answered) < len(others) and deadline > loop.time():
+                    try:
+                        msg = await subscription.next_msg(timeout=deadline - loop.time())
+                    except NATSTimeoutError:
+                        break
+                    share = json.loads(msg.data)
+                    answered.add(share["worker"])
+                    checked["healthy"].extend(share["healthy"])
+                    checked["missing_models"].update(share["missing_models"])
+            finally:
+                await subscription.unsubscribe()
+            if len(answered) < len(others):
+                logger.warning("Only %d of %d shard workers reported their checks of the registered servers", len(answered), len(others))
+        logger.info("Registered %d servers, %d were known already", len(registered), len(known))
+        return dict({"node": node_id, "registered": registered, "known": known}, **checked)
+
+    async def check_new_servers(urls):
+        """
+        Check the servers we own of a batch that was just registered, and announce their models together.
+
+        Returns:
+            dict: {"healthy", "missing_models": {url: [model ids]}}
+        """
+        ours = [url for url in urls if owns(url)]
+        if kv_registry:
+            for url in ours:
+                await kv_registry.put_server(url, our_servers.descriptor(url))
+        results = await health_checker.sweep(ours)
+        all_added, all_removed, changed = [], [], []
+        missing_models = {}
+        for result in results:
+            added, removed = await record_check(result)
+            all_added.extend(added)
+            all_removed.extend(removed)
+            if added or removed:
+                changed.append(result.url)
+            if result.ok and not result.unchanged:
+                served = {model.id for model in result.models}
+                missing = [model for model in our_servers.descriptor(result.url)["models"] if model not in served]
+                if missing:
+                    missing_models[result.url] = missing
+        await announce_changes(all_added, all_removed)
+        await share_servers(changed)
+        return {"healthy": [result.url for result in results if result.ok], "missing_models": missing_models}
+
+    async def deregister_servers(urls):
+        """
+        Deregister a batch of servers and announce all their models as unavailable together.
+
+        Returns:
+            dict: {"node", "deregistered", "unknown"}
+        """
+        deregistered, unknown, all_removed = [], [], []
+        for url in urls:
+            if url not in our_servers:
+                unknown.append(url)
+                continue
+            ours = owns(url)
+            removed = await remove_server(url)
+            deregistered.append(url)
+            if ours:
+                all_removed.extend(removed)
+                if kv_registry:
+                    await kv_registry.delete_server(url)
+        await announce_changes([], all_removed)
+        logger.info("Deregistered %d servers", len(deregistered))
+        return {"node": node_id, "deregistered": deregistered, "unknown": unknown}
+
+    async def listen_for_registrations():
+        """
+        Listen on 'inference.register' and 'inference.deregister' for servers coming and going in bulk.
+
+        The workers of a sharded node share a queue group for registrations, so one of them answers for all of them.
+        Every worker takes deregistrations, they each forget the servers and agree on the answer.
+        """
+        async def register_handler(msg):
+            summary = await register_servers(parse_descriptors(msg.data))
+            if msg.reply:
+                await publish(msg.reply, json.dumps(summary).encode())
+
+        async def deregister_handler(msg):
+            summary = await deregister_servers([descriptor["url"] for descriptor in parse_descriptors(msg.data)])
+            if msg.reply:
+                await publish(msg.reply, json.dumps(summary).encode())
+
+        await nats_client.subscribe("inference.register", queue=shard_subject if membership else "", cb=register_handler)
+        await nats_client.subscribe("inference.deregister", cb=deregister_handler)
+
+    def check_done(task):
+        checks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Health check of a server failed", exc_info=task.exception())
 
     async def periodic_health_check():
-        """Periodically check the health of the service and re-announce if necessary."""
-        our_models.clear()
+        """Check every server whenever its schedule says it's due and announce any changes."""
+        for server_url in our_servers:
+            if owns(server_url):
+                scheduler.add(server_url, loop.time())
+        last_load_report = loop.time()
         while True:
-            ## ping every server
-            for model in our_servers:
-                model_url = model
-                ## it's the baseurl of the model, you can check /models endpoint to see if the model is healthy
-                try:
-                    response = requests.get(f"{model_url}/models")
-                    response.raise_for_status()
-                    
-                    response_json = response.json()
-                    response_json = response_json.get("data", {})
-                    ## you can get a list of models loaded on the server from this url
-                    ## you could dynamically check add all of the models to the list above
-                    ## but I've left that as an exercise for you to figure out
-                    print(f"Model health check response: {response_json}")
-                    models = response_json
-                    for model in models:
-                        filename = model.get("id","").split("/")[-1]
-                        quantization = model.get("id","").split(".")[-2]
-                        
-                        our_model = {
-                            "name": model["id"],
-                            "quantization": quantization,
-                            "url": model_url,
-                            "filename": filename
-                        }
-                        our_models.append(our_model)
-                    ## announce the service availability
-                    await announce_service()
-                ## if the model is not healthy, announce the service unavailability
-                except requests.exceptions.RequestException as e:
-                    print(f"Error checking model health: {e}")
-                    ## announce that the model is no longer available
-                    await announce_service_unavailability(model)
-                
-            await asyncio.sleep(60 * 5)  # Check every 5 minutes
+            ## start every check that is due, each server is the baseurl of the model
+            ## and its /models endpoint tells us whether it is healthy
+            for server_url in scheduler.pop_due(loop.time()):
+                task = asyncio.create_task(check_server(server_url))
+                checks.add(task)
+                task.add_done_callback(check_done)
+            ## the load of every backend changes all the time, so it goes out every so often on its own subject
+            if loop.time() - last_load_report >= LOAD_REPORT_INTERVAL:
+                loads = [load for load in load_tracker.report() if owns(load["url"])]
+                for frame in encode_load_report(loads, nats_client.max_payload):
+                    await publish("inference.load", frame, headers=with_encoding(WIRE_FORMAT))
+                last_load_report = loop.time()
+            await scheduler.wait(loop.time(), longest=last_load_report + LOAD_REPORT_INTERVAL - loop.time())
+
+    async def listen_for_shard():
+        """Keep track of the other workers of a sharded node, and of the servers they own."""
+        async def heartbeat_handler(msg):
+            heartbeat = json.loads(msg.data)
+            if heartbeat["worker"] == DISCOVERY_WORKER_ID:
+                return
+            if membership.heartbeat(heartbeat["worker"], heartbeat["instance"], loop.time()):
+                logger.info("Shard worker %s joined", heartbeat["worker"])
+                rebalance()
+                ## it may have nothing yet, or only what it had before a restart, so it gets every server we know of
+                await share_servers(list(our_servers))
+
+        async def update_handler(msg):
+            update = json.loads(msg.data)
+            if update["worker"] == DISCOVERY_WORKER_ID:
+                return
+            for server in update["servers"]:
+                url = server["url"]
+                ## a worker that just started may not have been around when the server was added
+                known = url in our_servers
+                if not known:
+                    our_servers.append(url)
+                    await journal({"op": "add_server", "url": url})
+                ## our own checks are the word on our servers, what others say about them is second hand
+                if owns(url):
+                    if not known:
+                        scheduler.add(url, loop.time())
+                    continue
+                load_tracker.update(url, server["load"])
+                await apply_models(url, server["models"])
+            our_models.revision = max(our_models.revision, update["revision"])
+
+        async def register_handler(msg):
+            ## servers another worker took a registration for, we check the ones that are ours and tell it how that went
+            descriptors = parse_descriptors(msg.data)
+            for descriptor in descriptors:
+                await add_server(descriptor["url"], descriptor, delay=scheduler.min_interval)
+            checked = await check_new_servers([descriptor["url"] for descriptor in descriptors])
+            if msg.reply:
+                await publish(msg.reply, json.dumps(dict(checked, worker=DISCOVERY_WORKER_ID)).encode())
+
+        async def load_handler(msg):
+            ## how loaded the other workers' servers are, for the load we send along with their models
+            for load in decode_load_report(msg.data, msg.headers):
+                url = load.pop("url")
+                if not owns(url):
+                    load_tracker.update(url, load)
+
+        async def heartbeats():
+            while True:
+                await publish(f"{shard_subject}.heartbeat", json.dumps({"worker": DISCOVERY_WORKER_ID, "instance": membership.instance}).encode())
+                if membership.expire(loop.time()):
+                    rebalance()
+                await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+
+        await nats_client.subscribe(f"{shard_subject}.heartbeat", cb=heartbeat_handler)
+        await nats_client.subscribe(f"{shard_subject}.update", cb=update_handler)
+        await nats_client.subscribe(f"{shard_subject}.register", cb=register_handler)
+        await nats_client.subscribe("inference.load", cb=load_handler)
+        background.append(asyncio.create_task(heartbeats()))
+
+    async def follow_registry():
+        """Apply what the other discovery nodes write to the shared registry."""
+        async for change in kv_registry.changes():
+            url = change.url
+            if change.kind == "server":
+                if change.value is None and url in our_servers:
+                    await remove_server(url)
+                elif change.value is not None and url not in our_servers:
+                    await add_server(url, change.value if isinstance(change.value, dict) else None)
+            ## our own checks are the word on the servers we check, that includes our own writes coming back
+            elif url in our_servers and url not in scheduler:
+                if change.value is not None:
+                    load_tracker.update(url, change.value.get("load"))
+                await apply_models(url, change.value["models"] if change.value else None)
+
+    async def refresh_registry():
+        """Write our servers to the shared registry again before they expire, they only expire once nobody looks after them."""
+        while True:
+            await asyncio.sleep(kv_registry.ttl / 3)
+            for url in list(our_servers):
+                if owns(url):
+                    await kv_registry.put_server(url, our_servers.descriptor(url))
+                    await store_server(url)
+
+    if kv_registry:
+        background.append(asyncio.create_task(follow_registry()))
+        background.append(asyncio.create_task(refresh_registry()))
+
+    if membership:
+        await listen_for_shard()
+        ## the other workers send us their servers when they hear our first heartbeat, give them a moment
+        ## before we take our share of the requests
+        await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
 
     # Announce service availability at startup
     await announce_service()
@@ -178,40 +684,44 @@ async def run_nats_client():
     
     # Start listening for unavailable servers
     await remove_unavailable_server()
-    
-    
-    
-    ## when the script exits, announce that the service is no longer available
-    ## this is a good practice to let the clients know that the service is no longer available
-    ## and they should look for another service
-    ## you can do this by adding a signal handler for SIGTERM or SIGINT
-    def signal_handler(sig, frame):
-        print("Service is shutting down")
-        loop = asyncio.get_event_loop()
-        loop.create_task(announce_service_unavailability())
-        loop.create_task(nats_client.close())
-        loop.stop()
-        sys.exit(0)
-        
-        
-    
-        
-    ## add a signal handler for SIGTERM or SIGINT to announce that the service is no longer available
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
 
+    await listen_for_registrations()
+
+    await listen_for_telemetry()
+
+    async def shutdown():
+        """Withdraw from the clients, let the handlers still running finish and disconnect."""
+        logger.info("Service is shutting down")
+        for task in background + list(checks):
+            task.cancel()
+        ## the clients hear about it first, so they stop waiting on us while we finish up
+        await announce_service_unavailability()
+        ## no new messages come in, the ones we have are handled and what they publish is flushed before the connection closes
+        await nats_client.drain()
+        await health_checker.close()
+        if registry_store:
+            registry_store.close()
+        logger.info("Service stopped")
+
+    ## when the script exits, announce that the service is no longer available
+    ## so the clients know right away and look for another service
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
 
     # Start periodic health checks
-    asyncio.create_task(periodic_health_check())
+    background.append(asyncio.create_task(periodic_health_check()))
+
+    # Keep the service running until we're told to stop
+    await stopping.wait()
+    await shutdown()
+
 
-    # Keep the service running
-    while True:
-        await asyncio.sleep(3600)  # Keep the connection alive
-    
-    
-        
 if __name__ == '__main__':
-    asyncio.run(run_nats_client())
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if DISCOVERY_WORKERS > 1 and DISCOVERY_WORKER_ID is None:
+        supervise(DISCOVERY_WORKERS, os.path.abspath(__file__))
+    else:
+        asyncio.run(run_nats_client())
 
 
 
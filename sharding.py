@@ -0,0 +1,111 @@
+## runs the discovery server as several worker processes, each health checking its own share of the servers
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from hash_ring import HashRing, hash_key
+
+logger = logging.getLogger(__name__)
+
+## how many worker processes the supervisor starts, 1 runs the server in a single process as before
+DISCOVERY_WORKERS = int(os.getenv("DISCOVERY_WORKERS", "1"))
+## set by the supervisor for each worker, a process without it isn't sharded
+DISCOVERY_WORKER_ID = os.getenv("DISCOVERY_WORKER_ID")
+## shared by the workers of one supervisor, so clients see them as one discovery node
+DISCOVERY_NODE_ID = os.getenv("DISCOVERY_NODE_ID")
+## workers say they are alive this often, in seconds, and one that is quiet for three times as long is gone
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", "2"))
+SHARD_HEARTBEAT_TIMEOUT = 3 * SHARD_HEARTBEAT_INTERVAL
+## points per worker on the hash ring, more spread the servers more evenly
+SHARD_RING_POINTS = int(os.getenv("SHARD_RING_POINTS", "64"))
+
+
+class ShardMembership:
+    """
+    The workers of a sharded discovery node that are alive, and which servers are ours.
+
+    Every worker the supervisor started counts as alive until it misses its heartbeats,
+    so the ring is right from the start instead of after the first round of heartbeats.
+    """
+
+    def __init__(self, worker_id, workers, now, timeout=SHARD_HEARTBEAT_TIMEOUT):
+        self.worker_id = worker_id
+        ## tells a worker that restarted apart from one that kept running
+        self.instance = uuid.uuid4().hex
+        self.timeout = timeout
+        self.last_seen = {member: now for member in workers}
+        self.last_seen[worker_id] = now
+        self.instances = {worker_id: self.instance}
+        self.ring = HashRing(self.last_seen, SHARD_RING_POINTS)
+
+    def heartbeat(self, member, instance, now):
+        """
+        Note a worker's heartbeat.
+
+        Returns:
+            bool: True if the worker joined or restarted since its last heartbeat, it has to be told our state.
+        """
+        known = member in self.last_seen
+        joined = self.instances.get(member) != instance
+        self.last_seen[member] = now
+        self.instances[member] = instance
+        if not known:
+            self.ring.set_members(self.last_seen)
+        return joined
+
+    def expire(self, now):
+        """Drop the workers whose heartbeats stopped, returns True if the ring changed."""
+        gone = [member for member, seen in self.last_seen.items()
+                if member != self.worker_id and now - seen > self.timeout]
+        for member in gone:
+            del self.last_seen[member]
+            self.instances.pop(member, None)
+            logger.warning("Shard worker %s stopped sending heartbeats", member)
+        if gone:
+            self.ring.set_members(self.last_seen)
+        return bool(gone)
+
+    def owns(self, url):
+        return self.ring.owner(url) == self.worker_id
+
+
+def supervise(workers, script):
+    """
+    Run `script` as `workers` worker processes and restart any of them that exits, until SIGINT or SIGTERM.
+
+    Each worker gets its id in DISCOVERY_WORKER_ID and the shared node id in DISCOVERY_NODE_ID,
+    and its own metrics port counting up from METRICS_PORT.
+    """
+    node_id = uuid.uuid4().hex
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    processes = {}
+    stopping = []
+
+    def start(worker_id):
+        env = dict(os.environ, DISCOVERY_WORKERS=str(workers), DISCOVERY_WORKER_ID=str(worker_id), DISCOVERY_NODE_ID=node_id)
+        if metrics_port:
+            env["METRICS_PORT"] = str(metrics_port + worker_id)
+        processes[worker_id] = subprocess.Popen([sys.executable, script], env=env)
+        logger.info("Started shard worker %d, pid %d", worker_id, processes[worker_id].pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker_id in range(workers):
+        start(worker_id)
+    while not stopping:
+        time.sleep(1)
+        for worker_id, process in list(processes.items()):
+            if process.poll() is not None and not stopping:
+                logger.warning("Shard worker %d exited with %s, restarting it", worker_id, process.returncode)
+                start(worker_id)
+    for process in processes.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in processes.values():
+        process.wait()
@@ -0,0 +1,80 @@
+## the subjects models are announced on: every model goes on inference.available.<family>.<quantization>,
+## so a client subscribes to the models it wants and the NATS server drops everything else before it gets to us
+import os
+import re
+from model_catalog import QUANTIZATION_PATTERN
+
+AVAILABLE_SUBJECT = "inference.available"
+UNAVAILABLE_SUBJECT = "inference.unavailable"
+## discovery nodes going away, for every client whatever models it wants
+WITHDRAWN_SUBJECT = "inference.withdrawn"
+## every announcement also goes out on the flat inference.available and inference.unavailable, for older clients
+SUBJECT_MIRROR = os.getenv("SUBJECT_MIRROR", "true").lower() == "true"
+
+## NATS splits subjects at dots and gives * and > a meaning, anything but these characters becomes an underscore
+UNSAFE_CHARACTERS = re.compile(r"[^A-Za-z0-9_-]")
+MODEL_EXTENSION = re.compile(r"\.(gguf|ggml|bin|safetensors)$", re.IGNORECASE)
+
+
+def subject_token(value):
+    """A string as one token of a subject, different strings may end up as the same token."""
+    return UNSAFE_CHARACTERS.sub("_", value) or "_"
+
+
+def model_family(name):
+    """
+    The family of a model: its file name without the quantization and extension, in lower case.
+
+    "org/llama-3-8b.Q4_K_M.gguf" and "other/Llama-3-8B-Q8_0.gguf" are both "llama-3-8b".
+    """
+    base = MODEL_EXTENSION.sub("", name.split("/")[-1])
+    found = QUANTIZATION_PATTERN.search(base)
+    if found:
+        base = base[:found.start()]
+    return base.rstrip("-._").lower()
+
+
+def model_subject(prefix, model):
+    """The subject a model is announced on, e.g. inference.available.llama-3-8b.Q4_K_M"""
+    return f"{prefix}.{subject_token(model_family(model['name']))}.{subject_token(model['quantization'])}"
+
+
+def query_subject(prefix, query):
+    """
+    The narrowest subscription that gets every announcement of the models a query config matches.
+
+    An exact name narrows it to the model's family and an exact quantization to that quantization,
+    a regex or an empty field leaves a wildcard. It's a superset, the models still have to be matched.
+    """
+    name = query.get("name")
+    quantization = query.get("quantization")
+    family = subject_token(model_family(name)) if name and not query.get("use_regex_model_name") else "*"
+    quantization = subject_token(quantization) if quantization and not query.get("use_regex_quantization") else "*"
+    return f"{prefix}.{family}.{quantization}"
+
+
+def covers(subscription, subject):
+    """Whether a subscription of ours gets everything on a subject, which may have wildcards itself."""
+    subscription_tokens = subscription.split(".")
+    subject_tokens = subject.split(".")
+    return len(subscription_tokens) == len(subject_tokens) and \
+        all(token == "*" or token == other for token, other in zip(subscription_tokens, subject_tokens))
+
+
+def by_subject(prefix, models, mirror=SUBJECT_MIRROR):
+    """
+    Group models by the subject they're announced on.
+
+    Returns:
+        dict: {subject: [models]}, with every model under the flat `prefix` as well if mirror is set.
+    """
+    groups = {}
+    for model in models:
+        subject = model_subject(prefix, model)
+        group = groups.get(subject)
+        if group is None:
+            group = groups[subject] = []
+        group.append(model)
+    if mirror and models:
+        groups[prefix] = models
+    return groups
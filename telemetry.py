@@ -0,0 +1,123 @@
+## what clients see of the backends they send inference requests to, reported to the discovery services in batches
+import json
+import os
+import time
+from wire_format import chunk_encoded, DEFAULT_MAX_PAYLOAD, HEADERS_ALLOWANCE
+
+TELEMETRY_SUBJECT = os.getenv("TELEMETRY_SUBJECT", "inference.telemetry")
+## how often a client sends what it has collected, in seconds
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", "1"))
+
+OUTCOMES = ("ok", "error", "timeout")
+
+
+class BackendOutcomes:
+    __slots__ = ("ok", "errors", "timeouts", "latency")
+
+    def __init__(self):
+        self.ok = 0
+        self.errors = 0
+        self.timeouts = 0
+        ## the sum over the successful requests
+        self.latency = 0.0
+
+
+class TelemetryBuffer:
+    """
+    Adds up the outcomes of requests per backend until they're taken out with `drain`.
+
+    However many requests there were, a backend takes one entry in the next batch.
+    """
+
+    def __init__(self):
+        self.backends = {}
+
+    def __len__(self):
+        return len(self.backends)
+
+    def record(self, url, latency=None, outcome="ok"):
+        """
+        Note the outcome of one request to a backend.
+
+        Args:
+            latency (float): How long it took, in seconds.
+            outcome (str): "ok", "error" or "timeout".
+        """
+        outcomes = self.backends.get(url)
+        if outcomes is None:
+            outcomes = self.backends[url] = BackendOutcomes()
+        if outcome == "ok":
+            outcomes.ok += 1
+            outcomes.latency += latency or 0.0
+        elif outcome == "timeout":
+            outcomes.timeouts += 1
+        else:
+            outcomes.errors += 1
+
+    def drain(self):
+        """
+        Take everything recorded since the last drain.
+
+        Returns:
+            list: {"url", "ok", "errors", "timeouts", "latency"} per backend, latency is the mean of the successful requests.
+        """
+        backends, self.backends = self.backends, {}
+        return [{"url": url, "ok": outcomes.ok, "errors": outcomes.errors, "timeouts": outcomes.timeouts,
+                 "latency": outcomes.latency / outcomes.ok if outcomes.ok else None}
+                for url, outcomes in backends.items()]
+
+
+def encode_telemetry(reports, max_payload=DEFAULT_MAX_PAYLOAD):
+    """Encode reports as JSON lists, in as few frames as fit in max_payload."""
+    return chunk_encoded([json.dumps(report, separators=(",", ":")).encode() for report in reports],
+                         b"[", b"]", max_payload - HEADERS_ALLOWANCE)
+
+
+def decode_telemetry(data):
+    """The reports of a telemetry message, anything that isn't one is skipped."""
+    try:
+        reports = json.loads(data)
+    except ValueError:
+        return []
+    if not isinstance(reports, list):
+        return []
+    return [report for report in reports if isinstance(report, dict) and isinstance(report.get("url"), str)]
+
+
+class ReportingTransport:
+    """
+    Wraps a backend's httpx transport and reports how every request to it went, as (url, latency, outcome).
+
+    Latency is the time until the response headers arrive, a 5xx counts as an error. It's an
+    httpx.AsyncBaseTransport in all but name, so importing this module doesn't import httpx.
+    """
+
+    def __init__(self, transport, url, report):
+        self.transport = transport
+        self.url = url
+        self.report = report
+
+    async def handle_async_request(self, request):
+        ## loaded already, the transport we wrap is one of its own
+        import httpx
+        start = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TimeoutException:
+            self.report(self.url, time.monotonic() - start, "timeout")
+            raise
+        except httpx.TransportError:
+            self.report(self.url, time.monotonic() - start, "error")
+            raise
+        self.report(self.url, time.monotonic() - start, "error" if response.status_code >= 500 else "ok")
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.__aexit__(*exc_info)
@@ -0,0 +1,111 @@
+import pytest
+from circuit_breaker import CircuitBreakers, CLOSED, HALF_OPEN, OPEN
+
+URL = "http://10.0.0.5:8080/v1"
+
+
+@pytest.fixture
+def breakers():
+    return CircuitBreakers(failure_rate=0.5, min_requests=4, window=30, open_seconds=10, max_open_seconds=40)
+
+
+def report(ok=0, errors=0, timeouts=0):
+    return {"url": URL, "ok": ok, "errors": errors, "timeouts": timeouts, "latency": None}
+
+
+def test_opens_once_enough_requests_fail(breakers):
+    assert breakers.record(report(errors=2), 0) is None
+    assert breakers.state(URL, 0) == CLOSED
+    assert breakers.record(report(ok=1, timeouts=1), 1) == OPEN
+    assert breakers.state(URL, 1) == OPEN
+
+
+def test_few_requests_or_a_low_failure_rate_keep_it_closed(breakers):
+    assert breakers.record(report(errors=3), 0) is None
+    assert breakers.record(report(ok=10, errors=3), 1) is None
+    assert breakers.state(URL, 1) == CLOSED
+
+
+def test_window_starts_over(breakers):
+    breakers.record(report(errors=3), 0)
+    ## the failures of the last window are forgotten
+    assert breakers.record(report(ok=1, errors=1), 31) is None
+    assert breakers.state(URL, 31) == CLOSED
+
+
+def test_half_open_closes_on_success(breakers):
+    breakers.record(report(errors=4), 0)
+    assert breakers.state(URL, 9) == OPEN
+    assert breakers.state(URL, 10) == HALF_OPEN
+    assert breakers.record(report(ok=1), 11) == CLOSED
+    assert breakers.state(URL, 11) == CLOSED
+    ## closed for good, the next time it opens for the base time again
+    assert breakers.record(report(errors=4), 12) == OPEN
+    assert breakers.state(URL, 22) == HALF_OPEN
+
+
+def test_half_open_failure_opens_for_twice_as_long(breakers):
+    breakers.record(report(errors=4), 0)
+    assert breakers.record(report(ok=3, errors=1), 10) == OPEN
+    assert breakers.state(URL, 29) == OPEN
+    assert breakers.state(URL, 30) == HALF_OPEN
+    assert breakers.record(report(errors=1), 30) == OPEN
+    assert breakers.record(report(errors=1), 69) is None
+    assert breakers.state(URL, 70) == HALF_OPEN
+    ## capped at max_open_seconds
+    assert breakers.record(report(errors=1), 70) == OPEN
+    assert breakers.state(URL, 110) == HALF_OPEN
+
+
+def test_reports_while_open_are_ignored(breakers):
+    breakers.record(report(errors=4), 0)
+    assert breakers.record(report(ok=100), 5) is None
+    assert breakers.state(URL, 5) == OPEN
+
+
+@pytest.mark.parametrize("malformed", [
+    {"url": URL, "ok": "1"},
+    {"url": URL, "errors": -1},
+    {"url": URL, "timeouts": 1.5},
+    {"url": URL, "ok": True},
+    {"url": URL, "errors": [4]},
+])
+def test_malformed_reports_are_skipped(breakers, malformed):
+    assert breakers.record(malformed, 0) is None
+    assert URL not in breakers.breakers
+    ## and don't get in the way of the good ones
+    assert breakers.record(report(errors=4), 0) == OPEN
+
+
+def test_screen_drops_open_and_demotes_half_open(breakers):
+    other = "http://10.0.0.6:8080/v1"
+    models = [{"name": "a", "url": URL}, {"name": "a", "url": other}]
+    assert breakers.screen(models, 0) == (models, set())
+    breakers.record(report(errors=4), 0)
+    assert breakers.screen(models, 1) == ([models[1]], set())
+    assert breakers.screen(models, 10) == (models, {URL})
+
+
+def test_serving(breakers):
+    assert not breakers.serving(URL, 0, 30)
+    breakers.record(report(ok=1), 0)
+    assert breakers.serving(URL, 30, 30)
+    assert not breakers.serving(URL, 31, 30)
+
+
+def test_a_passing_health_check_closes_a_half_open_circuit(breakers):
+    breakers.record(report(errors=4), 0)
+    assert breakers.half_open_at(URL) == 10
+    ## open and closed circuits are left to the telemetry
+    assert breakers.probed(URL, True, 5) is None
+    assert breakers.state(URL, 5) == OPEN
+    assert breakers.probed(URL, True, 10) == CLOSED
+    assert breakers.half_open_at(URL) is None
+    assert breakers.probed(URL, False, 11) is None
+    assert breakers.state(URL, 11) == CLOSED
+
+
+def test_a_failing_health_check_opens_a_half_open_circuit_again(breakers):
+    breakers.record(report(errors=4), 0)
+    assert breakers.probed(URL, False, 10) == OPEN
+    assert breakers.half_open_at(URL) == 30
@@ -0,0 +1,102 @@
+## a discovery node and a client talking through the in-process NATS stand-in of the benchmarks
+import asyncio
+import time
+from benchmarks.fake_nats import FakeNATSServer
+from get_inference_service import InferenceServerManager
+from wire_format import encode_available
+
+QUERY = {"name": "org/foo.Q4_K_M.gguf", "quantization": "", "use_regex_model_name": False, "use_regex_quantization": False}
+
+
+async def start_node(monkeypatch):
+    """Start the discovery server on a fresh NATS, returns (the module, its task, the NATS server)."""
+    nats = await FakeNATSServer().start()
+    monkeypatch.setenv("NATS_SERVER_URL", nats.url)
+    import service_discovery_server
+    task = asyncio.create_task(service_discovery_server.run_nats_client())
+    ## it is listening once it has subscribed
+    while not any(subject == "inference.requested" for subject, _ in nats.subscriptions.values()):
+        await asyncio.sleep(0.01)
+    return service_discovery_server, task, nats
+
+
+async def stop_node(task, nats):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await nats.stop()
+
+
+def test_a_node_without_matches_still_answers(monkeypatch):
+    async def run():
+        _, task, nats = await start_node(monkeypatch)
+        manager = InferenceServerManager(QUERY)
+        try:
+            start = time.perf_counter()
+            discovered, answered = await manager.ask(QUERY, timeout=5, max_replies=1)
+            ## the empty answer ends the wait, instead of the timeout
+            assert time.perf_counter() - start < 2
+            assert discovered == {} and len(answered) == 1
+        finally:
+            await manager.close()
+            await stop_node(task, nats)
+
+    asyncio.run(run())
+
+
+def test_models_that_went_away_drop_out_on_refresh(monkeypatch):
+    async def run():
+        node, task, nats = await start_node(monkeypatch)
+        url = "http://10.0.0.5:8080/v1"
+        node.our_models.add({"name": "org/bar.Q4_K_M.gguf", "quantization": "Q4_K_M", "url": url, "filename": "bar.Q4_K_M.gguf"})
+        manager = InferenceServerManager(QUERY)
+        foo = {"name": "org/foo.Q4_K_M.gguf", "quantization": "Q4_K_M", "url": url, "filename": "foo.Q4_K_M.gguf"}
+        manager.cache.put(manager.config_key, QUERY, [foo], time.monotonic() - 60, pinned=True)
+        try:
+            assert await manager.refresh() == []
+            assert manager.get_models() == []
+        finally:
+            node.our_models.clear()
+            await manager.close()
+            await stop_node(task, nats)
+
+    asyncio.run(run())
+
+
+def test_a_wider_watch_replaces_the_narrow_ones(monkeypatch):
+    async def run():
+        nats = await FakeNATSServer().start()
+        monkeypatch.setenv("NATS_SERVER_URL", nats.url)
+        manager = InferenceServerManager(QUERY)
+        seen = []
+        try:
+            await manager.connect()
+            await manager.listen_for_response(new_server_cb=seen.append)
+            await manager.watch(dict(QUERY, name="org/foo.Q8_0.gguf"))
+            everything = dict(QUERY, name="")
+            await manager.watch(everything)
+            assert set(manager.watched) == {"inference.available.*.*", "inference.unavailable.*.*"}
+            ## a narrower one again is covered already
+            await manager.watch(QUERY)
+            assert len(manager.watched) == 2
+
+            model = {"name": "org/foo.Q4_K_M.gguf", "quantization": "Q4_K_M", "url": "http://10.0.0.5:8080/v1", "filename": "foo.Q4_K_M.gguf"}
+            publisher = InferenceServerManager(QUERY)
+            await publisher.connect()
+            for _ in range(2):
+                for frame in encode_available([model], 1, batch=True):
+                    await publisher.nats_client.publish("inference.available.foo.Q4_K_M", frame)
+            await publisher.nats_client.flush()
+            await publisher.close()
+            for _ in range(100):
+                if manager.callbacks or seen:
+                    break
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            ## once for the model, not per subscription nor per announcement
+            assert seen == [model]
+            assert manager.models == [model]
+        finally:
+            await manager.close()
+            await nats.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from discovery_cache import QueryCache, query_key
+from get_inference_service import InferenceServerManager
+
+QUERY = {"name": "org/foo.Q4_K_M.gguf", "quantization": "", "use_regex_model_name": False, "use_regex_quantization": False}
+FOO = {"name": "org/foo.Q4_K_M.gguf", "quantization": "Q4_K_M", "url": "http://10.0.0.5:8080/v1", "filename": "foo.Q4_K_M.gguf"}
+
+
+def test_query_key_ignores_field_order():
+    assert query_key({"a": 1, "b": [2]}) == query_key({"b": [2], "a": 1})
+    assert query_key({"a": 1}) != query_key({"a": 2})
+
+
+def test_entries_expire_after_their_ttl():
+    cache = QueryCache(ttl=30, max_entries=10)
+    entry = cache.put("k", QUERY, [FOO], now=100)
+    assert entry.expires == 130
+    ## a refresh replaces the models in place, for whoever holds on to the list
+    models = entry.models
+    cache.put("k", QUERY, [], now=200)
+    assert models == [] and cache.get("k").expires == 230
+
+
+def test_least_recently_used_goes_first_but_never_pinned():
+    cache = QueryCache(ttl=30, max_entries=2)
+    cache.put("config", QUERY, [], now=0, pinned=True)
+    cache.put("a", QUERY, [], now=0)
+    cache.put("b", QUERY, [], now=0)
+    cache.get("a")
+    cache.put("c", QUERY, [], now=0)
+    assert "b" not in cache
+    assert {"config", "a", "c"} == set(cache.entries)
+    cache.put("d", QUERY, [], now=0)
+    assert {"config", "c", "d"} == set(cache.entries)
+
+
+def test_concurrent_refreshes_share_one_request():
+    async def run():
+        manager = InferenceServerManager(QUERY)
+        asked = []
+
+        async def ask(query, timeout=None, max_replies=None):
+            asked.append(query)
+            await asyncio.sleep(0.05)
+            return {(FOO["url"], FOO["name"]): FOO}, {"node"}
+
+        manager.ask = ask
+        results = await asyncio.gather(*(manager.refresh() for _ in range(5)))
+        assert len(asked) == 1
+        assert results == [[FOO]] * 5
+        ## fresh now, so reads don't ask again
+        assert manager.get_models() == [FOO]
+        await asyncio.sleep(0)
+        assert len(asked) == 1 and not manager.refreshing
+
+    asyncio.run(run())
+
+
+def test_expired_entries_are_served_while_refreshed():
+    async def run():
+        manager = InferenceServerManager(QUERY)
+        gate = asyncio.Event()
+
+        async def ask(query, timeout=None, max_replies=None):
+            await gate.wait()
+            return {}, {"node"}
+
+        manager.ask = ask
+        manager.cache.put(manager.config_key, QUERY, [FOO], time.monotonic() - 60, pinned=True)
+        assert manager.get_models() == [FOO]
+        assert manager.config_key in manager.refreshing
+        gate.set()
+        await manager.refreshing[manager.config_key]
+        assert manager.get_models() == []
+
+    asyncio.run(run())
+
+
+def test_no_answer_keeps_what_we_have():
+    async def run():
+        manager = InferenceServerManager(QUERY)
+
+        async def ask(query, timeout=None, max_replies=None):
+            return {}, set()
+
+        manager.ask = ask
+        manager.cache.put(manager.config_key, QUERY, [FOO], time.monotonic() - 60, pinned=True)
+        assert await manager.refresh() == [FOO]
+
+    asyncio.run(run())
@@ -0,0 +1,114 @@
+import asyncio
+import pytest
+from health_check import ProbeResult
+from health_scheduler import HealthScheduler
+
+URL = "http://10.0.0.5:8080/v1"
+
+
+@pytest.fixture
+def scheduler():
+    return HealthScheduler(min_interval=5, max_interval=60, growth=2, dead_after=3, dead_max_interval=100, jitter=0)
+
+
+def check(scheduler, ok, now, serving=False):
+    """Run the check that is due, returns the interval until the next one."""
+    assert scheduler.pop_due(now) == [URL]
+    scheduler.record(ProbeResult(URL, ok, latency=0.01), now, serving=serving)
+    return scheduler.next_due() - now
+
+
+def test_healthy_backs_off_to_the_maximum(scheduler):
+    scheduler.add(URL, 0)
+    now, intervals = 0, []
+    for _ in range(5):
+        intervals.append(check(scheduler, True, now))
+        now += intervals[-1]
+    assert intervals == [10, 20, 40, 60, 60]
+
+
+def test_serving_goes_straight_to_the_maximum(scheduler):
+    scheduler.add(URL, 0)
+    assert check(scheduler, True, 0, serving=True) == 60
+
+
+def test_failures_retry_soon_then_back_off_exponentially(scheduler):
+    scheduler.add(URL, 0)
+    now, intervals = 0, []
+    for _ in range(6):
+        intervals.append(check(scheduler, False, now))
+        now += intervals[-1]
+    ## a blip is checked again soon, a dead backend less and less often
+    assert intervals == [5, 5, 10, 20, 40, 80]
+    intervals.append(check(scheduler, False, now))
+    assert intervals[-1] == 100
+
+
+def test_recovery_starts_over_at_the_minimum(scheduler):
+    scheduler.add(URL, 0)
+    now = 0
+    for ok in (True, True, False):
+        now += check(scheduler, ok, now)
+    assert check(scheduler, True, now) == 5
+
+
+def test_not_due_again_until_recorded(scheduler):
+    scheduler.add(URL, 0)
+    assert scheduler.pop_due(0) == [URL]
+    assert scheduler.pop_due(1000) == []
+    assert scheduler.next_due() is None
+
+
+def test_removed_and_rescheduled_entries_are_skipped(scheduler):
+    other = "http://10.0.0.6:8080/v1"
+    scheduler.add(URL, 0)
+    scheduler.add(other, 0)
+    scheduler.add(URL, 0, delay=50)
+    scheduler.remove(other)
+    assert scheduler.pop_due(10) == []
+    assert scheduler.next_due() == 50
+    assert scheduler.pop_due(50) == [URL]
+
+
+def test_jitter_stays_within_its_share(scheduler):
+    scheduler.jitter = 0.1
+    scheduler.add(URL, 0)
+    for _ in range(50):
+        interval = check(scheduler, True, scheduler.next_due(), serving=True)
+        assert 54 <= interval <= 66
+
+
+def test_a_backend_dead_for_long_stays_scheduled(scheduler):
+    ## the intervals from the environment are floats, which is where a huge backoff overflows
+    scheduler.min_interval, scheduler.dead_max_interval = 5.0, 100.0
+    scheduler.add(URL, 0)
+    now = 0
+    ## a week of failures at the longest interval, well past where 2 ** failures overflows a float
+    for _ in range(2000):
+        now += check(scheduler, False, now)
+    assert check(scheduler, False, now) == 100
+
+
+def test_recording_wakes_a_loop_with_nothing_due(scheduler):
+    async def run():
+        scheduler.add(URL, 0)
+        assert scheduler.pop_due(0) == [URL]
+        ## the check is in flight, so nothing is scheduled and the loop would sleep for good
+        waiting = asyncio.create_task(scheduler.wait(0))
+        await asyncio.sleep(0)
+        scheduler.record(ProbeResult(URL, True, latency=0.01), 0)
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+
+
+def test_expedite_moves_a_check_forward_only(scheduler):
+    scheduler.add(URL, 0, delay=50)
+    assert not scheduler.expedite(URL, 60)
+    assert scheduler.expedite(URL, 20)
+    assert scheduler.next_due() == 20
+    assert scheduler.pop_due(20) == [URL]
+    ## being checked right now, its result schedules the next one
+    assert not scheduler.expedite(URL, 20)
+    assert scheduler.pop_due(1000) == []
+    assert not scheduler.expedite("http://unknown/v1", 0)
@@ -0,0 +1,198 @@
+## the unit tests use a stand-in for the bucket with the calls KVRegistry makes, the integration test at the
+## end needs a real JetStream: NATS_JETSTREAM_URL, or a nats-server binary on the PATH it can start
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import time
+import uuid
+import pytest
+from kv_registry import KVRegistry, MODELS_PREFIX, SERVER_PREFIX, url_key
+
+URL = "http://10.0.0.5:8080/v1?x=1"
+
+
+class Entry:
+    def __init__(self, key, value, operation, revision):
+        self.key = key
+        self.value = value
+        self.operation = operation
+        self.revision = revision
+
+
+class Watcher:
+    def __init__(self, entries):
+        self.queue = asyncio.Queue()
+        for entry in entries:
+            self.queue.put_nowait(entry)
+        ## the end of the initial values
+        self.queue.put_nowait(None)
+
+    async def updates(self, timeout=None):
+        return await self.queue.get()
+
+    async def stop(self):
+        pass
+
+
+class Bucket:
+    def __init__(self):
+        self.entries = {}
+        self.revision = 0
+        self.watchers = []
+
+    def write(self, key, value, operation):
+        self.revision += 1
+        entry = Entry(key, value, operation, self.revision)
+        if operation is None:
+            self.entries[key] = entry
+        else:
+            self.entries.pop(key, None)
+        for watcher in self.watchers:
+            watcher.queue.put_nowait(entry)
+        return self.revision
+
+    async def put(self, key, value):
+        return self.write(key, value, None)
+
+    async def delete(self, key):
+        self.write(key, None, "DEL")
+
+    async def watchall(self):
+        watcher = Watcher(sorted(self.entries.values(), key=lambda entry: entry.revision))
+        self.watchers.append(watcher)
+        return watcher
+
+
+def test_url_keys_round_trip():
+    registry = KVRegistry(Bucket())
+    for url in (URL, "http://a/v1", "http://ab/v1", "http://abc/v1"):
+        key = url_key(MODELS_PREFIX, url)
+        assert ":" not in key and "/" not in key and not key.endswith("=")
+        change = registry.change(Entry(key, b'{"url": "x"}', None, 1))
+        assert (change.kind, change.url, change.value) == ("models", url, {"url": "x"})
+
+
+def test_change_of_deleted_foreign_and_damaged_entries():
+    registry = KVRegistry(Bucket())
+    deleted = registry.change(Entry(url_key(SERVER_PREFIX, URL), b"", "PURGE", 4))
+    assert (deleted.kind, deleted.url, deleted.value, deleted.sequence) == ("server", URL, None, 4)
+    assert registry.change(Entry("other.key", b"{}", None, 5)) is None
+    assert registry.change(Entry(url_key(SERVER_PREFIX, URL), b"{not json", None, 6)) is None
+
+
+def test_load_then_follow_changes():
+    async def run():
+        bucket = Bucket()
+        writer = KVRegistry(bucket)
+        other = "http://10.0.0.6:8080/v1"
+        await writer.put_server(URL, {"url": URL, "labels": {"gpu": "a100"}})
+        await writer.put_models(URL, 3, [{"name": "a", "url": URL}], load={"latency": 0.2})
+        await writer.put_server(other)
+        await writer.put_models(other, 1, [])
+        await writer.delete_models(other)
+        await bucket.put(url_key(MODELS_PREFIX, "http://damaged/v1"), b"{")
+
+        reader = KVRegistry(bucket)
+        state = await reader.load()
+        assert state["servers"] == [URL, other]
+        assert state["descriptors"][URL]["labels"] == {"gpu": "a100"}
+        assert state["snapshots"] == {URL: {"version": 3, "models": [{"name": "a", "url": URL}]}}
+        assert state["loads"] == {URL: {"latency": 0.2}}
+        ## the revision is the one the models were announced at, the bucket's sequence numbers are kept apart
+        assert state["revision"] == 3
+        assert reader.sequence == 3
+
+        changes = reader.changes()
+        await writer.delete_server(URL)
+        seen = [await changes.__anext__() for _ in range(2)]
+        assert [(change.kind, change.url, change.value) for change in seen] == [("server", URL, None), ("models", URL, None)]
+        assert reader.sequence == bucket.revision
+        await changes.aclose()
+        await reader.close()
+        assert reader.watcher is None
+
+    asyncio.run(run())
+
+
+def test_ttl_refreshes_dont_move_the_revision():
+    async def run():
+        bucket = Bucket()
+        writer = KVRegistry(bucket)
+        await writer.put_server(URL)
+        await writer.put_models(URL, 2, [{"name": "a", "url": URL}])
+        ## what a node writes every ttl / 3 to keep its servers from expiring
+        for _ in range(10):
+            await writer.put_server(URL)
+            await writer.put_models(URL, 2, [{"name": "a", "url": URL}])
+        state = await KVRegistry(bucket).load()
+        assert state["revision"] == 2
+        assert bucket.revision == 22
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def jetstream_url(tmp_path):
+    url = os.getenv("NATS_JETSTREAM_URL")
+    if url:
+        yield url
+        return
+    binary = shutil.which("nats-server")
+    if not binary:
+        pytest.skip("needs NATS_JETSTREAM_URL or nats-server on the PATH")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([binary, "-js", "-sd", str(tmp_path), "-a", "127.0.0.1", "-p", str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                process.poll()
+                if process.returncode is not None:
+                    pytest.fail("nats-server didn't start")
+                time.sleep(0.1)
+        yield f"nats://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_jetstream_bootstrap_and_follow(jetstream_url):
+    import nats
+
+    async def run():
+        bucket = "sd_test_" + uuid.uuid4().hex[:8]
+        first, second = await nats.connect(jetstream_url), await nats.connect(jetstream_url)
+        try:
+            writer = await KVRegistry.open(first, bucket=bucket, ttl=30)
+            await writer.put_server(URL)
+            await writer.put_models(URL, 1, [{"name": "a", "url": URL}])
+
+            ## a late joiner starts from one bulk read
+            reader = await KVRegistry.open(second, bucket=bucket, create=False)
+            state = await reader.load()
+            assert state["servers"] == [URL]
+            assert state["snapshots"][URL]["models"] == [{"name": "a", "url": URL}]
+            assert state["revision"] == 1 and reader.sequence == 2
+
+            changes = reader.changes()
+            await writer.put_models(URL, 2, [])
+            await writer.delete_server(URL)
+            seen = [await asyncio.wait_for(changes.__anext__(), 5) for _ in range(3)]
+            assert [(change.kind, change.value and change.value["version"]) for change in seen if change.kind == "models"] == \
+                [("models", 2), ("models", None)]
+            assert ("server", None) in [(change.kind, change.value) for change in seen]
+            await changes.aclose()
+            await reader.close()
+            await first.jetstream().delete_key_value(bucket)
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
@@ -0,0 +1,82 @@
+import math
+from health_check import ProbeResult
+from load_balancing import LoadTracker, StickyRouter, prompt_prefix_key
+
+
+def replicas(count, name="org/model.Q4_K_M.gguf"):
+    return [{"name": name, "url": f"http://10.0.0.{i}:8080/v1"} for i in range(count)]
+
+
+def test_sticky_sessions_stay_within_their_bound():
+    router = StickyRouter(balance=1.25, ttl=3600, max_sessions=10000)
+    backends = replicas(4)
+    for i in range(1000):
+        router.route(backends, f"session-{i}", now=0)
+    counts = router.counts[backends[0]["name"]]
+    assert sum(counts.values()) == 1000
+    assert max(counts.values()) <= math.ceil(1.25 * 1000 / 4)
+
+
+def test_sticky_sessions_come_back_to_their_replica():
+    router = StickyRouter(balance=1.25, ttl=3600, max_sessions=10000)
+    backends = replicas(4)
+    first = {i: router.route(backends, f"session-{i}", now=0)[0]["url"] for i in range(200)}
+    for i in range(200):
+        model, outcome = router.route(backends, f"session-{i}", now=1)
+        assert (model["url"], outcome) == (first[i], "hit")
+    assert router.stats()["hit_rate"] == 1.0
+
+
+def test_only_the_sessions_of_a_replica_that_went_away_move():
+    router = StickyRouter(balance=1.25, ttl=3600, max_sessions=10000)
+    backends = replicas(4)
+    first = {i: router.route(backends, f"session-{i}", now=0)[0]["url"] for i in range(400)}
+    gone = backends[0]["url"]
+    for i in range(400):
+        model, outcome = router.route(backends[1:], f"session-{i}", now=1)
+        if first[i] == gone:
+            assert outcome == "moved" and model["url"] != gone
+        else:
+            assert (model["url"], outcome) == (first[i], "hit")
+
+
+def test_old_and_too_many_sessions_are_forgotten():
+    router = StickyRouter(balance=1.25, ttl=10, max_sessions=3)
+    backends = replicas(2)
+    for i in range(5):
+        router.route(backends, f"session-{i}", now=0)
+    assert router.stats()["sessions"] == 3
+    router.route(backends, "late", now=100)
+    assert router.stats()["sessions"] == 1
+    assert sum(router.counts[backends[0]["name"]].values()) == 1
+
+
+def test_prompt_prefix_key_only_looks_at_the_start():
+    system = {"role": "system", "content": "x" * 600}
+    assert prompt_prefix_key([system, {"role": "user", "content": "a"}], length=512) == \
+        prompt_prefix_key([system, {"role": "user", "content": "b"}], length=512)
+    assert prompt_prefix_key([{"role": "user", "content": "a"}]) != prompt_prefix_key([{"role": "user", "content": "b"}])
+
+
+def test_measured_load_wins_over_announced():
+    url = "http://10.0.0.1:8080/v1"
+    tracker = LoadTracker()
+    tracker.record_latency(url, 2.0)
+    tracker.update(url, {"latency": 0.1, "error_rate": 0.0, "in_flight": 3, "queue_depth": 1})
+    assert tracker.load(url) == {"latency": 2.0, "error_rate": 0.0, "in_flight": 3, "queue_depth": 1}
+    ## announcements keep coming, what we measured stays
+    tracker.update(url, {"latency": 0.1, "error_rate": 0.5, "in_flight": 0, "queue_depth": 0})
+    assert tracker.load(url)["latency"] == 2.0 and tracker.load(url)["in_flight"] == 0
+    tracker.forget(url)
+    tracker.update(url, {"latency": 0.1})
+    assert tracker.load(url) == {"latency": 0.1}
+
+
+def test_probes_average_latency_and_errors():
+    url = "http://10.0.0.1:8080/v1"
+    tracker = LoadTracker()
+    tracker.record_probe(ProbeResult(url, True, latency=1.0))
+    tracker.record_probe(ProbeResult(url, False))
+    load = tracker.load(url)
+    assert load["latency"] == 1.0
+    assert 0 < load["error_rate"] < 1
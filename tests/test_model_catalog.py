@@ -0,0 +1,64 @@
+import json
+import random
+import pytest
+from model_catalog import CatalogParser, next_cursor, parse_quantization
+
+
+def catalog(count, **fields):
+    data = [{"id": f"org/model-{i}-8b.Q4_K_M.gguf", "object": "model", "owned_by": "llamacpp",
+             "meta": {"n_params": 8000000000 + i, "note": "a } and ] inside a \"string\" ünïcode"}} for i in range(count)]
+    return json.dumps(dict({"object": "list", "data": data}, **fields)).encode()
+
+
+def parse(body, sizes):
+    parser = CatalogParser()
+    position = 0
+    while position < len(body):
+        size = sizes()
+        parser.feed(body[position:position + size])
+        position += size
+    return parser.close()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_any_chunking_parses_like_json_loads(seed):
+    rng = random.Random(seed)
+    body = catalog(rng.randrange(0, 50), has_more=True, last_id="org/last")
+    parser = parse(body, lambda: rng.randrange(1, 64))
+    expected = json.loads(body)
+    assert [(model.id, model.owned_by, model.meta) for model in parser.models] == \
+        [(entry["id"], entry["owned_by"], entry["meta"]) for entry in expected["data"]]
+    assert parser.fields == {"object": "list", "has_more": True, "last_id": "org/last"}
+
+
+def test_one_byte_at_a_time():
+    body = catalog(3, has_more=False)
+    parser = parse(body, lambda: 1)
+    assert len(parser.models) == 3 and parser.fields["has_more"] is False
+
+
+def test_entries_without_an_id_are_skipped():
+    body = json.dumps({"data": [{"id": "a.Q8_0.gguf"}, {"object": "model"}, "junk", {"id": 5}]}).encode()
+    assert [model.id for model in parse(body, lambda: 7).models] == ["a.Q8_0.gguf"]
+
+
+@pytest.mark.parametrize("body", [b"[]", b'{"data": [{"id": "a"}', b'{"data": [{"id": "a"},', b'{"data" [] }', b"", b'{"data": [nope]}'])
+def test_damaged_catalogs_raise(body):
+    with pytest.raises(ValueError):
+        parse(body, lambda: 3)
+
+
+def test_next_cursor():
+    parser = parse(catalog(2, has_more=True), lambda: 100)
+    assert next_cursor(parser.fields, parser.models) == parser.models[-1].id
+    assert next_cursor({"has_more": True, "last_id": "x"}, parser.models) == "x"
+    assert next_cursor({"has_more": False, "last_id": "x"}, parser.models) is None
+
+
+@pytest.mark.parametrize("model_id, quantization", [
+    ("org/llama-3-8b.Q4_K_M.gguf", "Q4_K_M"),
+    ("org/mistral-7b-IQ2_XXS.gguf", "IQ2_XXS"),
+    ("org/model-f16.gguf", "F16"),
+])
+def test_parse_quantization(model_id, quantization):
+    assert parse_quantization(model_id) == quantization
@@ -0,0 +1,112 @@
+import random
+import pytest
+from model_registry import ModelRegistry, matches_query, model_key
+from query_planner import model_query
+
+FAMILIES = ["llama-3-8b", "llama-3-70b", "mistral-7b", "qwen2-72b"]
+QUANTIZATIONS = {"Q4_K_M": ("K", 4.89), "Q8_0": ("legacy", 8.5), "IQ2_XS": ("IQ", 2.31), "F16": ("float", 16.0)}
+
+
+def random_model(rng, server):
+    family = rng.choice(FAMILIES)
+    quantization = rng.choice(list(QUANTIZATIONS))
+    quant_family, quant_bits = QUANTIZATIONS[quantization]
+    model = {"name": f"org/{family}.{quantization}.gguf", "quantization": quantization, "url": f"http://10.0.0.{server}:8080/v1",
+             "quant_family": quant_family, "quant_bits": quant_bits}
+    ## not every catalog says how long a context its models take, or what they cost
+    if rng.random() < 0.8:
+        model["context_length"] = rng.choice([4096, 8192, 32768, 131072])
+    if rng.random() < 0.5:
+        model["cost"] = rng.choice([0, 0.5, 1, 2.5])
+    return model
+
+
+def random_query(rng):
+    criteria = {}
+    if rng.random() < 0.6:
+        low, high = rng.choice([None, 4096, 8192, 32768]), rng.choice([None, 8192, 32768, 131072])
+        criteria["context_length"] = (low, high)
+    if rng.random() < 0.4:
+        criteria["quant_family"] = rng.choice(["K", "legacy", "IQ", "float"])
+    if rng.random() < 0.3:
+        criteria["cost"] = (None, rng.choice([0, 1, 2.5]))
+    if rng.random() < 0.3:
+        criteria["quant_bits"] = (rng.choice([2, 4, 8]), None)
+    where = []
+    if rng.random() < 0.3:
+        where.append(["context_length", rng.choice(["<", ">", "==", "!="]), rng.choice([8192, 32768])])
+    name, quantization, regex = "", "", False
+    roll = rng.random()
+    if roll < 0.25:
+        family, quantization = rng.choice(FAMILIES), rng.choice(list(QUANTIZATIONS))
+        name = f"org/{family}.{quantization}.gguf"
+        if rng.random() < 0.5:
+            quantization = ""
+    elif roll < 0.4:
+        name, regex = rng.choice(["org/llama.*", ".*72b.*", "nothing"]), True
+    elif roll < 0.5:
+        quantization = rng.choice(list(QUANTIZATIONS))
+    return model_query(name, quantization, regex=regex, where=where, **criteria)
+
+
+def keys(models):
+    return sorted(model_key(model) for model in models)
+
+
+@pytest.fixture
+def registry():
+    rng = random.Random(13)
+    registry = ModelRegistry()
+    for server in range(40):
+        models = {model["name"]: model for model in (random_model(rng, server) for _ in range(rng.randint(1, 6)))}
+        registry.update_server(f"http://10.0.0.{server}:8080/v1", list(models.values()))
+    ## churn, so the indexes have had entries taken out as well as put in
+    for server in range(0, 40, 3):
+        registry.update_server(f"http://10.0.0.{server}:8080/v1", [random_model(rng, server)])
+    for server in range(1, 40, 7):
+        registry.remove_server(f"http://10.0.0.{server}:8080/v1")
+    return registry
+
+
+def test_match_agrees_with_brute_force(registry):
+    rng = random.Random(11)
+    for _ in range(500):
+        query = random_query(rng)
+        expected = [model for model in registry.all() if matches_query(query, model)]
+        assert keys(registry.match(query)) == keys(expected), query
+
+
+def test_plan_candidates_cover_every_match(registry):
+    rng = random.Random(17)
+    planned = 0
+    for _ in range(500):
+        query = random_query(rng)
+        candidates = registry.plan(query)
+        if candidates is None:
+            continue
+        planned += 1
+        expected = {model_key(model) for model in registry.all() if matches_query(query, model)}
+        assert expected <= {model_key(model) for model in candidates}, query
+    assert planned
+
+
+def test_plan_takes_the_narrowest_index(registry):
+    query = model_query(context_length=(131072, 131072), quant_family="IQ")
+    candidates = registry.plan(query)
+    by_context = [model for model in registry.all() if model.get("context_length") == 131072]
+    by_family = [model for model in registry.all() if model["quant_family"] == "IQ"]
+    assert len(candidates) == min(len(by_context), len(by_family))
+
+
+def test_update_server_reports_changes():
+    registry = ModelRegistry()
+    url = "http://a/v1"
+    first = {"name": "org/a.Q4_0.gguf", "quantization": "Q4_0", "url": url, "context_length": 4096}
+    second = {"name": "org/b.Q8_0.gguf", "quantization": "Q8_0", "url": url, "context_length": 8192}
+    assert registry.update_server(url, [first, second]) == ([first, second], [])
+    assert registry.update_server(url, [first, second]) == ([], [])
+    changed = dict(first, context_length=32768)
+    assert registry.update_server(url, [changed]) == ([changed], [second])
+    assert registry.match(model_query(context_length=(8192, None))) == [changed]
+    assert registry.remove_server(url) == [changed]
+    assert len(registry) == 0 and registry.ranges["context_length"] == ([], [])
@@ -0,0 +1,99 @@
+import asyncio
+from model_registry import ModelRegistry
+from registry_store import RegistryStore, apply_entry, empty_state
+
+URL = "http://10.0.0.5:8080/v1"
+OTHER = "http://10.0.0.6:8080/v1"
+
+
+def model(name, url=URL):
+    return {"name": name, "quantization": "Q4_K_M", "url": url, "filename": name.split("/")[-1]}
+
+
+def restore(state):
+    """Put a loaded state back the way the discovery server does on startup."""
+    registry = ModelRegistry()
+    for url, snapshot in state["snapshots"].items():
+        registry.restore_server(url, snapshot["models"], snapshot["version"])
+    registry.revision = max(registry.revision, state["revision"])
+    return registry
+
+
+def test_journal_compact_and_restore(tmp_path):
+    async def run():
+        path = str(tmp_path / "registry.json")
+        store = RegistryStore(path, compact_every=3)
+        state = empty_state()
+        entries = [
+            {"op": "add_server", "url": URL, "descriptor": {"url": URL, "labels": {"gpu": "a100"}}},
+            {"op": "add_server", "url": OTHER},
+            {"op": "update_server", "url": URL, "version": 1, "revision": 1, "models": [model("org/a.Q4_K_M.gguf")], "last_seen": 100.0},
+        ]
+        due = [store.append(entry) for entry in entries]
+        assert due == [False, False, True]
+        for entry in entries:
+            apply_entry(state, entry)
+        await store.compact(state)
+        ## and a few more after the snapshot, only in the journal
+        store.append({"op": "update_server", "url": OTHER, "version": 2, "revision": 2, "models": [model("org/b.Q4_K_M.gguf", OTHER)]})
+        store.append({"op": "update_server", "url": URL, "version": 3, "revision": 3,
+                      "models": [model("org/a.Q4_K_M.gguf"), model("org/c.Q4_K_M.gguf")], "last_seen": 200.0})
+        store.close()
+
+        restarted = RegistryStore(path, compact_every=3)
+        loaded = restarted.load()
+        assert restarted.entries == 2
+        assert loaded["servers"] == [URL, OTHER]
+        assert loaded["descriptors"] == {URL: {"url": URL, "labels": {"gpu": "a100"}}}
+        assert loaded["last_seen"] == {URL: 200.0}
+        assert loaded["revision"] == 3
+
+        registry = restore(loaded)
+        assert registry.revision == 3
+        assert len(registry) == 3
+        assert registry.stale == {URL, OTHER}
+        ## a server stays stale until it's health checked, then all of its models are announced again as verified
+        added, removed = registry.update_server(URL, [model("org/a.Q4_K_M.gguf"), model("org/c.Q4_K_M.gguf")])
+        assert len(added) == 2 and removed == []
+        assert registry.stale == {OTHER}
+
+    asyncio.run(run())
+
+
+def test_removed_servers_and_damaged_lines(tmp_path):
+    path = str(tmp_path / "registry.json")
+    store = RegistryStore(path)
+    store.append({"op": "add_server", "url": URL})
+    store.append({"op": "update_server", "url": URL, "version": 1, "revision": 1, "models": [model("org/a.Q4_K_M.gguf")]})
+    store.append({"op": "add_server", "url": OTHER})
+    store.append({"op": "remove_server", "url": URL, "revision": 2})
+    store.close()
+    ## a crash in the middle of a write
+    with open(f"{path}.journal", "a") as journal_file:
+        journal_file.write('{"op": "add_ser')
+    loaded = RegistryStore(path).load()
+    assert loaded["servers"] == [OTHER] and loaded["snapshots"] == {} and loaded["revision"] == 2
+
+    ## the next entry isn't glued onto the damaged one
+    store = RegistryStore(path)
+    store.append({"op": "add_server", "url": URL})
+    store.close()
+    assert RegistryStore(path).load()["servers"] == [OTHER, URL]
+
+
+def test_changes_made_while_compacting_go_into_the_new_journal(tmp_path):
+    async def run():
+        path = str(tmp_path / "registry.json")
+        store = RegistryStore(path)
+        state = empty_state()
+        store.append({"op": "add_server", "url": URL})
+        apply_entry(state, {"op": "add_server", "url": URL})
+        compacting = asyncio.create_task(store.compact(state))
+        await asyncio.sleep(0)
+        ## not in the state being written
+        assert store.append({"op": "add_server", "url": OTHER}) is False
+        await compacting
+        store.close()
+        assert RegistryStore(path).load()["servers"] == [URL, OTHER]
+
+    asyncio.run(run())
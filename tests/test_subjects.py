@@ -0,0 +1,37 @@
+import pytest
+from subjects import by_subject, covers, model_family, model_subject, query_subject
+
+QUERY = {"name": "", "quantization": "", "use_regex_model_name": False, "use_regex_quantization": False}
+MODEL = {"name": "org/Llama-3-8B.Q4_K_M.gguf", "quantization": "Q4_K_M"}
+
+
+@pytest.mark.parametrize("subscription, subject, expected", [
+    ("inference.available.*.*", "inference.available.llama-3-8b.Q4_K_M", True),
+    ("inference.available.*.*", "inference.available.llama-3-8b.*", True),
+    ("inference.available.llama-3-8b.*", "inference.available.llama-3-8b.Q8_0", True),
+    ("inference.available.llama-3-8b.*", "inference.available.*.Q8_0", False),
+    ("inference.available.llama-3-8b.Q4_K_M", "inference.available.llama-3-8b.*", False),
+    ("inference.available.*.*", "inference.available", False),
+    ("inference.available.*.*", "inference.unavailable.llama-3-8b.Q4_K_M", False),
+])
+def test_covers(subscription, subject, expected):
+    assert covers(subscription, subject) is expected
+
+
+def test_a_model_goes_on_the_subject_its_query_subscribes_to():
+    assert model_family(MODEL["name"]) == "llama-3-8b"
+    subject = model_subject("inference.available", MODEL)
+    assert subject == "inference.available.llama-3-8b.Q4_K_M"
+    for query in (dict(QUERY, name=MODEL["name"]), dict(QUERY, quantization="Q4_K_M"), QUERY,
+                  dict(QUERY, name="llama.*", use_regex_model_name=True)):
+        assert covers(query_subject("inference.available", query), subject)
+    assert not covers(query_subject("inference.available", dict(QUERY, quantization="Q8_0")), subject)
+
+
+def test_by_subject_mirrors_on_the_flat_subject():
+    other = {"name": "org/phi-3.F16.gguf", "quantization": "F16"}
+    groups = by_subject("inference.available", [MODEL, other], mirror=True)
+    assert groups == {"inference.available.llama-3-8b.Q4_K_M": [MODEL], "inference.available.phi-3.F16": [other],
+                      "inference.available": [MODEL, other]}
+    assert "inference.available" not in by_subject("inference.available", [MODEL], mirror=False)
+    assert by_subject("inference.available", [], mirror=True) == {}
@@ -0,0 +1,111 @@
+import json
+import math
+import pytest
+from wire_format import (BINARY_ENCODING, JSON_ENCODING, I32_MAX, ENCODING_HEADER, chunk_encoded, decode_available,
+                         decode_load_report, decode_request, decode_unavailable, encode_available, encode_load_report,
+                         encode_request, encode_unavailable, with_encoding)
+
+MODELS = [
+    {"name": "org/llama-3-8b.Q4_K_M.gguf", "quantization": "Q4_K_M", "url": "http://10.0.0.5:8080/v1",
+     "filename": "llama-3-8b.Q4_K_M.gguf", "context_length": 8192, "labels": {"rack": "r1"},
+     "load": {"latency": 0.25, "error_rate": 0.0, "in_flight": 3, "queue_depth": 0}},
+    {"name": "org/mistral-7b.Q8_0.gguf", "quantization": "Q8_0", "url": "http://10.0.0.5:8080/v1",
+     "filename": "mistral-7b.Q8_0.gguf", "stale": True},
+    {"name": "org/phi-3.F16.gguf", "quantization": "F16", "url": "http://10.0.0.6:8080/v1", "filename": "phi-3.F16.gguf",
+     "half_open": True, "load": {"latency": None, "error_rate": None, "in_flight": None, "queue_depth": None}},
+]
+
+
+def binary():
+    return with_encoding(BINARY_ENCODING)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_available_json_round_trip(batch):
+    models = []
+    for frame in encode_available(MODELS, 7, batch=batch, encoding=JSON_ENCODING):
+        decoded, revision = decode_available(frame)
+        assert revision == 7
+        models.extend(decoded)
+    assert models == MODELS
+
+
+
+@pytest.mark.parametrize("encoding", [JSON_ENCODING, BINARY_ENCODING])
+def test_an_empty_batch_is_one_empty_frame(encoding):
+    frames = encode_available([], 3, batch=True, encoding=encoding)
+    assert len(frames) == 1
+    assert decode_available(frames[0], with_encoding(encoding)) == ([], 3)
+    assert encode_available([], 3, batch=False, encoding=JSON_ENCODING) == []
+
+def test_available_binary_round_trip():
+    frames = encode_available(MODELS, 2 ** 40, encoding=BINARY_ENCODING)
+    assert len(frames) == 1
+    models, revision = decode_available(frames[0], binary())
+    assert revision == 2 ** 40
+    assert [model["name"] for model in models] == [model["name"] for model in MODELS]
+    assert models[0]["labels"] == {"rack": "r1"} and models[0]["context_length"] == 8192
+    assert models[0]["load"]["in_flight"] == 3 and math.isclose(models[0]["load"]["latency"], 0.25)
+    assert models[1]["stale"] is True and "load" not in models[1]
+    assert models[2]["half_open"] is True
+
+
+def test_binary_frames_split_to_fit():
+    models = [dict(MODELS[0], name=f"org/model-{index}.Q4_K_M.gguf") for index in range(2000)]
+    frames = encode_available(models, 1, max_payload=16 * 1024, encoding=BINARY_ENCODING)
+    assert len(frames) > 1 and all(len(frame) <= 16 * 1024 for frame in frames)
+    decoded = [model for frame in frames for model in decode_available(frame, binary())[0]]
+    assert [model["name"] for model in decoded] == [model["name"] for model in models]
+
+
+@pytest.mark.parametrize("encoding", [JSON_ENCODING, BINARY_ENCODING])
+def test_unavailable_and_load_round_trip(encoding):
+    headers = with_encoding(encoding)
+    servers = [{"url": "http://a/v1"}, {"url": "http://b/v1", "name": "org/x.Q4_0.gguf", "quantization": "Q4_0"}]
+    assert [model for frame in encode_unavailable(servers, encoding=encoding)
+            for model in decode_unavailable(frame, headers)] == servers
+    loads = [{"url": "http://a/v1", "latency": 0.5, "error_rate": 0.25, "in_flight": 2, "queue_depth": 9},
+             {"url": "http://b/v1", "latency": None, "error_rate": None, "in_flight": None, "queue_depth": None}]
+    assert [load for frame in encode_load_report(loads, encoding=encoding)
+            for load in decode_load_report(frame, headers)] == loads
+
+
+@pytest.mark.parametrize("encoding", [JSON_ENCODING, BINARY_ENCODING])
+def test_request_round_trip(encoding):
+    query = {"name": "llama.*", "quantization": "", "use_regex_model_name": True, "use_regex_quantization": False,
+             "where": [["context_length", ">=", 32768]], "limit": 3}
+    assert decode_request(encode_request(query, encoding), with_encoding(encoding)) == query
+
+
+@pytest.mark.parametrize("in_flight, queue_depth, expected", [
+    (I32_MAX, 0, (I32_MAX, 0)),
+    (I32_MAX + 1, 2 ** 63, (I32_MAX, I32_MAX)),
+    (-1, -2 ** 31 - 1, (None, None)),
+    (float("inf"), float("nan"), (I32_MAX, None)),
+])
+def test_counts_saturate_at_the_i32_bounds(in_flight, queue_depth, expected):
+    load = {"url": "http://a/v1", "latency": 0.1, "error_rate": 0.0, "in_flight": in_flight, "queue_depth": queue_depth}
+    (decoded,) = decode_load_report(encode_load_report([load], encoding=BINARY_ENCODING)[0], binary())
+    assert (decoded["in_flight"], decoded["queue_depth"]) == expected
+    model = dict(MODELS[0], load=load)
+    (frame,) = encode_available([model], 1, encoding=BINARY_ENCODING)
+    decoded = decode_available(frame, binary())[0][0]["load"]
+    assert (decoded["in_flight"], decoded["queue_depth"]) == expected
+
+
+def test_truncated_and_foreign_frames_are_rejected():
+    (frame,) = encode_available(MODELS, 1, encoding=BINARY_ENCODING)
+    for damaged in (frame[:5], frame[:-1], b"XX" + frame[2:]):
+        with pytest.raises(ValueError):
+            decode_available(damaged, binary())
+    with pytest.raises(ValueError):
+        decode_load_report(frame, binary())
+    with pytest.raises(ValueError):
+        decode_available(frame, {ENCODING_HEADER: "sd-binary/99"})
+
+
+def test_chunk_encoded_fits_max_payload():
+    parts = [json.dumps({"index": index}).encode() for index in range(500)]
+    frames = chunk_encoded(parts, b"[", b"]", 100)
+    assert all(len(frame) <= 100 for frame in frames)
+    assert [item for frame in frames for item in json.loads(frame)] == [{"index": index} for index in range(500)]
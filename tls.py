@@ -0,0 +1,14 @@
+## the ssl context every http client of the process shares
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def shared_ssl_context():
+    """
+    The ssl context for the health checker's and the OpenAI clients' connections. Loading the CA bundle
+    is slow, so it's only done once.
+
+    httpx is imported with the first call, so importing this costs a client that never makes a request nothing.
+    """
+    import httpx
+    return httpx.create_ssl_context()
@@ -0,0 +1,402 @@
+## how discovery messages are laid out on the wire
+import json
+import math
+import os
+import struct
+
+## batching on the flat inference.available is opt-in until every client in the fleet understands batched frames,
+## the per-family subjects are always batched since only clients that read batches subscribe to them
+BATCH_ANNOUNCEMENTS = os.getenv("BATCH_ANNOUNCEMENTS", "false").lower() == "true"
+## the default max_payload of a nats server, used when we don't know the real one
+DEFAULT_MAX_PAYLOAD = 1024 * 1024
+## max_payload also counts the message headers, leave them some room
+HEADERS_ALLOWANCE = 512
+
+## a message in the binary encoding says so in its Encoding header, one without the header is JSON.
+## peers that can read the binary encoding say so in the Accept-Encoding header of their requests
+ENCODING_HEADER = "Encoding"
+ACCEPT_ENCODING_HEADER = "Accept-Encoding"
+JSON_ENCODING = "json"
+BINARY_ENCODING = "sd-binary/1"
+## replies follow the Accept-Encoding of the request, this is what we send unasked on the shared subjects.
+## leave it at json until every peer in the fleet reads the binary encoding
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", JSON_ENCODING)
+
+
+def chunk_encoded(parts, prefix, suffix, max_payload):
+    """
+    Join already encoded JSON values into as few frames as fit in `max_payload` bytes.
+
+    Args:
+        parts (list): Encoded JSON values, e.g. one per model.
+        prefix (bytes): What goes before the values, e.g. b'{"selected_models": ['
+        suffix (bytes): What goes after the values, e.g. b']}'
+
+    Returns:
+        list: The frames, a value that is too big on its own still gets a frame of its own.
+    """
+    frames = []
+    batch = []
+    size = len(prefix) + len(suffix)
+    for part in parts:
+        ## every value after the first one also needs a separator
+        part_size = len(part) + (1 if batch else 0)
+        if batch and size + part_size > max_payload:
+            frames.append(prefix + b",".join(batch) + suffix)
+            batch = []
+            size = len(prefix) + len(suffix)
+            part_size = len(part)
+        batch.append(part)
+        size += part_size
+    if batch:
+        frames.append(prefix + b",".join(batch) + suffix)
+    return frames
+
+
+def encode_available(models, revision, max_payload=DEFAULT_MAX_PAYLOAD, batch=BATCH_ANNOUNCEMENTS, encoding=WIRE_FORMAT):
+    """
+    Encode an inference.available announcement of some models.
+
+    Args:
+        models (list): The models to announce.
+        revision (int): The registry revision they belong to.
+        batch (bool): Send a list of models per frame instead of one frame per model, binary frames are always batched.
+        encoding (str): JSON_ENCODING or BINARY_ENCODING.
+
+    Returns:
+        list: The encoded frames to publish. Batched, no models is one empty frame, so an answer that found nothing still says so.
+    """
+    if encoding == BINARY_ENCODING:
+        if not models:
+            return [FRAME.pack(BINARY_MAGIC, BINARY_VERSION, KIND_AVAILABLE, revision, 0) + COUNT.pack(0)]
+        return encode_binary(KIND_AVAILABLE, models, revision, max_payload)
+    if not batch:
+        return [json.dumps({"selected_model": model, "revision": revision}).encode() for model in models]
+    prefix = json.dumps({"revision": revision})[:-1].encode() + b', "selected_models": ['
+    return chunk_encoded([json.dumps(model).encode() for model in models], prefix, b"]}", max_payload - HEADERS_ALLOWANCE) or [prefix + b"]}"]
+
+
+def encode_reply(query, model, revision, encoding=WIRE_FORMAT):
+    """Encode the answer to a request that came without a reply inbox, it goes out on inference.available."""
+    if encoding == BINARY_ENCODING:
+        ## binary peers know a reply by its revision, no need to echo the request
+        return encode_binary(KIND_AVAILABLE, [model], revision)[0]
+    return json.dumps({"requested_model": query, "selected_model": model, "revision": revision}).encode()
+
+
+def encode_unavailable(models, max_payload=DEFAULT_MAX_PAYLOAD, encoding=WIRE_FORMAT):
+    """Encode an inference.unavailable announcement, a plain list of models split to fit `max_payload`."""
+    if encoding == BINARY_ENCODING:
+        return encode_binary(KIND_UNAVAILABLE, models, 0, max_payload)
+    return chunk_encoded([json.dumps(model).encode() for model in models], b"[", b"]", max_payload - HEADERS_ALLOWANCE)
+
+
+def encode_load_report(loads, max_payload=DEFAULT_MAX_PAYLOAD, encoding=WIRE_FORMAT):
+    """Encode an inference.load report, a list with the load of every backend split to fit `max_payload`."""
+    if encoding == BINARY_ENCODING:
+        return encode_binary(KIND_LOAD, loads, 0, max_payload)
+    return chunk_encoded([json.dumps(load).encode() for load in loads], b"[", b"]", max_payload - HEADERS_ALLOWANCE)
+
+
+def encode_request(query, encoding=WIRE_FORMAT):
+    """Encode a request for models on inference.requested."""
+    if encoding == BINARY_ENCODING:
+        return encode_binary(KIND_REQUEST, [query])[0]
+    return json.dumps(query).encode()
+
+
+def decode_available(data, headers=None):
+    """
+    Decode an inference.available frame, batched or single model, JSON or binary.
+
+    Returns:
+        tuple: (models, revision), models is empty for frames that are neither a reply nor an announcement.
+    """
+    if is_binary(headers):
+        return decode_binary(data, KIND_AVAILABLE)
+    frame = json.loads(data)
+    revision = frame.get("revision", 0)
+    if "selected_models" in frame:
+        return frame["selected_models"], revision
+    ## replies to a request carry the request, announcements of changes carry a revision
+    if frame.get("requested_model") or "revision" in frame:
+        return [frame["selected_model"]], revision
+    return [], revision
+
+
+def decode_unavailable(data, headers=None):
+    if is_binary(headers):
+        return decode_binary(data, KIND_UNAVAILABLE)[0]
+    return json.loads(data)
+
+
+def decode_load_report(data, headers=None):
+    if is_binary(headers):
+        return decode_binary(data, KIND_LOAD)[0]
+    return json.loads(data)
+
+
+def decode_request(data, headers=None):
+    if is_binary(headers):
+        return decode_binary(data, KIND_REQUEST)[0][0]
+    return json.loads(data)
+
+
+def is_binary(headers):
+    """Whether a message with these headers is in the binary encoding, raises ValueError for an encoding we don't know."""
+    encoding = (headers or {}).get(ENCODING_HEADER, JSON_ENCODING)
+    if encoding == JSON_ENCODING:
+        return False
+    if encoding == BINARY_ENCODING:
+        return True
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def reply_encoding(headers):
+    """Answer in the binary encoding only those who asked in their Accept-Encoding header."""
+    accepted = (headers or {}).get(ACCEPT_ENCODING_HEADER, "")
+    return BINARY_ENCODING if BINARY_ENCODING in (part.strip() for part in accepted.split(",")) else JSON_ENCODING
+
+
+def with_encoding(encoding, headers=None):
+    """The headers to publish a message in `encoding` with, JSON goes without an Encoding header for old peers."""
+    if encoding == JSON_ENCODING:
+        return headers
+    return dict(headers or {}, **{ENCODING_HEADER: encoding})
+
+
+def request_headers(encoding=WIRE_FORMAT):
+    """The headers of a request, it's encoded in `encoding` and we can read binary replies."""
+    return with_encoding(encoding, {ACCEPT_ENCODING_HEADER: BINARY_ENCODING})
+
+
+## the binary encoding, all numbers little endian:
+##   frame    magic b"SD", version u8, kind u8, revision u64, string count u16,
+##            every string as its length u32 and its utf-8 bytes, record count u32, the records
+##   model    name, quantization, url, filename and extra as string ids u16, flags u8,
+##            latency f32, error rate f32, in flight i32, queue depth i32
+##   load     url as a string id u16, latency f32, error rate f32, in flight i32, queue depth i32
+##   request  name, quantization and extra as string ids u16, flags u8
+## every distinct string goes once into the string table of its frame and records refer to it by index,
+## so the url shared by all the models of a backend costs two bytes a model. A missing string is NO_STRING,
+## a missing number NaN or -1, and a count beyond what an i32 holds saturates at I32_MAX.
+## Whatever a record has beyond these fields goes as a JSON object in `extra`.
+BINARY_MAGIC = b"SD"
+BINARY_VERSION = 1
+KIND_AVAILABLE = 1
+KIND_UNAVAILABLE = 2
+KIND_LOAD = 3
+KIND_REQUEST = 4
+NO_STRING = 0xFFFF
+FRAME = struct.Struct("<2sBBQH")
+STRING_LENGTH = struct.Struct("<I")
+COUNT = struct.Struct("<I")
+MODEL = struct.Struct("<HHHHHBffii")
+LOAD = struct.Struct("<Hffii")
+REQUEST = struct.Struct("<HHHB")
+MODEL_STRINGS = ("name", "quantization", "url", "filename")
+MODEL_FIELDS = MODEL_STRINGS + ("load", "stale")
+MODEL_HAS_LOAD = 1
+MODEL_STALE = 2
+REQUEST_FIELDS = ("name", "quantization", "use_regex_model_name", "use_regex_quantization")
+REQUEST_REGEX_NAME = 1
+REQUEST_REGEX_QUANTIZATION = 2
+I32_MAX = 2 ** 31 - 1
+
+
+class StringTable:
+    """The strings of one binary frame, each stored once and referred to by its index."""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, value):
+        if value is None:
+            return NO_STRING
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            if string_id >= NO_STRING:
+                raise OverflowError("Too many strings for one frame")
+            self.ids[value] = string_id
+            self.strings.append(value)
+        return string_id
+
+    def extra(self, record, fields):
+        """Intern whatever `record` has beyond the schema's `fields`, as one JSON object."""
+        extra = {key: value for key, value in record.items() if key not in fields}
+        if not extra:
+            return NO_STRING
+        return self.intern(json.dumps(extra, sort_keys=True, separators=(",", ":")))
+
+    def encode(self):
+        parts = []
+        for value in self.strings:
+            encoded = value.encode()
+            parts.append(STRING_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        return b"".join(parts)
+
+
+def count_number(value):
+    """
+    A count as an i32, -1 for an unknown or negative one and I32_MAX for anything beyond it.
+
+    Counts come from headers the backends set, one that doesn't fit mustn't cost the whole frame.
+    """
+    if value is None or not value >= 0:
+        return -1
+    return int(min(value, I32_MAX))
+
+
+def load_numbers(load):
+    """The latency, error rate, in flight and queue depth of a load, with NaN and -1 for unknown ones."""
+    latency, error_rate = load.get("latency"), load.get("error_rate")
+    return (math.nan if latency is None else latency, math.nan if error_rate is None else error_rate,
+            count_number(load.get("in_flight")), count_number(load.get("queue_depth")))
+
+
+def load_from_numbers(latency, error_rate, in_flight, queue_depth):
+    return {
+        "latency": None if math.isnan(latency) else latency,
+        "error_rate": None if math.isnan(error_rate) else error_rate,
+        "in_flight": None if in_flight < 0 else in_flight,
+        "queue_depth": None if queue_depth < 0 else queue_depth,
+    }
+
+
+def pack_model(strings, model):
+    load = model.get("load")
+    flags = (MODEL_HAS_LOAD if load else 0) | (MODEL_STALE if model.get("stale") else 0)
+    return MODEL.pack(*[strings.intern(model.get(key)) for key in MODEL_STRINGS], strings.extra(model, MODEL_FIELDS),
+                      flags, *load_numbers(load or {}))
+
+
+def unpack_model(strings, fields, extra):
+    ## hot on busy subjects, so unrolled. NaN is the one number that is not equal to itself
+    name, quantization, url, filename, extra_id, flags, latency, error_rate, in_flight, queue_depth = fields
+    model = {}
+    if name != NO_STRING:
+        model["name"] = strings[name]
+    if quantization != NO_STRING:
+        model["quantization"] = strings[quantization]
+    if url != NO_STRING:
+        model["url"] = strings[url]
+    if filename != NO_STRING:
+        model["filename"] = strings[filename]
+    if flags & MODEL_HAS_LOAD:
+        model["load"] = {
+            "latency": None if latency != latency else latency,
+            "error_rate": None if error_rate != error_rate else error_rate,
+            "in_flight": None if in_flight < 0 else in_flight,
+            "queue_depth": None if queue_depth < 0 else queue_depth,
+        }
+    if flags & MODEL_STALE:
+        model["stale"] = True
+    if extra_id != NO_STRING:
+        model.update(extra(extra_id))
+    return model
+
+
+def pack_load(strings, load):
+    return LOAD.pack(strings.intern(load.get("url")), *load_numbers(load))
+
+
+def unpack_load(strings, fields, extra):
+    return dict(load_from_numbers(*fields[1:]), url=strings[fields[0]])
+
+
+def pack_request(strings, query):
+    flags = ((REQUEST_REGEX_NAME if query.get("use_regex_model_name") else 0)
+             | (REQUEST_REGEX_QUANTIZATION if query.get("use_regex_quantization") else 0))
+    return REQUEST.pack(strings.intern(query.get("name")), strings.intern(query.get("quantization")),
+                        strings.extra(query, REQUEST_FIELDS), flags)
+
+
+def unpack_request(strings, fields, extra):
+    name, quantization, extra_id, flags = fields
+    query = {
+        "name": "" if name == NO_STRING else strings[name],
+        "quantization": "" if quantization == NO_STRING else strings[quantization],
+        "use_regex_model_name": bool(flags & REQUEST_REGEX_NAME),
+        "use_regex_quantization": bool(flags & REQUEST_REGEX_QUANTIZATION),
+    }
+    if extra_id != NO_STRING:
+        query.update(extra(extra_id))
+    return query
+
+
+## kind -> (record layout, pack, unpack)
+RECORD_KINDS = {
+    KIND_AVAILABLE: (MODEL, pack_model, unpack_model),
+    KIND_UNAVAILABLE: (MODEL, pack_model, unpack_model),
+    KIND_LOAD: (LOAD, pack_load, unpack_load),
+    KIND_REQUEST: (REQUEST, pack_request, unpack_request),
+}
+
+
+def encode_binary(kind, records, revision=0, max_payload=DEFAULT_MAX_PAYLOAD):
+    """
+    Encode records of one kind into binary frames.
+
+    Returns:
+        list: The frames, the records are split in halves until every frame fits in `max_payload` bytes.
+    """
+    if not records:
+        return []
+    _, pack, _ = RECORD_KINDS[kind]
+    strings = StringTable()
+    try:
+        packed = [pack(strings, record) for record in records]
+    except OverflowError:
+        packed = None
+    if packed is not None:
+        frame = b"".join([FRAME.pack(BINARY_MAGIC, BINARY_VERSION, kind, revision, len(strings.strings)),
+                          strings.encode(), COUNT.pack(len(packed))] + packed)
+        if len(frame) <= max_payload - HEADERS_ALLOWANCE or len(records) == 1:
+            return [frame]
+    middle = len(records) // 2
+    return (encode_binary(kind, records[:middle], revision, max_payload)
+            + encode_binary(kind, records[middle:], revision, max_payload))
+
+
+def decode_binary(data, kind):
+    """
+    Decode a binary frame of records of one kind.
+
+    Returns:
+        tuple: (records, revision)
+    """
+    try:
+        magic, version, frame_kind, revision, string_count = FRAME.unpack_from(data)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f"Not a version {BINARY_VERSION} binary frame")
+        if frame_kind != kind:
+            raise ValueError(f"Expected a frame of kind {kind}, got {frame_kind}")
+        offset = FRAME.size
+        strings = []
+        for _ in range(string_count):
+            (length,) = STRING_LENGTH.unpack_from(data, offset)
+            offset += STRING_LENGTH.size
+            strings.append(bytes(data[offset:offset + length]).decode())
+            offset += length
+        (count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+    except struct.error as e:
+        raise ValueError(f"Truncated binary frame: {e}") from e
+    layout, _, unpack = RECORD_KINDS[kind]
+    if len(data) - offset != count * layout.size:
+        raise ValueError("Truncated binary frame")
+    ## records of a frame often share their extra fields, decode each of them once
+    extras = {}
+
+    def extra(string_id):
+        if string_id not in extras:
+            extras[string_id] = json.loads(strings[string_id])
+        return dict(extras[string_id])
+
+    try:
+        return [unpack(strings, fields, extra) for fields in layout.iter_unpack(data[offset:])], revision
+    except IndexError as e:
+        raise ValueError("Binary frame refers to a string it doesn't have") from e